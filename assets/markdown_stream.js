@@ -0,0 +1,41 @@
+window.markdownStream = window.markdownStream || {};
+
+/**
+ * Applies a server-rendered markdown frame (see src/markdown_stream.py) to a container.
+ * Finished blocks are appended once; only the open tail block is replaced.
+ *
+ * @param {HTMLElement} container - Element holding the rendered answer
+ * @param {{start: number, blocks: string[], tail: string}} frame - Markdown frame
+ */
+window.markdownStream.apply = function(container, frame) {
+    if (!container || !frame) return;
+
+    // First frame: drop placeholder content and add the tail element
+    if (!container.hasAttribute('data-markdown-stream')) {
+        container.innerHTML = '';
+        container.setAttribute('data-markdown-stream', '');
+        const tailElement = document.createElement('div');
+        tailElement.className = 'md-tail';
+        container.appendChild(tailElement);
+    }
+    const tail = container.querySelector(':scope > .md-tail');
+    let count = Number(container.dataset.blockCount || 0);
+
+    // A frame starting before our last block replaces the blocks from there on
+    if (frame.start < count) {
+        container.querySelectorAll(':scope > .md-block').forEach(function(block) {
+            if (Number(block.dataset.index) >= frame.start) block.remove();
+        });
+        count = frame.start;
+    }
+
+    frame.blocks.forEach(function(html) {
+        const block = document.createElement('div');
+        block.className = 'md-block';
+        block.dataset.index = count++;
+        block.innerHTML = html;
+        container.insertBefore(block, tail);
+    });
+    container.dataset.blockCount = count;
+    tail.innerHTML = frame.tail;
+};
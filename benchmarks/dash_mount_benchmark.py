@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import types
+
+os.environ.setdefault("JOURNAL", "0")
+os.environ.setdefault("LEDGER", "0")
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+import httpx  # noqa: E402
+
+import serve  # noqa: E402
+
+# Memory and throughput of the Dash app mounted in the FastAPI process
+# (DASH_MOUNT_PATH, see dash_mount.py) versus run as its own process.
+#
+#   separate: one FastAPI worker (DASH_MOUNT_PATH="") plus the standalone Dash
+#             app on Werkzeug's threaded server
+#   mounted:  one FastAPI worker serving the page and Dash at /dash
+#
+# Both use a fake provider streaming --tokens tokens every --token-ms ms (a
+# finish chunk last, like litellm). --dash-users Dash clients each send
+# --messages messages and poll the streaming callback every 100 ms like the
+# page's interval; --page-users clients stream /chat/events at the same time.
+# Reported: PSS and RSS summed over the server processes after the load,
+# messages per second per frontend, provider calls per Dash message and the
+# mean time until a Dash client first sees text.
+#
+#   python benchmarks/dash_mount_benchmark.py --dash-users 20 --page-users 20
+
+POLL_INTERVAL = 0.1
+
+def fake_completion(tokens, token_seconds):
+    def completion(model, messages, stream=True, **kwargs):
+        for n in range(tokens):
+            time.sleep(token_seconds)
+            delta = types.SimpleNamespace(content=f"token{n} ")
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason=None)])
+        delta = types.SimpleNamespace(content=None)
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason="stop")])
+    return completion
+
+def use_fake_provider(args):
+    import providers
+    providers._litellm = types.SimpleNamespace(completion=fake_completion(args.tokens, args.token_ms / 1000))
+
+def listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(2048)
+    return sock
+
+def fork(target):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            target()
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def start_fastapi(args, mount_path):
+    sock = listen()
+
+    def run():
+        os.environ["DASH_MOUNT_PATH"] = mount_path
+        use_fake_provider(args)
+        import app
+        server_args = serve.parse_args(["--log-level", "warning"])
+        serve.run_worker(sock, app.app, server_args, time.perf_counter(), serve.apply_profile("default"))
+
+    pid = fork(run)
+    port = sock.getsockname()[1]
+    sock.close()
+    return pid, f"http://127.0.0.1:{port}"
+
+def start_standalone_dash(args):
+    sock = listen()
+
+    def run():
+        import logging
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        use_fake_provider(args)
+        import app_dash
+        host, port = sock.getsockname()
+        make_server(host, port, app_dash.create_dash_app().server, threaded=True, fd=sock.fileno()).serve_forever()
+
+    pid = fork(run)
+    port = sock.getsockname()[1]
+    sock.close()
+    return pid, f"http://127.0.0.1:{port}"
+
+def memory_mb(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields.get("Pss", 0) / 1024, fields.get("Rss", 0) / 1024
+
+async def wait_ready(url):
+    async with httpx.AsyncClient() as client:
+        for _ in range(400):
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"{url} did not start")
+
+# Body of the Dash streaming callback (update_streaming), built from the app's dependencies
+async def streaming_callback(client, dash_base):
+    dependencies = (await client.get(dash_base + "_dash-dependencies")).json()
+    output = next(d["output"] for d in dependencies if any(i["id"] == "streaming-interval" for i in d["inputs"]))
+    response_property = output.split("streaming-response.", 1)[1].split("...", 1)[0]
+    return {
+        "output": output,
+        "outputs": [
+            {"id": "streaming-response", "property": response_property},
+            {"id": "streaming-content", "property": "data"},
+        ],
+        "inputs": [{"id": "streaming-interval", "property": "n_intervals", "value": 1}],
+        "state": [
+            {"id": "streaming-response", "property": "data", "value": None},
+            {"id": "current-message-id", "property": "data", "value": 1},
+        ],
+        "changedPropIds": ["streaming-interval.n_intervals"],
+    }
+
+async def dash_message(client, dash_base, template, n):
+    stream_data = {
+        "user_message": f"chest pain {n}", "model_name": "gemini/gemini-2.0-flash", "system_prompt": "",
+        "message_id": n, "content": "", "status": "starting", "div_id": f"d{n}", "prompt_name": "prompt1",
+    }
+    body = json.loads(json.dumps(template))
+    started = time.perf_counter()
+    first_text = None
+    while True:
+        body["state"][0]["value"] = json.dumps(stream_data)
+        response = await client.post(dash_base + "_dash-update-component", json=body)
+        if response.status_code == 200:
+            data = response.json()["response"].get("streaming-response", {}).get("data")
+            if data:
+                stream_data = json.loads(data)
+        if first_text is None and stream_data["content"]:
+            first_text = time.perf_counter() - started
+        if stream_data["status"] == "complete":
+            return first_text
+        await asyncio.sleep(POLL_INTERVAL)
+
+async def page_message(client, fastapi_base, n):
+    payload = {"user_message": f"chest pain {n}", "model_name": "gemini/gemini-2.0-flash", "prompt_name": "prompt1"}
+    async with client.stream("POST", fastapi_base + "/chat/events", json=payload) as response:
+        async for _ in response.aiter_raw():
+            pass
+
+async def run_load(fastapi_base, dash_base, args):
+    limits = httpx.Limits(max_connections=args.dash_users + args.page_users + 10)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        template = await streaming_callback(client, dash_base)
+        finished = {"dash": 0, "page": 0}
+        first_texts = []
+
+        async def dash_user(user):
+            for n in range(args.messages):
+                first_texts.append(await dash_message(client, dash_base, template, user * 1000 + n))
+                finished["dash"] += 1
+
+        async def page_user(user):
+            for n in range(args.messages):
+                await page_message(client, fastapi_base, user * 1000 + n)
+                finished["page"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(dash_user(user) for user in range(args.dash_users)),
+            *(page_user(user) for user in range(args.page_users)),
+        )
+        wall = time.perf_counter() - started
+    first_texts = [seconds for seconds in first_texts if seconds is not None]
+    return finished, wall, sum(first_texts) / len(first_texts) if first_texts else None
+
+async def provider_calls(urls):
+    calls = 0
+    async with httpx.AsyncClient() as client:
+        for url in urls:
+            counters = (await client.get(url)).json().get("counters", {})
+            calls += sum(value for name, value in counters.items() if name.startswith("quota_requests"))
+    return calls
+
+def bench(mode, args):
+    if mode == "mounted":
+        pid, fastapi_base = start_fastapi(args, "/dash")
+        pids, dash_base = [pid], fastapi_base + "/dash/"
+        metrics_urls = [fastapi_base + "/metrics"]
+    else:
+        pid, fastapi_base = start_fastapi(args, "")
+        dash_pid, dash_root = start_standalone_dash(args)
+        pids, dash_base = [pid, dash_pid], dash_root + "/"
+        metrics_urls = [fastapi_base + "/metrics", dash_root + "/metrics"]
+    try:
+        asyncio.run(wait_ready(fastapi_base + "/metrics"))
+        asyncio.run(wait_ready(dash_base))
+        idle = [memory_mb(pid) for pid in pids]
+        finished, wall, first_text = asyncio.run(run_load(fastapi_base, dash_base, args))
+        loaded = [memory_mb(pid) for pid in pids]
+        calls = asyncio.run(provider_calls(metrics_urls))
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGINT)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+    page_calls = finished["page"]
+    dash_calls = (calls - page_calls) / finished["dash"] if finished["dash"] else 0
+    print(
+        f"  {mode:<9} {len(pids)} process(es)  idle PSS {sum(p for p, _ in idle):6.1f} MB"
+        f"  loaded PSS {sum(p for p, _ in loaded):6.1f} MB (RSS {sum(r for _, r in loaded):6.1f} MB)",
+        flush=True,
+    )
+    print(
+        f"            dash {finished['dash'] / wall:6.2f} msg/s  page {finished['page'] / wall:6.2f} msg/s"
+        f"  {wall:6.2f}s wall  {dash_calls:.1f} provider calls per dash message"
+        f"  first dash text after {first_text or 0:.2f}s",
+        flush=True,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Dash app mounted in FastAPI with a separate process")
+    parser.add_argument("--dash-users", type=int, default=20)
+    parser.add_argument("--page-users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per answer")
+    parser.add_argument("--token-ms", type=float, default=5, help="milliseconds between tokens")
+    parser.add_argument("--modes", nargs="+", default=["separate", "mounted"], choices=["separate", "mounted"])
+    args = parser.parse_args()
+
+    print(
+        f"{args.dash_users} dash + {args.page_users} page users x {args.messages} messages,"
+        f" {args.tokens} tokens every {args.token_ms:g} ms"
+    )
+    for mode in args.modes:
+        bench(mode, args)
+
+if __name__ == "__main__":
+    main()
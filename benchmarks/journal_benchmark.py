@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from journal import Journal
+
+# Journal throughput benchmark: appends/s (with and without fsync), cost of append()
+# on the request path, random lookup latency, history lookups, reopen and compaction.
+#
+#   python benchmarks/journal_benchmark.py --records 200000
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda fraction: samples[min(len(samples) - 1, int(fraction * len(samples)))]
+    return f"p50 {pick(0.50) * 1e6:8.1f} us   p99 {pick(0.99) * 1e6:8.1f} us"
+
+def run(args, fsync):
+    directory = tempfile.mkdtemp(prefix="journal-bench-", dir=args.dir)
+    conversations = [f"session-{n}" for n in range(args.conversations)]
+    text = "x" * args.payload
+    try:
+        journal = Journal(directory, segment_bytes=args.segment_bytes, fsync=fsync)
+        append_latency = []
+        started = time.perf_counter()
+        for n in range(args.records):
+            conversation_id = conversations[n % len(conversations)]
+            before = time.perf_counter()
+            journal.append("response" if n % 2 else "request", conversation_id, model="bench", content=text)
+            append_latency.append(time.perf_counter() - before)
+        journal.flush()
+        elapsed = time.perf_counter() - started
+        stats = journal.stats()
+        print(f"fsync={fsync}: {args.records} records in {elapsed:.2f}s = {args.records / elapsed:,.0f} appends/s"
+              f" ({stats['bytes'] / elapsed / 1e6:.1f} MB/s, {stats['segments']} segments)")
+        print(f"  append() call          {percentiles(append_latency)}")
+
+        seqs = [random.randint(1, args.records) for _ in range(args.lookups)]
+        latency = []
+        for seq in seqs:
+            before = time.perf_counter()
+            view = journal.read_view(seq)
+            latency.append(time.perf_counter() - before)
+            view.release()
+        print(f"  read_view (zero-copy)  {percentiles(latency)}")
+
+        latency = []
+        for seq in seqs:
+            before = time.perf_counter()
+            journal.read(seq)
+            latency.append(time.perf_counter() - before)
+        print(f"  read (decoded)         {percentiles(latency)}")
+
+        latency = []
+        for _ in range(args.lookups // 10):
+            conversation_id = random.choice(conversations)
+            before = time.perf_counter()
+            journal.history(conversation_id, limit=20)
+            latency.append(time.perf_counter() - before)
+        print(f"  history(limit=20)      {percentiles(latency)}")
+        journal.close()
+
+        before = time.perf_counter()
+        journal = Journal(directory, segment_bytes=args.segment_bytes, fsync=fsync)
+        print(f"  reopen                 {(time.perf_counter() - before) * 1e3:.1f} ms")
+
+        for conversation_id in conversations[: len(conversations) // 10]:
+            journal.forget(conversation_id)
+        journal.flush()
+        before_bytes = journal.stats()["bytes"]
+        before = time.perf_counter()
+        journal.maintain()
+        journal.append("request", "after-compaction")
+        journal.flush()
+        stats = journal.stats()
+        print(f"  compaction (forget 10%) {(time.perf_counter() - before) * 1e3:.1f} ms,"
+              f" {before_bytes / 1e6:.1f} MB -> {stats['bytes'] / 1e6:.1f} MB, {stats['segments']} segments")
+        journal.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversation journal")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--conversations", type=int, default=2000)
+    parser.add_argument("--payload", type=int, default=1000, help="bytes of content per record")
+    parser.add_argument("--segment-bytes", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--dir", default=None, help="directory for the temporary journal (default: system temp)")
+    args = parser.parse_args()
+
+    for fsync in (True, False):
+        run(args, fsync)
+
+if __name__ == "__main__":
+    main()
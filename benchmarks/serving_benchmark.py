@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+import types
+
+os.environ.setdefault("JOURNAL", "0")
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+import httpx  # noqa: E402
+
+import serve  # noqa: E402
+
+# CPU cost per streamed token of the serving profiles (serve.py --profile).
+#
+# For each profile a one-worker server is forked with a fake completion that
+# streams --tokens tokens per answer without network or provider latency, then
+# --requests requests are streamed through it with --concurrency clients. The
+# worker's CPU time (user + system, from /proc) is divided by the tokens
+# delivered. Responses are requested uncompressed unless --compress is given.
+#
+#   python benchmarks/serving_benchmark.py --requests 200 --concurrency 50
+
+# Streamed answer text (markdown with sections, a list and a table), cycled per token
+SAMPLE = (
+    "### Most Likely\n1. **Acute coronary syndrome** - chest pain radiating to the left arm\n"
+    "2. **Stable angina**: exertional pain relieved by rest\n\n### Can't Miss\n- Aortic dissection\n"
+    "- Pulmonary embolism\n\n| Diagnosis | Key features | Next step |\n|---|---|---|\n"
+    "| ACS | ST changes, troponin | Aspirin, cath lab |\n| PE | Hypoxia, tachycardia | CT angiography |\n\n"
+)
+TOKENS = [token + " " for token in SAMPLE.replace("\n", " \n").split(" ") if token]
+
+ENDPOINTS = {
+    "stream-markdown": ("GET", "/stream", {"render": "markdown"}),
+    "stream-structured": ("GET", "/stream", {"render": "markdown", "structured": "true"}),
+    "chat-events-ndjson": ("POST", "/chat/events", {}),
+}
+
+def fake_completion(tokens):
+    def completion(model, messages, stream=True, **kwargs):
+        for n in range(tokens):
+            delta = types.SimpleNamespace(content=TOKENS[n % len(TOKENS)])
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+    return completion
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def start_server(profile, tokens):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(2048)
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            server_settings = serve.apply_profile(profile)
+            import app
+            app.completion = fake_completion(tokens)
+            args = serve.parse_args(["--log-level", "warning"])
+            serve.run_worker(sock, app.app, args, time.perf_counter(), server_settings)
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    port = sock.getsockname()[1]
+    sock.close()
+    return pid, port
+
+async def wait_ready(base):
+    async with httpx.AsyncClient() as client:
+        for _ in range(200):
+            try:
+                await client.get(base + "/metrics")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+async def run_requests(base, endpoint, requests, concurrency, compress):
+    method, path, params = ENDPOINTS[endpoint]
+    headers = {} if compress else {"Accept-Encoding": "identity"}
+    query = {"user_message": "chest pain", "model_name": "bench", "prompt_name": "prompt1", **params}
+    semaphore = asyncio.Semaphore(concurrency)
+    received = 0
+
+    async def one(client):
+        nonlocal received
+        async with semaphore:
+            if method == "GET":
+                request = client.build_request("GET", base + path, params=query, headers=headers)
+            else:
+                request = client.build_request("POST", base + path, json=query, headers=headers)
+            response = await client.send(request, stream=True)
+            async for chunk in response.aiter_raw():
+                received += len(chunk)
+            await response.aclose()
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        await asyncio.gather(*(one(client) for _ in range(requests)))
+    return received
+
+def bench(profile, args):
+    pid, port = start_server(profile, args.tokens)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        asyncio.run(wait_ready(base))
+        for endpoint in args.endpoints:
+            asyncio.run(run_requests(base, endpoint, min(args.requests, 10), args.concurrency, args.compress))
+            cpu_before = cpu_seconds(pid)
+            started = time.perf_counter()
+            received = asyncio.run(run_requests(base, endpoint, args.requests, args.concurrency, args.compress))
+            wall = time.perf_counter() - started
+            cpu = cpu_seconds(pid) - cpu_before
+            tokens = args.requests * args.tokens
+            print(
+                f"  {profile:<8} {endpoint:<20} {cpu:7.2f}s CPU  {cpu / tokens * 1e6:7.1f} us/token"
+                f"  {wall:6.2f}s wall  {received / 1e6:7.1f} MB",
+                flush=True,
+            )
+    finally:
+        os.kill(pid, signal.SIGINT)
+        os.waitpid(pid, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU per streamed token of the serving profiles")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=400, help="tokens per streamed answer")
+    parser.add_argument("--profiles", nargs="+", default=["default", "fast"], choices=sorted(serve.PROFILES))
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=list(ENDPOINTS))
+    parser.add_argument("--compress", action="store_true", help="let responses be compressed (Accept-Encoding)")
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests x {args.tokens} tokens, {args.concurrency} concurrent")
+    for profile in args.profiles:
+        bench(profile, args)
+
+if __name__ == "__main__":
+    main()
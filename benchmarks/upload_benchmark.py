@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("JOURNAL", "0")
+os.environ.setdefault("LEDGER", "0")
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+import httpx  # noqa: E402
+
+import serve  # noqa: E402
+
+# Memory and throughput of streaming lab-result uploads (POST /uploads, see uploads.py).
+#
+# A lab CSV of about --size-mb MB is generated on disk, then uploaded --uploads
+# times (--concurrency at once) to a forked one-worker server, as multipart
+# form data or, with --raw, as the raw body. The worker's peak resident memory
+# (VmHWM, reset before the uploads) is reported next to its idle memory, and
+# compared with reading the whole file into a DataFrame in a forked child (the
+# naive approach the streaming digest replaces).
+#
+#   python benchmarks/upload_benchmark.py --size-mb 100
+
+# (test, unit, low, high, typical value, spread)
+TESTS = [
+    ("Hemoglobin", "g/dL", 12.0, 17.5, 14.0, 2.0),
+    ("WBC", "10^3/uL", 4.0, 11.0, 7.0, 2.5),
+    ("Platelets", "10^3/uL", 150, 400, 260, 70),
+    ("Sodium", "mmol/L", 135, 145, 140, 3),
+    ("Potassium", "mmol/L", 3.5, 5.1, 4.2, 0.4),
+    ("Creatinine", "mg/dL", 0.6, 1.3, 0.9, 0.25),
+    ("Glucose", "mg/dL", 70, 99, 92, 15),
+    ("ALT", "U/L", 7, 56, 30, 15),
+    ("Troponin I", "ng/mL", 0.0, 0.04, 0.01, 0.01),
+    ("CRP", "mg/L", 0.0, 10.0, 4.0, 4.0),
+]
+
+def write_lab_csv(path, size_bytes, seed=7):
+    rng = random.Random(seed)
+    rows = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("patient_id,collected,test,result,units,reference_range,flag\n")
+        while f.tell() < size_bytes:
+            lines = []
+            for _ in range(1000):
+                test, unit, low, high, typical, spread = TESTS[rng.randrange(len(TESTS))]
+                value = max(0.0, rng.gauss(typical, spread))
+                flag = "H" if value > high else "L" if value < low else ""
+                lines.append(
+                    f"P{rng.randrange(100000):05d},2026-0{rng.randint(1, 9)}-{rng.randint(10, 28)},"
+                    f"{test},{value:.2f},{unit},{low}-{high},{flag}\n"
+                )
+            f.writelines(lines)
+            rows += len(lines)
+    return rows
+
+def memory_kb(pid, field):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+# Reset the peak resident memory (VmHWM) of a process to its current size
+def reset_peak(pid):
+    with open(f"/proc/{pid}/clear_refs", "w") as f:
+        f.write("5")
+
+def start_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            server_settings = serve.apply_profile("default")
+            import app
+            args = serve.parse_args(["--log-level", "warning"])
+            serve.run_worker(sock, app.app, args, time.perf_counter(), server_settings)
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    port = sock.getsockname()[1]
+    sock.close()
+    return pid, port
+
+async def wait_ready(base):
+    async with httpx.AsyncClient() as client:
+        for _ in range(200):
+            try:
+                await client.get(base + "/metrics")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+async def file_chunks(path, chunk_size=256 * 1024):
+    with open(path, "rb") as f:
+        while True:
+            data = await asyncio.to_thread(f.read, chunk_size)
+            if not data:
+                return
+            yield data
+
+async def upload(client, base, path, raw):
+    name = os.path.basename(path)
+    if raw:
+        response = await client.post(
+            base + "/uploads", params={"filename": name}, content=file_chunks(path),
+            headers={"Content-Type": "text/csv"},
+        )
+    else:
+        with open(path, "rb") as f:
+            response = await client.post(base + "/uploads", files={"file": (name, f, "text/csv")})
+    response.raise_for_status()
+    return response.json()
+
+async def run_uploads(base, path, uploads, concurrency, raw):
+    semaphore = asyncio.Semaphore(concurrency)
+    records = []
+
+    async def one(client):
+        async with semaphore:
+            records.append(await upload(client, base, path, raw))
+
+    async with httpx.AsyncClient(timeout=600) as client:
+        await asyncio.gather(*(one(client) for _ in range(uploads)))
+    return records
+
+# Peak memory of reading the whole file into a DataFrame, in a forked child
+def naive_peak_kb(path):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            os.close(read_fd)
+            import pandas as pd
+            before = memory_kb("self", "VmRSS")
+            reset_peak("self")
+            frame = pd.read_csv(path, dtype=str)
+            flagged = frame[frame["flag"].fillna("") != ""]
+            flagged.groupby("test").size()
+            os.write(write_fd, f"{before} {memory_kb('self', 'VmHWM')}".encode())
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    before, peak = map(int, result.split())
+    return before, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory and throughput of streaming uploads")
+    parser.add_argument("--size-mb", type=float, default=100)
+    parser.add_argument("--uploads", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--raw", action="store_true", help="upload the raw file instead of multipart form data")
+    parser.add_argument("--skip-naive", action="store_true", help="skip the read-everything comparison")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "labs.csv")
+        rows = write_lab_csv(path, int(args.size_mb * 1e6))
+        size = os.path.getsize(path)
+        print(f"{size / 1e6:.1f} MB lab CSV, {rows} rows; {args.uploads} uploads, {args.concurrency} at once,"
+              f" {'raw body' if args.raw else 'multipart'}")
+
+        pid, port = start_server()
+        base = f"http://127.0.0.1:{port}"
+        try:
+            asyncio.run(wait_ready(base))
+            # Warm-up (imports pandas in the worker)
+            asyncio.run(run_uploads(base, path, 1, 1, args.raw))
+            idle = memory_kb(pid, "VmRSS")
+            reset_peak(pid)
+            started = time.perf_counter()
+            records = asyncio.run(run_uploads(base, path, args.uploads, args.concurrency, args.raw))
+            wall = time.perf_counter() - started
+            peak = memory_kb(pid, "VmHWM")
+        finally:
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+
+        record = records[0]
+        print(f"  streaming digest: worker {idle / 1024:6.1f} MB idle, {peak / 1024:6.1f} MB peak"
+              f" (+{(peak - idle) / 1024:.1f} MB)  {size * args.uploads / 1e6 / wall:6.1f} MB/s")
+        print(f"  digest: {record['rows']} rows, {record['abnormal_rows']} abnormal in {record['abnormal_tests']} tests, {len(record['text'])} chars attached")
+        if not args.skip_naive:
+            before, naive = naive_peak_kb(path)
+            print(f"  read_csv whole file: {before / 1024:6.1f} MB before, {naive / 1024:6.1f} MB peak"
+                  f" (+{(naive - before) / 1024:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
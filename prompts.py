@@ -17,4 +17,14 @@ You are an expert medical AI diagnostician assisting a human physician.
 Look-up any relevant information requested, providing citations.
 
 '''
-)
\ No newline at end of file
+)
+
+# Prompt ids used by the UIs, mapped to their system prompts
+PROMPTS = {
+    "prompt1": prompt1,
+    "prompt2": prompt2,
+}
+
+# Select the system prompt for a prompt id (defaults to prompt1 if something goes wrong)
+def select_system_prompt(prompt_name):
+    return PROMPTS.get(prompt_name, prompt1)
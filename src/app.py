@@ -1,62 +1,106 @@
+import hmac
+import importlib.util
 import os
 import sys
 import json
 import asyncio
+import time
+from datetime import datetime, timezone
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, APIRouter, Request, Form, Depends, HTTPException, WebSocket, Query, Header
+from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from litellm import completion
 import uvicorn
 
 # Add the parent directory to sys.path to import prompts.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from prompts import prompt1, prompt2  # Import prompts from prompts.py
+# Add this directory to sys.path so sibling modules import when run as src.app
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prompts import PROMPTS, prompt1, prompt2, select_system_prompt  # Import prompts from prompts.py
+from providers import DEFAULT_MODELS, completion  # Lazy litellm.completion (imported on first use)
+from static_assets import AssetRegistry, StaticAsset, REVALIDATE_CACHE_CONTROL
+from compression import StreamingCompressionMiddleware
+from markdown_stream import IncrementalMarkdownRenderer
+from ddx_parser import DifferentialParser, parse_differential
+from prewarm import Prewarmer, TTFTTimer
+from engine import interruptible_events, stream_deltas
+from ws_chat import ChatSocket
+from jobs import JobRegistry, spool_events, spool_path, read_spool, is_valid_job_id
+from message_store import MessageStore
+from drain import Draining, GenerationInterrupted
+from condense import condenser
+from uploads import UploadError, UploadTooLarge, UnsupportedUpload
+import drain
+import compression
+import dash_mount
+import journal
+import ledger
+import metrics
+import quota
+import shadow
+import sse
+import uploads
 
 # Load API keys from environment variables
 load_dotenv()
 # litellm automatically reads environment variables like GEMINI_API_KEY and ANTHROPIC_API_KEY
 
-# Create FastAPI app
-app = FastAPI(title="Medical AI Assistant")
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Set up templates and static files
 # Use absolute paths for templates and static files
 base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 templates_dir = os.path.join(base_dir, "templates")
 assets_dir = os.path.join(base_dir, "assets")
 
-templates = Jinja2Templates(directory=templates_dir)
-app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
-
 # Create templates directory if it doesn't exist
 os.makedirs(templates_dir, exist_ok=True)
 
-# Define models
-class Message(BaseModel):
-    role: str
-    content: str
+templates = Jinja2Templates(directory=templates_dir)
 
+# Path the Dash app is served at inside this app (see dash_mount.py); empty to not mount it
+DASH_MOUNT_PATH = os.environ.get("DASH_MOUNT_PATH", "/dash")
+
+# Bearer token of the operator endpoints (GET /shadow); unset disables them
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Routes are registered on a router so create_app() can build fresh app instances
+router = APIRouter()
+
+# Dependency of the operator endpoints: requires "Authorization: Bearer <ADMIN_TOKEN>"
+def require_admin(authorization: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+# Define models
 class ChatRequest(BaseModel):
     user_message: str
     model_name: str
     prompt_name: str
+    session_id: Optional[str] = None
+    # Also return the differential parsed into sections, diagnoses, table rows and next step
+    structured: bool = False
+    # Upload ids (POST /uploads) whose digests are sent along with the message
+    attachments: List[str] = []
 
-# In-memory chat history (in a real app, this would be stored in a database)
-chat_history: Dict[str, List[Message]] = {}
+class GenerationRequest(BaseModel):
+    user_message: str
+    model_name: str
+    prompt_name: str
+    session_id: Optional[str] = None
+    attachments: List[str] = []
+
+class WarmRequest(BaseModel):
+    session_id: str
+    model_name: str
+    prompt_name: str
+
+# In-memory chat history per session, bounded by a memory budget (see message_store.py)
+message_store = MessageStore()
 
 # Template generation is now disabled to use the manually edited template file
 # This prevents overwriting our custom changes to the template
@@ -65,142 +109,285 @@ chat_history: Dict[str, List[Message]] = {}
 #     # Template generation code removed to prevent overwriting custom template
 #     pass
 
+# Render the index page once; it has no per-request variables
+def render_index(assets: AssetRegistry) -> StaticAsset:
+    html = templates.get_template("index.html").render(asset_url=assets.url)
+    return StaticAsset.from_bytes(html.encode("utf-8"), "text/html; charset=utf-8")
+
 # Define routes
-@app.get("/", response_class=HTMLResponse)
+# The index page is pre-rendered at startup and served from memory (it is also the health check target)
+@router.api_route("/", methods=["GET", "HEAD"], response_class=HTMLResponse)
 async def get_html(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return request.app.state.index_page.response(request, REVALIDATE_CACHE_CONTROL)
+
+# Fingerprinted, precompressed assets (see static_assets.py)
+@router.api_route("/assets/{name}", methods=["GET", "HEAD"])
+async def get_asset(request: Request, name: str):
+    response = request.app.state.assets.response(request, name)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return response
+
+# Warm-up call for the typing signal: a 1-token completion through the same streaming
+# path as the real request, so it reuses the same provider client and sends the same prompt prefix
+def warm_provider(model_name: str, prompt_name: str):
+    messages = [
+        {"role": "system", "content": select_system_prompt(prompt_name)},
+        {"role": "user", "content": "."}
+    ]
+    usage_labels = {"frontend": "fastapi", "prompt": prompt_name, "kind": "warmup"}
+    for _ in completion(model=model_name, messages=messages, stream=True, max_tokens=1, usage_labels=usage_labels):
+        pass
+
+# Shared pre-warmer (idempotent, rate-limited per session and process, offered models
+# and prompts only; see prewarm.py)
+prewarmer = Prewarmer(warm_provider, DEFAULT_MODELS, PROMPTS)
+
+# "Typing started" signal from the chat input: pre-warm the selected model and prompt
+@router.post("/warm")
+async def warm(request: WarmRequest):
+    status = prewarmer.request(request.session_id, request.model_name, request.prompt_name)
+    if status == "rejected":
+        raise HTTPException(status_code=422, detail="Unknown model or prompt")
+    return {"status": status}
+
+# New generations are refused while the worker drains for shutdown (see drain.py);
+# clients retry, reaching another worker or the new deployment
+def reject_if_draining():
+    if drain.controller.draining:
+        raise HTTPException(status_code=503, detail=str(Draining()), headers={"Retry-After": "1"})
+
+# Helper function to stream content deltas; the blocking litellm stream runs in a
+# worker thread (see engine.py), so concurrent generations don't stall the event loop.
+# Oversized messages are condensed first (see condense.py); with progress=True the
+# condensing progress events (dicts) are yielded before the text deltas.
+# The digests of attached uploads (see uploads.py) are sent after the message.
+# frontend labels the journal, metrics and usage ("dash" for the mounted Dash app).
+async def generate_deltas(
+    user_message: str, model_name: str, prompt_name: str, session_id: Optional[str] = None, progress: bool = False,
+    attachments: Optional[List[str]] = None, frontend: str = "fastapi",
+):
+    # Select the prompt based on the dropdown
+    system_prompt = select_system_prompt(prompt_name)
+    model_message = user_message
+    if attachments:
+        model_message = await asyncio.to_thread(uploads.attach, user_message, attachments)
+    
+    # Prepare messages for the API call
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": model_message}
+    ]
+    
+    # Registered for graceful drain on shutdown (raises Draining once it has started)
+    inflight = drain.controller.register(frontend, model_name)
+    ttft = TTFTTimer(model_name, prewarmer.is_warm(session_id, model_name, prompt_name), frontend=frontend)
+    # Journal the exchange (queued; written off the request path, see journal.py)
+    request_seq = journal.record(
+        "request", session_id, frontend=frontend, model=model_name, prompt=prompt_name, message=user_message,
+        attachments=attachments or None,
+    )
+    if session_id:
+        message_store.append(session_id, "user", user_message)
+    started = time.perf_counter()
+    content = ""
+    status, error = "complete", None
+    usage_labels = {"frontend": frontend, "prompt": prompt_name}
+    try:
+        if condenser.needs_condensing(model_message, model_name):
+            # Interruptible too: a generation still condensing at the drain deadline is cut off here
+            condensing = condenser.condense_async(model_message, model_name, usage_labels)
+            async for event in interruptible_events(condensing, inflight):
+                if event["stage"] == "done":
+                    messages[1]["content"] = event.pop("text")
+                if progress:
+                    yield event
+        async for delta in stream_deltas(
+            model_name, messages, completion_func=completion, interruptible=inflight, usage_labels=usage_labels
+        ):
+            ttft.token()
+            content += delta
+            yield delta
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    except GenerationInterrupted as e:
+        # Cut off by a shutdown: the partial content is journaled below and handed to the caller
+        status, error = "interrupted", str(e)
+        e.content = content
+        raise
+    except Exception as e:
+        status, error = "error", str(e)
+        raise
+    finally:
+        drain.controller.unregister(inflight)
+        journal.record(
+            "response", session_id, frontend=frontend, request_seq=request_seq, model=model_name, status=status,
+            error=error, content=content, duration=time.perf_counter() - started,
+        )
+        if session_id and content:
+            message_store.append(session_id, "assistant", content, prompt=prompt_name)
 
 # Helper function to generate response content (streaming version)
-async def generate_response_stream(user_message: str, model_name: str, prompt_name: str):
+async def generate_response_stream(
+    user_message: str, model_name: str, prompt_name: str, session_id: Optional[str] = None, progress: bool = False,
+    attachments: Optional[List[str]] = None,
+):
     try:
-        # Select the prompt based on the dropdown
-        system_prompt = ""
-        if prompt_name == "prompt1":
-            system_prompt = prompt1
-        elif prompt_name == "prompt2":
-            system_prompt = prompt2
-        else:
-            system_prompt = prompt1  # Default to prompt1 if something goes wrong
-        
-        # Prepare messages for the API call
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
         # Initialize response content
         content = ""
         
-        # Start streaming response
-        response_stream = completion(
-            model=model_name,
-            messages=messages,
-            stream=True  # Enable streaming
-        )
-        
         # Process the stream
-        for chunk in response_stream:
-            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                # Extract delta content from the chunk
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    content += delta.content
-                    
-                    # For streaming, yield the content
-                    yield content
+        async for delta in generate_deltas(user_message, model_name, prompt_name, session_id, progress, attachments):
+            if isinstance(delta, dict):
+                # Condensing progress (progress=True), passed through as is
+                yield delta
+                continue
+            content += delta
+            
+            # For streaming, yield the content
+            yield content
         
+    except GenerationInterrupted:
+        # Handled by the caller, which still holds the partial content
+        raise
     except Exception as e:
         # Yield error message
         error_msg = f"Error: {str(e)}"
         yield error_msg
 
 # Helper function to generate complete response (non-streaming version)
-async def generate_complete_response(user_message: str, model_name: str, prompt_name: str):
+async def generate_complete_response(
+    user_message: str, model_name: str, prompt_name: str, session_id: Optional[str] = None,
+    attachments: Optional[List[str]] = None,
+):
     try:
-        # Select the prompt based on the dropdown
-        system_prompt = ""
-        if prompt_name == "prompt1":
-            system_prompt = prompt1
-        elif prompt_name == "prompt2":
-            system_prompt = prompt2
-        else:
-            system_prompt = prompt1  # Default to prompt1 if something goes wrong
-        
-        # Prepare messages for the API call
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
         # Initialize response content
         content = ""
         
-        # Start streaming response (but collect the full response)
-        response_stream = completion(
-            model=model_name,
-            messages=messages,
-            stream=True  # Enable streaming
-        )
-        
         # Process the stream to get the complete response
-        for chunk in response_stream:
-            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                # Extract delta content from the chunk
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    content += delta.content
+        async for delta in generate_deltas(user_message, model_name, prompt_name, session_id, attachments=attachments):
+            content += delta
         
         # Return the final content
         return content
         
+    except GenerationInterrupted:
+        raise
     except Exception as e:
         # Return error message
         error_msg = f"Error: {str(e)}"
         return error_msg
 
 # Main chat endpoint (non-streaming, works in all browsers)
-@app.post("/chat")
+@router.post("/chat")
 async def chat(request: ChatRequest):
+    reject_if_draining()
     try:
         # Generate the complete response (non-streaming)
         content = await generate_complete_response(
             request.user_message, 
             request.model_name, 
-            request.prompt_name
+            request.prompt_name,
+            request.session_id,
+            request.attachments,
         )
         
         # Return the complete response as JSON
-        return {"content": content, "status": "complete"}
+        response = {"content": content, "status": "complete"}
+        if request.structured:
+            response["result"] = parse_differential(content)
+        return response
+    except GenerationInterrupted as e:
+        # Cut off by a shutdown: return what was generated so far
+        response = {"content": e.content, "status": "interrupted", "error": str(e)}
+        if request.structured:
+            response["result"] = parse_differential(e.content)
+        return response
     except Exception as e:
         return {"content": f"Error: {str(e)}", "status": "error"}
 
+# Typed SSE event for a structured differential event (see ddx_parser.py)
+def structured_sse(event):
+    return sse.frame(event, event["type"])
+
 # SSE endpoint for streaming responses (used by Chrome and other browsers)
-@app.get("/stream")
+# With render=markdown, the answer is sent as incremental HTML in "markdown" events
+# (see markdown_stream.py) instead of the full content on every event.
+# With structured=true, typed events (section, diagnosis, table_row, step, next_step)
+# are sent as soon as the differential's lines arrive, and a final "result" event.
+# Condensing an oversized message sends "progress" events first (see condense.py).
+@router.get("/stream")
 async def stream_response(
     user_message: str,
     model_name: str,
-    prompt_name: str
+    prompt_name: str,
+    render: str = "text",
+    session_id: Optional[str] = None,
+    structured: bool = False,
+    attachments: List[str] = Query([]),
 ):
+    reject_if_draining()
+
     # For browsers that support SSE, use streaming
     async def event_generator():
         try:
             last_content = None
-            async for content in generate_response_stream(user_message, model_name, prompt_name):
-                last_content = content
-                # Send the current content as an SSE event
-                yield f"data: {json.dumps({'content': content, 'status': 'streaming'})}\n\n"
+            renderer = IncrementalMarkdownRenderer() if render == "markdown" else None
+            parser = DifferentialParser() if structured else None
+            async for content in generate_response_stream(
+                user_message, model_name, prompt_name, session_id, progress=True, attachments=attachments
+            ):
+                if isinstance(content, dict):
+                    yield sse.frame(content, "progress")
+                    continue
+                if parser is not None and content.startswith(last_content or ""):
+                    for event in parser.feed(content[len(last_content or ""):]):
+                        yield structured_sse(event)
+                if renderer is not None:
+                    if last_content and content.startswith(last_content):
+                        frame = renderer.feed(content[len(last_content):])
+                    else:
+                        # First chunk, or the content was replaced (error message): start over
+                        renderer = IncrementalMarkdownRenderer()
+                        frame = renderer.feed(content)
+                    last_content = content
+                    if frame:
+                        yield sse.frame(frame, "markdown")
+                else:
+                    last_content = content
+                    # Send the current content as an SSE event
+                    yield sse.frame({"content": content, "status": "streaming"})
                 
                 # Add a small delay to control the stream rate
                 await asyncio.sleep(0.01)
             
+            # Finish the open markdown block
+            if renderer is not None:
+                yield sse.frame(renderer.close(), "markdown")
+
+            if parser is not None:
+                for event in parser.close():
+                    yield structured_sse(event)
+                yield structured_sse({"type": "result", "status": "complete", "result": parser.result()})
+
             # Send a final event to indicate completion
             if last_content:
-                yield f"data: {json.dumps({'content': last_content, 'status': 'complete'})}\n\n"
+                yield sse.frame({"content": last_content, "status": "complete"})
             
+        except GenerationInterrupted as e:
+            # Cut off by a shutdown: close the markdown and send the partial content
+            if renderer is not None:
+                yield sse.frame(renderer.close(), "markdown")
+            if parser is not None:
+                for event in parser.close():
+                    yield structured_sse(event)
+                yield structured_sse({"type": "result", "status": "interrupted", "result": parser.result()})
+            yield sse.frame({"content": e.content, "status": "interrupted", "error": str(e)})
         except Exception as e:
             # Send error message
             error_msg = f"Error: {str(e)}"
-            yield f"data: {json.dumps({'content': error_msg, 'status': 'complete'})}\n\n"
+            yield sse.frame({"content": error_msg, "status": "complete"})
     
     return StreamingResponse(
         event_generator(),
@@ -212,7 +399,280 @@ async def stream_response(
         }
     )
 
-# Run the app
+# Structured differential as NDJSON: one typed event per line while the answer streams
+# (same events as /stream?structured=true, after any "condense" progress events),
+# then {"type": "result", "status", "result"}
+@router.post("/chat/events")
+async def chat_events(request: ChatRequest):
+    reject_if_draining()
+
+    async def event_lines():
+        parser = DifferentialParser()
+        status, error = "complete", None
+        try:
+            async for delta in generate_deltas(
+                request.user_message, request.model_name, request.prompt_name, request.session_id, progress=True,
+                attachments=request.attachments,
+            ):
+                if isinstance(delta, dict):
+                    # Condensing progress of an oversized message
+                    yield sse.ndjson_line(delta)
+                    continue
+                for event in parser.feed(delta):
+                    yield sse.ndjson_line(event)
+        except GenerationInterrupted as e:
+            status, error = "interrupted", str(e)
+        except Exception as e:
+            status, error = "error", f"Error: {str(e)}"
+        for event in parser.close():
+            yield sse.ndjson_line(event)
+        yield sse.ndjson_line({"type": "result", "status": status, "error": error, "result": parser.result()})
+
+    return StreamingResponse(
+        event_lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Multiplexed WebSocket chat transport: many concurrent messages over one connection,
+# with delta frames, per-message cancellation and flow control (see ws_chat.py)
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket, session_id: Optional[str] = None):
+    await ChatSocket(websocket, generate_deltas, session_id).run()
+
+# Uploads parsed at once on this worker
+upload_slots = asyncio.Semaphore(uploads.MAX_CONCURRENT)
+
+# Background generation jobs (see jobs.py)
+generation_jobs = JobRegistry(generate_deltas)
+
+# Two-phase streaming, step 1: start a generation that runs independently of the client
+# (the message goes in the request body, not the URL)
+@router.post("/generations", status_code=202)
+async def create_generation(request: GenerationRequest):
+    reject_if_draining()
+    job = generation_jobs.create(request.model_dump())
+    if job is None:
+        raise HTTPException(status_code=503, detail="Too many generations in progress")
+    return {"id": job.id, "status": job.status, "events_url": f"/generations/{job.id}/events"}
+
+# Status and content so far of a generation
+@router.get("/generations/{job_id}")
+async def get_generation(job_id: str):
+    job = generation_jobs.get(job_id)
+    if job is not None:
+        summary = job.summary()
+    else:
+        summary = await asyncio.to_thread(read_spool, job_id) if is_valid_job_id(job_id) else None
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return summary
+
+# Cancel a running generation (owning worker only)
+@router.delete("/generations/{job_id}")
+async def cancel_generation(job_id: str):
+    if not generation_jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="No running generation with this id on this worker")
+    return {"id": job_id, "status": "cancelling"}
+
+# Two-phase streaming, step 2: SSE with event ids. A reconnecting client (EventSource sends
+# Last-Event-ID automatically) resumes after its last event; nothing is re-requested upstream.
+# Condensing an oversized message sends "progress" events (without ids) first.
+@router.get("/generations/{job_id}/events")
+async def generation_events(request: Request, job_id: str, render: str = "text", last_event_id: Optional[int] = None):
+    if last_event_id is None:
+        header = request.headers.get("last-event-id", "")
+        last_event_id = int(header) if header.isdigit() else 0
+
+    job = generation_jobs.get(job_id)
+    if job is None and not (is_valid_job_id(job_id) and await asyncio.to_thread(os.path.exists, spool_path(job_id))):
+        raise HTTPException(status_code=404, detail="Generation not found")
+
+    markdown = render == "markdown"
+    # Markdown needs the text before the resume point too, to re-render the open block
+    start = 0 if markdown else last_event_id
+    source = job.events(start) if job is not None else spool_events(job_id, start)
+
+    async def event_generator():
+        yield b"retry: 1000\n\n"
+        renderer = None
+        # Markdown mode: text the client already has. The first frame of this connection
+        # re-renders from block 0, so a resumed page replaces whatever it showed before.
+        replay, replay_id = "", 0
+        async for kind, event_id, payload in source:
+            if kind == "progress":
+                # An oversized message is being condensed before the answer starts
+                yield sse.frame(payload, "progress")
+                continue
+            if markdown and kind == "delta" and event_id <= last_event_id:
+                replay, replay_id = replay + payload, event_id
+                continue
+            if kind == "done":
+                if markdown and renderer is None and replay:
+                    renderer = IncrementalMarkdownRenderer()
+                    yield sse.frame({"content": replay, "markdown": renderer.feed(replay)}, "snapshot", replay_id)
+                done = {"status": event_id, "error": payload}
+                if renderer is not None:
+                    done["markdown"] = renderer.close()
+                yield sse.frame(done, "done")
+                return
+            data = {"text": payload} if kind == "delta" else {"content": payload}
+            if markdown:
+                if renderer is None or kind == "snapshot":
+                    renderer = IncrementalMarkdownRenderer()
+                    frame = renderer.feed(replay + payload if kind == "delta" else payload)
+                else:
+                    frame = renderer.feed(payload)
+                if frame:
+                    data["markdown"] = frame
+            yield sse.frame(data, kind, event_id)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Helps with certain proxy servers
+        }
+    )
+
+# Attach a lab CSV or text report: the body (multipart/form-data, or the raw file with
+# ?filename=) is parsed as it streams in and reduced to a digest of abnormal values,
+# which the next message can attach by id (attachments=[id]; see uploads.py)
+@router.post("/uploads", status_code=201)
+async def create_upload(request: Request, filename: Optional[str] = None):
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > uploads.MAX_BYTES:
+        raise HTTPException(status_code=413, detail=str(UploadTooLarge(uploads.MAX_BYTES)))
+    if upload_slots.locked():
+        raise HTTPException(status_code=503, detail="Too many uploads in progress", headers={"Retry-After": "1"})
+    async with upload_slots:
+        try:
+            digest = await uploads.ingest(
+                request.stream(), request.headers.get("content-type"), filename or request.headers.get("x-filename")
+            )
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except UnsupportedUpload as e:
+            raise HTTPException(status_code=415, detail=str(e))
+        except UploadError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return await asyncio.to_thread(uploads.save, digest)
+
+# Digest of an upload (for showing what will be attached)
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    record = await asyncio.to_thread(uploads.load, upload_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Upload not found or expired")
+    return record
+
+# Ledger query window and grouping from the /usage query parameters (naive datetimes are UTC)
+def usage_query(since, until, group_by, **filters):
+    def epoch(value):
+        if value is None:
+            return None
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+    fields = tuple(field.strip() for field in group_by.split(",") if field.strip())
+    try:
+        return ledger.query(epoch(since), epoch(until), fields, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Token usage and cost from every frontend, summed per group (e.g. group_by=day,model).
+# Served from the ledger's hourly aggregates (all workers and apps), never raw records;
+# plain def routes, so the summary file reads run in the threadpool
+@router.get("/usage")
+def get_usage(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: str = "model",
+    model: Optional[str] = None,
+    prompt: Optional[str] = None,
+    frontend: Optional[str] = None,
+    kind: Optional[str] = None,
+):
+    return usage_query(since, until, group_by, model=model, prompt=prompt, frontend=frontend, kind=kind)
+
+# The same usage rows as a CSV download
+@router.get("/usage.csv")
+def get_usage_csv(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: str = "hour,model,prompt,frontend",
+    model: Optional[str] = None,
+    prompt: Optional[str] = None,
+    frontend: Optional[str] = None,
+    kind: Optional[str] = None,
+):
+    import pandas as pd  # Heavy; only needed for exports
+
+    usage = usage_query(since, until, group_by, model=model, prompt=prompt, frontend=frontend, kind=kind)
+    columns = usage["group_by"] + list(usage["totals"])
+    csv = pd.DataFrame(usage["rows"], columns=columns).to_csv(index=False)
+    return Response(
+        csv, media_type="text/csv", headers={"Content-Disposition": 'attachment; filename="usage.csv"'}
+    )
+
+# Side-by-side comparison of the shadow candidates with the live model (see shadow.py):
+# per-model TTFT, duration and token summaries plus the latest comparisons (metrics and
+# hashes, no text). Needs the admin token. A plain def route, so reading the
+# comparison files runs in the threadpool
+@router.get("/shadow", dependencies=[Depends(require_admin)])
+def get_shadow(since: Optional[datetime] = None, recent: int = 20, model: Optional[str] = None):
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return shadow.shadow.report(since.timestamp() if since else None, max(0, recent), model)
+
+# Per-worker metrics (compression ratio and CPU cost, ...)
+@router.get("/metrics")
+async def get_metrics():
+    return {
+        **metrics.snapshot(),
+        "compression": compression.summary(),
+        "quota": quota.scheduler.status(),
+        "message_store": message_store.memory_report(),
+        "drain": drain.controller.status(),
+        "ledger": ledger.get_ledger().stats() if ledger.ENABLED else None,
+        "condense": condenser.status(),
+        "shadow": shadow.shadow.status(),
+    }
+
+# App factory: provider SDKs are not imported here, only on the first completion
+# call (or up front in the pre-fork parent, see serve.py --preload)
+def create_app() -> FastAPI:
+    app = FastAPI(title="Medical AI Assistant")
+
+    # Add CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Compress /chat and /stream per SSE frame, negotiated through Accept-Encoding
+    app.add_middleware(StreamingCompressionMiddleware)
+
+    # Build/load the asset pipeline and pre-render the index page once at startup
+    app.state.assets = AssetRegistry(assets_dir)
+    app.state.index_page = render_index(app.state.assets)
+
+    app.include_router(router)
+
+    # The Dash app, generating through this app's engine and job limits (see dash_mount.py);
+    # optional: without dash installed the FastAPI page is served alone
+    if DASH_MOUNT_PATH and importlib.util.find_spec("dash") is not None:
+        dash_mount.mount(app, DASH_MOUNT_PATH, generation_jobs, prewarmer)
+    return app
+
+# Create FastAPI app
+app = create_app()
+
+# Run the app (development server with auto-reload; in production use
+# `python src/serve.py --preload --profile fast`, see serve.py)
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
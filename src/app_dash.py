@@ -1,33 +1,43 @@
 import dash
 from dash import dcc, html, callback_context
-from dash.dependencies import Input, Output, State
-import litellm
-from litellm import completion
+from dash.dependencies import Input, Output, State, MATCH
 import os
 import sys
 import json
+import time
+from functools import partial
 from dash import clientside_callback, ClientsideFunction
 from dotenv import load_dotenv
+from flask import jsonify, request
 
 # Add the parent directory to sys.path to import prompts.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from prompts import prompt1, prompt2 # Import prompts from prompts.py
+from prompts import PROMPTS, prompt1, prompt2, select_system_prompt # Import prompts from prompts.py
+from providers import DEFAULT_MODELS, completion  # Lazy litellm.completion (imported on first use)
+from markdown_stream import render_frame
+from prewarm import Prewarmer, TTFTTimer
+from comparison import start_comparison, get_comparison
+from condense import condenser
+import journal
+import metrics
+import quota
 
 # Load API keys from environment variables
 load_dotenv()
 # litellm automatically reads environment variables like GEMINI_API_KEY and ANTHROPIC_API_KEY
 
-# Set up the app with external stylesheets
-app = dash.Dash(
-    __name__,
-    suppress_callback_exceptions=True,
-    meta_tags=[
-        {"name": "viewport", "content": "width=device-width, initial-scale=1.0"}
-    ]
-)
+# Shared assets folder (markdown_stream.js / markdown.css); style.css and the build output belong to the FastAPI page
+assets_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets")
+
+# Models offered in the model dropdown and the comparison checklist
+MODEL_OPTIONS = [
+    {'label': 'Gemini 2.0 Flash', 'value': 'gemini/gemini-2.0-flash'},
+    {'label': 'Claude 3 Opus', 'value': 'claude-3-opus-20240229'},
+]
+MODEL_LABELS = {option['value']: option['label'] for option in MODEL_OPTIONS}
 
-# App layout with modern ChatGPT-inspired styling
-app.layout = html.Div(style={
+# App layout with modern ChatGPT-inspired styling (shared by the apps create_dash_app() builds)
+layout = html.Div(style={
     'maxWidth': '900px',
     'margin': '0 auto',
     'height': '100vh',
@@ -45,6 +55,8 @@ app.layout = html.Div(style={
     dcc.Store(id='streaming-content', data=''),
     # Interval for polling streaming updates
     dcc.Interval(id='streaming-interval', interval=100, disabled=True),
+    # Output target of the clientside "typing started" (pre-warm) hook
+    dcc.Store(id='warm-signal', data=None),
     # Header
     html.Div(style={
         'padding': '16px 0',
@@ -138,10 +150,7 @@ app.layout = html.Div(style={
                 html.Label("Model", style={"fontSize": "0.8em", "marginBottom": "4px", "display": "block"}),
                 dcc.Dropdown(
                     id='model-dropdown',
-                    options=[
-                        {'label': 'Gemini 2.0 Flash', 'value': 'gemini/gemini-2.0-flash'},
-                        {'label': 'Claude 3 Opus', 'value': 'claude-3-opus-20240229'},
-                    ],
+                    options=MODEL_OPTIONS,
                     value='gemini/gemini-2.0-flash',
                     clearable=False,
                     style={
@@ -150,6 +159,18 @@ app.layout = html.Div(style={
                     }
                 )
             ]),
+            # Comparison mode: tick two or more models to send the message to all of them
+            html.Div(style={'flex': 1}, children=[
+                html.Label("Compare models", style={"fontSize": "0.8em", "marginBottom": "4px", "display": "block"}),
+                dcc.Checklist(
+                    id='compare-models',
+                    options=MODEL_OPTIONS,
+                    value=[],
+                    inline=True,
+                    inputStyle={'marginRight': '4px'},
+                    labelStyle={'marginRight': '12px', 'fontSize': '0.9em'},
+                )
+            ]),
             # Prompt dropdown
             html.Div(style={'flex': 1}, children=[
                 html.Label("System Prompt", style={"fontSize": "0.8em", "marginBottom": "4px", "display": "block"}),
@@ -219,20 +240,8 @@ app.layout = html.Div(style={
 ])
 
 # Callback to start streaming process
-@app.callback(
-    [Output('streaming-response', 'data'),
-     Output('streaming-interval', 'disabled'),
-     Output('current-message-id', 'data'),
-     Output('chat-area', 'children')],
-    [Input('submit-button', 'n_clicks'),
-     Input('user-input', 'n_submit')],  # Allow Enter key to submit
-    [State('user-input', 'value'),
-     State('model-dropdown', 'value'),
-     State('prompt-dropdown', 'value'),
-     State('chat-area', 'children'),
-     State('current-message-id', 'data')] # Get current chat messages
-)
-def start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, current_messages, current_id):
+def start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, current_messages, current_id,
+                    compare_models=None, backend=None):
     # Check if callback was triggered by a button click or Enter key
     triggered = callback_context.triggered[0]['prop_id']
     
@@ -321,6 +330,22 @@ def start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, c
         # Create a unique ID for the streaming content div
         streaming_div_id = f'streaming-content-{new_id}'
         
+        # Comparison mode: the same message to every ticked model, streamed side by side
+        # (mounted: one generation job per model)
+        if compare_models and len(compare_models) > 1:
+            if backend is not None:
+                stream_data = start_job_comparison(compare_models, user_message, prompt_name, streaming_div_id, backend)
+            else:
+                stream_data = start_model_comparison(compare_models, user_message, system_prompt, prompt_name,
+                                                     streaming_div_id)
+            new_messages.append(
+                html.Div([
+                    html.Div("AI", style=assistant_icon_style),
+                    comparison_layout(stream_data),
+                ], style=assistant_msg_style, className='assistant-message')
+            )
+            return json.dumps(stream_data), False, new_id, new_messages
+        
         new_messages.append(
             html.Div([
                 html.Div("AI", style=assistant_icon_style),
@@ -336,7 +361,8 @@ def start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, c
             'message_id': new_id,
             'content': "",
             'status': 'starting',
-            'div_id': streaming_div_id
+            'div_id': streaming_div_id,
+            'prompt_name': prompt_name
         }
         
         # Return the data to start streaming, enable the interval, update message ID, and update chat area
@@ -345,16 +371,234 @@ def start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, c
     # If no new input, return current state
     return dash.no_update, True, current_id, current_messages
 
-# Callback to handle streaming updates
-@app.callback(
-    [Output('streaming-response', 'data', allow_duplicate=True),
-     Output('streaming-content', 'data')],
-    [Input('streaming-interval', 'n_intervals')],
-    [State('streaming-response', 'data'),
-     State('current-message-id', 'data')],
-    prevent_initial_call=True
-)
-def update_streaming(n_intervals, stream_data_json, current_id):
+# Build the streaming-content payload: raw content plus a markdown frame holding only
+# the blocks the browser has not rendered yet (see markdown_stream.py)
+def streaming_update(stream_data):
+    frame, block_count = render_frame(stream_data['content'], stream_data.get('markdown_blocks', 0))
+    stream_data['markdown_blocks'] = block_count
+    return json.dumps({
+        'content': stream_data['content'],
+        'div_id': stream_data['div_id'],
+        'markdown': frame
+    })
+
+# Journal the finished exchange (queued; written off the request path, see journal.py)
+def journal_response(stream_data, status='complete'):
+    journal.record(
+        'response', None, frontend='dash', request_seq=stream_data.get('journal_seq'),
+        model=stream_data['model_name'], status=status, content=stream_data['content']
+    )
+
+# Start a comparison run (background threads, see comparison.py) and journal its requests
+def start_model_comparison(models, user_message, system_prompt, prompt_name, div_id):
+    messages = [{"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}]
+    journal_seqs = {
+        model: journal.record('request', None, frontend='dash', model=model, prompt=prompt_name,
+                              message=user_message, mode='compare')
+        for model in models
+    }
+
+    def on_finish(run):
+        journal.record(
+            'response', None, frontend='dash', request_seq=journal_seqs.get(run.model), model=run.model,
+            status=run.status, error=run.error, content=run.content, duration=run.duration, mode='compare'
+        )
+
+    usage_labels = {'frontend': 'dash', 'prompt': prompt_name, 'kind': 'compare'}
+    comparison = start_comparison(models, messages, partial(completion, usage_labels=usage_labels), on_finish)
+    return {
+        'mode': 'compare',
+        'comparison_id': comparison.id,
+        'models': list(comparison.runs),
+        'cancel_ids': [f"{comparison.id}|{model}" for model in comparison.runs],
+        'div_id': div_id,
+        'status': 'streaming',
+        'markdown_blocks': [0] * len(comparison.runs),
+    }
+
+# Mounted: start a comparison as one generation job of the FastAPI app per model (each
+# goes through the engine, drain and job limit like a single message; see dash_mount.py)
+def start_job_comparison(models, user_message, prompt_name, div_id, backend):
+    job_ids, errors = [], []
+    for model in models:
+        try:
+            job_ids.append(backend.start({
+                'user_message': user_message,
+                'model_name': model,
+                'prompt_name': prompt_name or 'prompt1',
+                'frontend': 'dash',
+            }))
+            errors.append(None)
+        except Exception as e:
+            job_ids.append(None)
+            errors.append(f"Error: {str(e)}")
+    return {
+        'mode': 'compare',
+        'job_ids': job_ids,
+        'start_errors': errors,
+        'models': list(models),
+        'cancel_ids': [f"job|{job_id}" for job_id in job_ids],
+        'div_id': div_id,
+        'status': 'streaming',
+        'started': time.time(),
+        'markdown_blocks': [0] * len(models),
+    }
+
+# One column per model: name, timings, Cancel button and the streamed answer
+def comparison_layout(stream_data):
+    columns = []
+    for i, model in enumerate(stream_data['models']):
+        columns.append(html.Div([
+            html.Div([
+                html.Strong(MODEL_LABELS.get(model, model)),
+                html.Span("waiting…", id=f"{stream_data['div_id']}-{i}-stats",
+                          style={'color': '#666', 'flexGrow': 1, 'marginLeft': '8px'}),
+                html.Button("Cancel", id={'type': 'compare-cancel', 'index': stream_data['cancel_ids'][i]},
+                            n_clicks=0, style={'fontSize': '0.8em', 'padding': '2px 8px', 'borderRadius': '6px',
+                                               'border': '1px solid #E5E5E5', 'cursor': 'pointer'}),
+            ], style={'display': 'flex', 'alignItems': 'center', 'fontSize': '0.85em', 'marginBottom': '8px'}),
+            html.Div(id=f"{stream_data['div_id']}-{i}", children=""),
+        ], style={'minWidth': 0, 'borderRight': '1px solid #E5E5E5', 'paddingRight': '12px'}))
+    return html.Div([
+        html.Div(columns, style={
+            'display': 'grid',
+            'gridTemplateColumns': f"repeat({len(columns)}, minmax(0, 1fr))",
+            'gap': '12px',
+        }),
+        html.Div(id=f"{stream_data['div_id']}-summary", style={'fontSize': '0.8em', 'color': '#666', 'marginTop': '8px'}),
+    ], id=stream_data['div_id'], style={'flexGrow': 1, 'minWidth': 0})
+
+def format_seconds(seconds):
+    return '–' if seconds is None else f'{seconds:.2f}s'
+
+def run_stats(run):
+    if run['status'] == 'waiting':
+        # Mounted: condensing progress of the model's job
+        return run['progress']['message'] if run.get('progress') else 'waiting…'
+    timing = f"first token {format_seconds(run['ttft'])}"
+    if run['duration'] is not None:
+        timing += f" · total {format_seconds(run['duration'])}"
+    return timing if run['status'] in ('streaming', 'complete') else f"{run['status']} · {timing}"
+
+# Polling tick of a comparison: every model's new markdown blocks and timings in one payload
+def comparison_update(stream_data):
+    comparison = get_comparison(stream_data['comparison_id'])
+    if comparison is None:
+        stream_data['status'] = 'complete'
+        return [json.dumps(stream_data), dash.no_update]
+    return comparison_payload(stream_data, comparison.snapshot())
+
+# A comparison run ({"status", "content", "error", "ttft", "duration"}) from a job summary
+def job_run(job, start_error):
+    if job is None:
+        error = start_error or 'Error: The generation was lost.'
+        return {'status': 'error', 'content': '', 'error': error, 'ttft': None, 'duration': None}
+    status = job['status']
+    if status == 'running':
+        status = 'streaming' if job['content'] else 'waiting'
+    return {'status': status, 'content': job['content'], 'error': job['error'],
+            'ttft': job.get('ttft'), 'duration': job.get('duration'), 'progress': job.get('progress')}
+
+# Polling tick of a mounted comparison: read each model's job
+def job_comparison_update(stream_data, backend):
+    runs = [
+        job_run(backend.poll(job_id) if job_id else None, start_error)
+        for job_id, start_error in zip(stream_data['job_ids'], stream_data['start_errors'])
+    ]
+    finished = all(run['status'] not in ('waiting', 'streaming') for run in runs)
+    durations = [run['duration'] for run in runs]
+    if finished and None not in durations:
+        wall_time = max(durations)
+    else:
+        wall_time = time.time() - stream_data['started']
+    return comparison_payload(stream_data, {'runs': runs, 'finished': finished, 'wall_time': wall_time})
+
+# Payload of a comparison snapshot ({"runs", "finished", "wall_time"})
+def comparison_payload(stream_data, snapshot):
+    columns = []
+    for i, run in enumerate(snapshot['runs']):
+        content = run['content'] or (run['error'] or '')
+        frame, block_count = render_frame(content, stream_data['markdown_blocks'][i])
+        stream_data['markdown_blocks'][i] = block_count
+        columns.append({
+            'div_id': f"{stream_data['div_id']}-{i}",
+            'stats_id': f"{stream_data['div_id']}-{i}-stats",
+            'stats': run_stats(run),
+            'content': content,
+            'markdown': frame,
+        })
+    summary = ''
+    if snapshot['finished']:
+        stream_data['status'] = 'complete'
+        summary = f"All models finished in {format_seconds(snapshot['wall_time'])}"
+    return [json.dumps(stream_data), json.dumps({
+        'div_id': stream_data['div_id'],
+        'compare': columns,
+        'summary_id': f"{stream_data['div_id']}-summary",
+        'summary': summary,
+    })]
+
+# Cancel one model of a comparison; the others keep streaming
+def cancel_comparison_model(n_clicks, backend=None):
+    comparison_id, _, model = callback_context.triggered_id['index'].partition('|')
+    if comparison_id == 'job':
+        # Mounted: `model` is the model's job id
+        if backend is not None and model != 'None':
+            backend.cancel(model)
+        return True
+    comparison = get_comparison(comparison_id)
+    if comparison is not None:
+        comparison.cancel(model)
+    return True
+
+# Mounted: start the message as a generation job of the FastAPI app's `backend` (see
+# dash_mount.py), then render the job's content so far on each poll (condensing,
+# journaling and metering happen in the job)
+def shared_engine_update(stream_data, backend):
+    if stream_data['status'] == 'starting':
+        try:
+            stream_data['job_id'] = backend.start({
+                'user_message': stream_data['user_message'],
+                'model_name': stream_data['model_name'],
+                'prompt_name': stream_data.get('prompt_name') or 'prompt1',
+                'frontend': 'dash',
+            })
+        except Exception as e:
+            stream_data['status'] = 'complete'
+            stream_data['content'] = f"Error: {str(e)}"
+            return [json.dumps(stream_data), streaming_update(stream_data)]
+        stream_data['status'] = 'streaming'
+        return [json.dumps(stream_data), dash.no_update]
+
+    job = backend.poll(stream_data['job_id'])
+    if job is None:
+        job = {'status': 'error', 'content': stream_data['content'], 'error': 'Error: The generation was lost.'}
+    progress = job.get('progress')
+    if job['status'] == 'running' and not job['content'] and progress:
+        # An oversized message is being condensed before the answer starts
+        if progress['message'] == stream_data.get('progress'):
+            return [dash.no_update, dash.no_update]
+        stream_data['progress'] = progress['message']
+        frame, _ = render_frame(progress['message'] + '...')
+        return [json.dumps(stream_data), json.dumps({
+            'content': progress['message'] + '...',
+            'div_id': stream_data['div_id'],
+            'markdown': frame
+        })]
+    changed = job['content'] != stream_data['content']
+    stream_data['content'] = job['content']
+    if job['status'] != 'running':
+        stream_data['status'] = 'complete'
+        if job['status'] == 'error' and not stream_data['content']:
+            stream_data['content'] = job['error']
+    elif not changed:
+        return [dash.no_update, dash.no_update]
+    return [json.dumps(stream_data), streaming_update(stream_data)]
+
+# Callback to handle streaming updates; with a `backend` (mounted in the FastAPI app)
+# messages run as its generation jobs, otherwise the provider is called here
+def update_streaming(n_intervals, stream_data_json, current_id, backend=None):
     if not stream_data_json:
         return [dash.no_update, dash.no_update]
     
@@ -364,6 +608,14 @@ def update_streaming(n_intervals, stream_data_json, current_id):
     if stream_data['status'] == 'complete':
         return [dash.no_update, dash.no_update]
     
+    if stream_data.get('mode') == 'compare':
+        if 'job_ids' in stream_data:
+            return job_comparison_update(stream_data, backend)
+        return comparison_update(stream_data)
+    
+    if backend is not None:
+        return shared_engine_update(stream_data, backend)
+    
     # If streaming is just starting, initiate the API call
     if stream_data['status'] == 'starting':
         try:
@@ -373,12 +625,33 @@ def update_streaming(n_intervals, stream_data_json, current_id):
             # Start streaming response
             stream_data['status'] = 'streaming'
             stream_data['content'] = ""  # Initialize empty content
+            stream_data['journal_seq'] = journal.record(
+                'request', None, frontend='dash', model=stream_data['model_name'],
+                prompt=stream_data.get('prompt_name'), message=stream_data['user_message']
+            )
+            
+            # Oversized messages are condensed first (blocks this callback; the condensed
+            # text is kept for the follow-up calls, see condense.py)
+            if condenser.needs_condensing(stream_data['user_message'], stream_data['model_name']):
+                stream_data['model_message'] = condenser.condense(
+                    stream_data['user_message'], stream_data['model_name'],
+                    {'frontend': 'dash', 'prompt': stream_data.get('prompt_name')}
+                )
+                messages[1]['content'] = stream_data['model_message']
+            
+            # Time-to-first-token, labelled by whether the typing signal pre-warmed this model/prompt
+            ttft = TTFTTimer(
+                stream_data['model_name'],
+                prewarmer.is_warm(None, stream_data['model_name'], stream_data.get('prompt_name')),
+                frontend='dash'
+            )
             
             # Make a non-blocking call to get the first chunk
             response_chunk = completion(
                 model=stream_data['model_name'],
                 messages=messages,
-                stream=True  # Enable streaming
+                stream=True,  # Enable streaming
+                usage_labels={'frontend': 'dash', 'prompt': stream_data.get('prompt_name')}
             )
             
             # Get the first chunk
@@ -387,35 +660,34 @@ def update_streaming(n_intervals, stream_data_json, current_id):
                     # Extract delta content from the chunk
                     delta = chunk.choices[0].delta
                     if hasattr(delta, 'content') and delta.content:
+                        ttft.token()
                         stream_data['content'] += delta.content
                     break  # Just get the first chunk for now
             
             # Return updated stream data and content
-            return [json.dumps(stream_data), json.dumps({
-                'content': stream_data['content'],
-                'div_id': stream_data['div_id']
-            })]
+            content_update = streaming_update(stream_data)
+            return [json.dumps(stream_data), content_update]
             
         except Exception as e:
             # Handle errors
             stream_data['status'] = 'complete'
             stream_data['content'] = f"Error: {str(e)}"
-            return [json.dumps(stream_data), json.dumps({
-                'content': stream_data['content'],
-                'div_id': stream_data['div_id']
-            })]
+            journal_response(stream_data, 'error')
+            content_update = streaming_update(stream_data)
+            return [json.dumps(stream_data), content_update]
     
     # If already streaming, continue getting more chunks
     elif stream_data['status'] == 'streaming':
         try:
             messages = [{"role": "system", "content": stream_data['system_prompt']},
-                        {"role": "user", "content": stream_data['user_message']}]
+                        {"role": "user", "content": stream_data.get('model_message', stream_data['user_message'])}]
             
             # Continue streaming where we left off
             response_chunk = completion(
                 model=stream_data['model_name'],
                 messages=messages,
-                stream=True
+                stream=True,
+                usage_labels={'frontend': 'dash', 'prompt': stream_data.get('prompt_name')}
             )
             
             # Skip chunks we've already processed
@@ -441,40 +713,83 @@ def update_streaming(n_intervals, stream_data_json, current_id):
             # If we've reached the end, mark as complete
             if not new_content or stream_data['status'] == 'complete':
                 stream_data['status'] = 'complete'
+                journal_response(stream_data)
             
             # Return updated stream data and content
-            return [json.dumps(stream_data), json.dumps({
-                'content': stream_data['content'],
-                'div_id': stream_data['div_id']
-            })]
+            content_update = streaming_update(stream_data)
+            return [json.dumps(stream_data), content_update]
             
         except Exception as e:
             # Handle errors
             stream_data['status'] = 'complete'
             if not stream_data['content']:  # Only show error if we haven't received any content yet
                 stream_data['content'] = f"Error: {str(e)}"
-            return [json.dumps(stream_data), json.dumps({
-                'content': stream_data['content'],
-                'div_id': stream_data['div_id']
-            })]
+            journal_response(stream_data, 'error')
+            content_update = streaming_update(stream_data)
+            return [json.dumps(stream_data), content_update]
     
     return [dash.no_update, dash.no_update]
 
+# Warm-up call for the typing signal: a 1-token completion through the same streaming path
+# as the real request (same provider client, same system prompt prefix)
+def warm_provider(model_name, prompt_name):
+    messages = [{"role": "system", "content": select_system_prompt(prompt_name)},
+                {"role": "user", "content": "."}]
+    usage_labels = {'frontend': 'dash', 'prompt': prompt_name, 'kind': 'warmup'}
+    for _ in completion(model=model_name, messages=messages, stream=True, max_tokens=1, usage_labels=usage_labels):
+        pass
+
+# Shared pre-warmer (idempotent, rate-limited per session and process, offered models
+# and prompts only; see prewarm.py)
+prewarmer = Prewarmer(warm_provider, DEFAULT_MODELS, PROMPTS)
+
+# Per-process metrics (time-to-first-token with and without pre-warming, ...)
+def get_metrics():
+    return jsonify({**metrics.snapshot(), 'quota': quota.scheduler.status()})
+
 # Callback to clear input after submission
-@app.callback(
-    Output('user-input', 'value'),
-    [Input('submit-button', 'n_clicks'),
-     Input('user-input', 'n_submit')]
-)
 def clear_input(n_clicks, n_submit):
     triggered = dash.callback_context.triggered[0]['prop_id']
     if triggered == 'submit-button.n_clicks' or triggered == 'user-input.n_submit':
         return ''
     return dash.no_update
 
-# Register clientside callback to update streaming content
-app.clientside_callback(
+# Clientside hook: send a throttled "typing started" signal while the user types,
+# and again when the model or prompt changes mid-message (WARM_URL is the app's /warm)
+WARM_SIGNAL_JS = """
+    function(userMessage, modelName, promptName) {
+        if (!userMessage || !userMessage.trim()) return window.dash_clientside.no_update;
+        
+        const state = window.warmSignalState = window.warmSignalState || {
+            sessionId: Date.now() + '-' + Math.random().toString(36).slice(2),
+            timer: null,
+            lastKey: null,
+            lastAt: 0
+        };
+        if (state.timer) return window.dash_clientside.no_update;
+        
+        state.timer = setTimeout(function() {
+            state.timer = null;
+            const key = modelName + '|' + promptName;
+            if (key === state.lastKey && Date.now() - state.lastAt < 60000) return;
+            state.lastKey = key;
+            state.lastAt = Date.now();
+            fetch('WARM_URL', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                keepalive: true,
+                body: JSON.stringify({session_id: state.sessionId, model_name: modelName, prompt_name: promptName})
+            }).catch(function(error) {
+                console.warn('Warm-up signal failed:', error);
+            });
+        }, 300);
+        
+        return window.dash_clientside.no_update;
+    }
     """
+
+# Clientside callback to update streaming content
+STREAMING_CONTENT_JS = """
     function(streamingContent) {
         if (!streamingContent) return window.dash_clientside.no_update;
         
@@ -482,8 +797,32 @@ app.clientside_callback(
             const data = JSON.parse(streamingContent);
             const contentElement = document.getElementById(data.div_id);
             
+            // Comparison mode: one column per model
+            if (data.compare) {
+                data.compare.forEach(function(column) {
+                    const columnElement = document.getElementById(column.div_id);
+                    const statsElement = document.getElementById(column.stats_id);
+                    if (statsElement) statsElement.textContent = column.stats;
+                    if (columnElement && column.content) {
+                        if (column.markdown && window.markdownStream) {
+                            window.markdownStream.apply(columnElement, column.markdown);
+                        } else {
+                            columnElement.textContent = column.content;
+                        }
+                    }
+                });
+                const summaryElement = document.getElementById(data.summary_id);
+                if (summaryElement) summaryElement.textContent = data.summary;
+                return window.dash_clientside.no_update;
+            }
+            
             if (contentElement && data.content) {
-                contentElement.textContent = data.content;
+                // Render server-side markdown (tables included); fall back to plain text
+                if (data.markdown && window.markdownStream) {
+                    window.markdownStream.apply(contentElement, data.markdown);
+                } else {
+                    contentElement.textContent = data.content;
+                }
                 
                 // Scroll to the bottom of the chat area
                 const chatArea = document.querySelector('.chat-area') || 
@@ -498,15 +837,10 @@ app.clientside_callback(
         
         return window.dash_clientside.no_update;
     }
-    """,
-    Output('streaming-content', 'data', allow_duplicate=True),
-    [Input('streaming-content', 'data')],
-    prevent_initial_call=True
-)
+    """
 
 # Clientside callback to disable interval when streaming is complete
-app.clientside_callback(
-    """
+STREAMING_DONE_JS = """
     function(streamData) {
         if (!streamData) return window.dash_clientside.no_update;
         
@@ -523,12 +857,104 @@ app.clientside_callback(
         
         return window.dash_clientside.no_update;
     }
-    """,
-    Output('streaming-interval', 'disabled', allow_duplicate=True),
-    [Input('streaming-response', 'data')],
-    prevent_initial_call=True
-)
+    """
+
+# Build a Dash app. `prefix` is the URL prefix the browser uses: "/" standalone, the mount
+# path (e.g. "/dash/") inside the FastAPI app, whose mount strips it before Flask routes the
+# request. With a `backend`, messages run as the FastAPI app's generation jobs and the
+# typing signal warms `shared_prewarmer` (see dash_mount.py); without, the callbacks call
+# the provider themselves and warm this module's pre-warmer
+def create_dash_app(prefix="/", backend=None, shared_prewarmer=None):
+    warmer = shared_prewarmer or prewarmer
+    app = dash.Dash(
+        __name__,
+        requests_pathname_prefix=prefix,
+        routes_pathname_prefix="/",
+        suppress_callback_exceptions=True,
+        assets_folder=assets_dir,
+        assets_ignore=r"^style\.css$",
+        assets_path_ignore=["build"],
+        meta_tags=[
+            {"name": "viewport", "content": "width=device-width, initial-scale=1.0"}
+        ]
+    )
+    app.layout = layout
+
+    @app.callback(
+        [Output('streaming-response', 'data'),
+         Output('streaming-interval', 'disabled'),
+         Output('current-message-id', 'data'),
+         Output('chat-area', 'children')],
+        [Input('submit-button', 'n_clicks'),
+         Input('user-input', 'n_submit')],  # Allow Enter key to submit
+        [State('user-input', 'value'),
+         State('model-dropdown', 'value'),
+         State('prompt-dropdown', 'value'),
+         State('chat-area', 'children'),
+         State('current-message-id', 'data'), # Get current chat messages
+         State('compare-models', 'value')]
+    )
+    def submit_message(n_clicks, n_submit, user_message, model_name, prompt_name, current_messages, current_id,
+                       compare_models):
+        return start_streaming(n_clicks, n_submit, user_message, model_name, prompt_name, current_messages,
+                               current_id, compare_models, backend)
+
+    @app.callback(
+        Output({'type': 'compare-cancel', 'index': MATCH}, 'disabled'),
+        Input({'type': 'compare-cancel', 'index': MATCH}, 'n_clicks'),
+        prevent_initial_call=True
+    )
+    def cancel_model(n_clicks):
+        return cancel_comparison_model(n_clicks, backend)
+
+    @app.callback(
+        [Output('streaming-response', 'data', allow_duplicate=True),
+         Output('streaming-content', 'data')],
+        [Input('streaming-interval', 'n_intervals')],
+        [State('streaming-response', 'data'),
+         State('current-message-id', 'data')],
+        prevent_initial_call=True
+    )
+    def poll_streaming(n_intervals, stream_data_json, current_id):
+        return update_streaming(n_intervals, stream_data_json, current_id, backend)
+
+    app.callback(
+        Output('user-input', 'value'),
+        [Input('submit-button', 'n_clicks'),
+         Input('user-input', 'n_submit')]
+    )(clear_input)
+
+    # "Typing started" signal from the clientside hook
+    def warm():
+        payload = request.get_json(silent=True) or {}
+        status = warmer.request(payload.get('session_id'), payload.get('model_name'), payload.get('prompt_name'))
+        return jsonify({'status': status}), 422 if status == 'rejected' else 200
+
+    app.server.add_url_rule('/warm', 'warm', warm, methods=['POST'])
+    app.server.add_url_rule('/metrics', 'metrics', get_metrics)
+
+    app.clientside_callback(
+        WARM_SIGNAL_JS.replace('WARM_URL', app.get_relative_path('/warm')),
+        Output('warm-signal', 'data'),
+        [Input('user-input', 'value'),
+         Input('model-dropdown', 'value'),
+         Input('prompt-dropdown', 'value')],
+        prevent_initial_call=True
+    )
+    app.clientside_callback(
+        STREAMING_CONTENT_JS,
+        Output('streaming-content', 'data', allow_duplicate=True),
+        [Input('streaming-content', 'data')],
+        prevent_initial_call=True
+    )
+    app.clientside_callback(
+        STREAMING_DONE_JS,
+        Output('streaming-interval', 'disabled', allow_duplicate=True),
+        [Input('streaming-response', 'data')],
+        prevent_initial_call=True
+    )
+    return app
 
-# Run the app
+# Run the app standalone (in production it is mounted in the FastAPI app at /dash, see dash_mount.py)
 if __name__ == '__main__':
-    app.run(debug=True, port=8054)  # Use a different port
+    create_dash_app().run(debug=True, port=8054)  # Use a different port
@@ -2,12 +2,17 @@ import streamlit as st
 import os
 import sys
 import time
+import uuid
 from dotenv import load_dotenv
-from litellm import completion
 
 # Add the parent directory to sys.path to import prompts.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from prompts import prompt1, prompt2
+from providers import completion  # Lazy litellm.completion (imported on first use)
+from condense import condenser
+import journal
+from message_store import MessageStore
+from generation_pool import GenerationPool
 
 # Load environment variables for API keys
 load_dotenv()
@@ -34,11 +39,34 @@ st.set_page_config(
     initial_sidebar_state="collapsed",
 )
 
+WELCOME_MESSAGE = "Hello! I'm your medical AI assistant. How can I help you today?"
+
+# Chat history of every browser session lives in one process-wide store with a
+# memory budget (idle sessions are evicted, see message_store.py)
+@st.cache_resource
+def get_message_store():
+    return MessageStore()
+
+message_store = get_message_store()
+
+# Seconds between refreshes of an answer being generated
+POLL_INTERVAL = 0.25
+
+# Generations run in one process-wide pool shared by all sessions, which caps how
+# many run at once (see generation_pool.py); the script thread only polls
+@st.cache_resource
+def get_generation_pool():
+    return GenerationPool(completion, condenser=condenser)
+
+generation_pool = get_generation_pool()
+
 # Initialize session state for chat history and settings
-if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role": "assistant", "content": "Hello! I'm your medical AI assistant. How can I help you today?"}
-    ]
+if "session_key" not in st.session_state:
+    st.session_state.session_key = uuid.uuid4().hex
+session_key = st.session_state.session_key
+if session_key not in message_store:
+    # New session, or its history was evicted while idle
+    message_store.append(session_key, "assistant", WELCOME_MESSAGE)
 
 if "model" not in st.session_state:
     st.session_state.model = "gemini/gemini-2.0-flash"
@@ -151,7 +179,8 @@ with col2:
     st.session_state.prompt = prompt_mapping[prompt_option]
 
 # Display chat messages from history
-for message in st.session_state.messages:
+chat_messages = message_store.messages(session_key)
+for message in chat_messages:
     role = message["role"]
     content = message["content"]
     
@@ -166,25 +195,82 @@ for message in st.session_state.messages:
     </div>
     """, unsafe_allow_html=True)
 
+# Show the answer being generated. Only this fragment re-runs while it streams, so
+# the rest of the page stays interactive; once the answer is complete it is in the
+# history and the whole page re-runs once to show it there.
+@st.fragment(run_every=POLL_INTERVAL)
+def show_generation():
+    task = generation_pool.get(st.session_state.get("generation_id"))
+    if task is None or task.finished:
+        st.session_state.pop("generation_id", None)
+        st.rerun()
+    
+    if task.status == "queued":
+        ahead = generation_pool.queue_position(task.id)
+        content = f"Waiting for a free slot ({ahead} ahead)..." if ahead else "Generating response..."
+    elif task.status == "condensing":
+        content = f"{task.progress or 'Condensing a long input'}..."
+    else:
+        content = task.content or "Generating response..."
+    
+    st.markdown(f"""
+    <div class="chat-message assistant-message">
+        <div class="avatar assistant-avatar">AI</div>
+        <div class="message-content">{content}</div>
+    </div>
+    """, unsafe_allow_html=True)
+    st.button("Stop", key="stop_generation", on_click=generation_pool.cancel, args=(task.id,))
+
+if "generation_id" in st.session_state:
+    show_generation()
+
 # Add a spacer to ensure chat messages are visible above the input area
 st.markdown("<div style='height: 50px;'></div>", unsafe_allow_html=True)
 
 # Function to handle message submission
 def handle_submit():
-    if st.session_state.user_input.strip():
+    if st.session_state.user_input.strip() and "generation_id" not in st.session_state:
         user_message = st.session_state.user_input
+        session_key = st.session_state.session_key
+        model = st.session_state.model
+        # Prompts are recorded by id (journal, message store, ledger), like the other frontends
+        prompt_name = "prompt1" if st.session_state.prompt == prompt1 else "prompt2"
         
         # Add user message to chat
-        st.session_state.messages.append({"role": "user", "content": user_message})
+        message_store.append(session_key, "user", user_message)
+        
+        # Prepare messages for the API call
+        messages = [
+            {"role": "system", "content": st.session_state.prompt},
+            {"role": "user", "content": user_message}
+        ]
+        journal_seq = journal.record(
+            "request", None, frontend="streamlit", model=model, prompt=prompt_name, message=user_message
+        )
+        
+        # Runs in the pool's worker thread once the generation stops
+        def on_finish(task):
+            journal.record(
+                "response", None, frontend="streamlit", request_seq=journal_seq,
+                model=model, status=task.status, error=task.error, content=task.content
+            )
+            if task.error:
+                message_store.append(session_key, "assistant", task.error)
+            elif task.content:
+                message_store.append(session_key, "assistant", task.content, prompt=prompt_name)
+            elif task.status == "complete":
+                message_store.append(session_key, "assistant", "I'm sorry, I couldn't generate a response. Please try again.")
         
-        # Add a temporary message
-        st.session_state.messages.append({"role": "assistant", "content": "Generating response..."})
+        # Generate in the shared pool; the page polls it (see show_generation)
+        usage_labels = {"frontend": "streamlit", "prompt": prompt_name}
+        task = generation_pool.submit(session_key, model, messages, on_finish, usage_labels)
+        if task is None:
+            message_store.append(session_key, "assistant", "The server is busy right now. Please try again in a moment.")
+        else:
+            st.session_state.generation_id = task.id
         
         # Clear the input
         st.session_state.user_input = ""
-        
-        # Force a rerun to update the UI
-        st.rerun()
 
 # Add a note about clicking in the input field
 st.info("⚠️ Please click in the input field below to start typing. Auto-focus is not supported in this Streamlit app.", icon="ℹ️")
@@ -199,69 +285,9 @@ with col1:
     # The input value is already in session state via the key="user_input"
 
 with col2:
-    if st.button("Send", on_click=handle_submit, use_container_width=True):
+    if st.button("Send", on_click=handle_submit, use_container_width=True, disabled="generation_id" in st.session_state):
         pass  # The actual logic is in the handle_submit function
 
-# Process AI response generation
-if (st.session_state.messages and 
-    st.session_state.messages[-1]["role"] == "assistant" and 
-    st.session_state.messages[-1]["content"] == "Generating response..."):
-    
-    # Get the last user message
-    user_message = None
-    for msg in reversed(st.session_state.messages[:-1]):
-        if msg["role"] == "user":
-            user_message = msg["content"]
-            break
-    
-    if user_message:
-        try:
-            # Prepare messages for the API call
-            messages = [
-                {"role": "system", "content": st.session_state.prompt},
-                {"role": "user", "content": user_message}
-            ]
-            
-            # Remove the "Generating response..." message
-            st.session_state.messages.pop()
-            
-            # Create a placeholder for the streaming response
-            placeholder = st.empty()
-            response_content = ""
-            
-            # Stream the response
-            for chunk in completion(
-                model=st.session_state.model,
-                messages=messages,
-                stream=True
-            ):
-                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, 'content') and delta.content:
-                        response_content += delta.content
-                        
-                        # Update the placeholder with the current content
-                        with placeholder:
-                            st.markdown(f"""
-                            <div class="chat-message assistant-message">
-                                <div class="avatar assistant-avatar">AI</div>
-                                <div class="message-content">{response_content}</div>
-                            </div>
-                            """, unsafe_allow_html=True)
-            
-            # Add the final response to the session state
-            if response_content:
-                st.session_state.messages.append({"role": "assistant", "content": response_content})
-            else:
-                st.session_state.messages.append({"role": "assistant", "content": "I'm sorry, I couldn't generate a response. Please try again."})
-                
-        except Exception as e:
-            # Add error message
-            st.session_state.messages.append({"role": "assistant", "content": f"Error: {str(e)}"})
-        
-        # Rerun to update the UI with the final state
-        st.rerun()
-
 # Add a note about the limitation
 st.markdown("""
 <div style="text-align: center; margin-top: 10px; color: #666; font-size: 0.8em;">
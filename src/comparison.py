@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from engine import chunk_content
+
+# Multi-model comparison runs for the Dash app.
+#
+# Dash callbacks are short-lived requests, so a comparison runs in background
+# threads (one per model, all started at once) and the page polls snapshot()
+# with a single request per tick, which returns every model's content, status
+# and timings together. Each model can be cancelled on its own; the others keep
+# streaming. (The FastAPI app compares over its WebSocket, see ws_chat.py.)
+
+# Threads shared by all comparison runs in the process
+MAX_COMPARISON_THREADS = int(os.environ.get("MAX_COMPARISON_THREADS", 16))
+
+# Runs kept for polling (oldest dropped first)
+MAX_RUNS = 100
+
+_executor = ThreadPoolExecutor(max_workers=MAX_COMPARISON_THREADS, thread_name_prefix="comparison")
+
+class ModelRun:
+    __slots__ = ("model", "content", "status", "error", "started", "ttft", "duration", "stop")
+
+    def __init__(self, model):
+        self.model = model
+        self.content = ""
+        self.status = "waiting"
+        self.error = None
+        self.started = None
+        self.ttft = None
+        self.duration = None
+        self.stop = threading.Event()
+
+    def snapshot(self):
+        return {
+            "model": self.model,
+            "content": self.content,
+            "status": self.status,
+            "error": self.error,
+            "ttft": self.ttft,
+            "duration": self.duration,
+        }
+
+class Comparison:
+    # on_finish(model_run) is called from the model's thread when it stops
+    def __init__(self, models, messages, completion_func, on_finish=None):
+        self.id = uuid.uuid4().hex
+        self.messages = messages
+        self.completion_func = completion_func
+        self.on_finish = on_finish
+        self.runs = OrderedDict((model, ModelRun(model)) for model in dict.fromkeys(models))
+        self.started = time.perf_counter()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        for run in self.runs.values():
+            _executor.submit(self._run, run)
+        metrics.incr("comparisons", frontend="dash", models=len(self.runs))
+        return self
+
+    def _run(self, run):
+        run.started = time.perf_counter()
+        run.status = "streaming"
+        try:
+            for chunk in self.completion_func(model=run.model, messages=self.messages, stream=True):
+                if run.stop.is_set():
+                    break
+                content = chunk_content(chunk)
+                if content:
+                    if run.ttft is None:
+                        run.ttft = time.perf_counter() - run.started
+                        metrics.observe("ttft_seconds", run.ttft, model=run.model, warmed=False, frontend="dash-compare")
+                    run.content += content
+            run.status = "cancelled" if run.stop.is_set() else "complete"
+        except Exception as e:
+            run.status = "error"
+            run.error = f"Error: {str(e)}"
+        run.duration = time.perf_counter() - run.started
+        with self._lock:
+            if self.finished_at is None and all(r.status in ("complete", "cancelled", "error") for r in self.runs.values()):
+                self.finished_at = time.perf_counter()
+        if self.on_finish is not None:
+            self.on_finish(run)
+
+    # Cancel one model; the others keep streaming
+    def cancel(self, model):
+        run = self.runs.get(model)
+        if run is None:
+            return False
+        run.stop.set()
+        return True
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "runs": [run.snapshot() for run in self.runs.values()],
+            "finished": self.finished,
+            # Wall-clock time of the whole comparison (the slowest model, not the sum)
+            "wall_time": (self.finished_at or time.perf_counter()) - self.started,
+        }
+
+_runs = OrderedDict()
+_runs_lock = threading.Lock()
+
+def start_comparison(models, messages, completion_func, on_finish=None):
+    comparison = Comparison(models, messages, completion_func, on_finish)
+    with _runs_lock:
+        _runs[comparison.id] = comparison
+        while len(_runs) > MAX_RUNS:
+            _, dropped = _runs.popitem(last=False)
+            for model in dropped.runs:
+                dropped.cancel(model)
+    return comparison.start()
+
+def get_comparison(comparison_id):
+    with _runs_lock:
+        return _runs.get(comparison_id)
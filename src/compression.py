@@ -0,0 +1,173 @@
+import time
+import zlib
+
+import metrics
+from static_assets import negotiate_encoding, is_compressible
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Streaming-safe response compression for the chat endpoints.
+#
+# Unlike a buffering gzip middleware, every ASGI body message (one SSE frame or a
+# coalesced batch of frames) is compressed and flushed immediately, so no token is
+# held back waiting for more input. One compressor lives for the whole response,
+# which lets later frames back-reference earlier ones (the SSE frames repeat most
+# of the previous content, so the ratio is high). Non-streaming bodies such as the
+# /chat JSON are compressed in one shot.
+
+# Paths (and their sub-paths) whose responses are compressed
+COMPRESSED_PATHS = ("/chat", "/stream", "/generations")
+
+# Complete bodies smaller than this are sent uncompressed
+MINIMUM_SIZE = 512
+
+# Fast settings: these run per frame on the request path
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+def available_encodings():
+    return {"gzip", "br"} if brotli is not None else {"gzip"}
+
+# Per-response compressor with explicit flush/finish
+class StreamCompressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        else:
+            # wbits=31 produces a gzip container
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    # Compress data and flush it so the client can decode everything sent so far
+    def flush(self, data):
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    # Compress the final data and terminate the stream
+    def finish(self, data):
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH)
+
+# The entry of `paths` covering `path` (None if none does); metrics are labelled with
+# it, so per-job paths like /generations/{id}/events don't each add counter series
+def _matching_prefix(path, paths):
+    for prefix in paths:
+        if path == prefix or path.startswith(prefix + "/"):
+            return prefix
+    return None
+
+# ASGI middleware compressing responses of the given paths per body message
+class StreamingCompressionMiddleware:
+    def __init__(self, app, paths=COMPRESSED_PATHS, minimum_size=MINIMUM_SIZE):
+        self.app = app
+        self.paths = paths
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        prefix = _matching_prefix(scope["path"], self.paths) if scope["type"] == "http" else None
+        if prefix is None:
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate_encoding(accept_encoding, available_encodings())
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressingResponder(send, encoding, self.minimum_size, prefix)
+        await self.app(scope, receive, responder.send)
+
+class _CompressingResponder:
+    def __init__(self, send, encoding, minimum_size, path):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.path = path
+        self._start = None
+        self._compressor = None
+        self._passthrough = False
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            # Hold the start message until the first body tells us whether to compress
+            self._start = message
+            headers = {key.lower(): value for key, value in message.get("headers", [])}
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            if b"content-encoding" in headers or not is_compressible(content_type):
+                self._passthrough = True
+            return
+
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self._start is not None:
+            start, self._start = self._start, None
+            if self._passthrough or (not more_body and len(body) < self.minimum_size):
+                self._passthrough = True
+                await self._send(start)
+            else:
+                self._compressor = StreamCompressor(self.encoding)
+                await self._send(self._compressed_start(start))
+
+        if self._passthrough:
+            await self._send(message)
+            return
+
+        started = time.thread_time()
+        data = self._compressor.flush(body) if more_body else self._compressor.finish(body)
+        cpu_seconds = time.thread_time() - started
+
+        labels = {"encoding": self.encoding, "path": self.path}
+        metrics.incr("compression_bytes_in", len(body), **labels)
+        metrics.incr("compression_bytes_out", len(data), **labels)
+        metrics.incr("compression_cpu_seconds", cpu_seconds, **labels)
+        metrics.incr("compression_flushes", 1, **labels)
+        if not more_body:
+            metrics.incr("compression_responses", 1, **labels)
+
+        await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    def _compressed_start(self, start):
+        headers = [
+            (key, value)
+            for key, value in start.get("headers", [])
+            if key.lower() not in (b"content-length", b"vary")
+        ]
+        vary = [value for key, value in start.get("headers", []) if key.lower() == b"vary"]
+        headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        return {**start, "headers": headers}
+
+# Compression ratio and CPU cost per encoding and path, from the metrics registry
+def summary():
+    counters = metrics.snapshot("compression_")["counters"]
+    series = {}
+    for key, value in counters.items():
+        name, _, labels = key.partition("{")
+        entry = series.setdefault("{" + labels, {})
+        entry[name.replace("compression_", "")] = value
+
+    result = {}
+    for labels, entry in series.items():
+        bytes_in = entry.get("bytes_in", 0)
+        bytes_out = entry.get("bytes_out", 0)
+        result[labels] = {
+            **entry,
+            "ratio": bytes_in / bytes_out if bytes_out else None,
+            "cpu_us_per_kb": entry.get("cpu_seconds", 0) * 1e6 / (bytes_in / 1024) if bytes_in else None,
+        }
+    return result
@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import metrics
+import providers
+import quota
+
+# Map-reduce condensation of oversized inputs (whole discharge notes pasted in).
+#
+# Before dispatch, the user message's size is estimated (quota's characters / 4).
+# Above the model's threshold it is condensed instead of being sent to fail:
+#   1. split into chunks at paragraph boundaries chosen by content (a paragraph
+#      ends a chunk when its hash says so, within CHUNK_TOKENS / 2 .. * 2), so an
+#      edit only changes the chunks around it and the rest keep their content;
+#   2. map: each chunk is condensed by the cheap CONDENSE_MODEL, at most
+#      CONDENSE_CONCURRENCY at once per process (across all requests). Results
+#      are cached by content hash, and concurrent requests for the same chunk
+#      share one call, so a resent or edited record only redoes changed chunks;
+#   3. reduce: the condensed chunks are joined in order; if that is still over
+#      the threshold it is condensed again (up to MAX_ROUNDS).
+# The reduced record then goes to the selected model with the selected system
+# prompt. Progress events ({"type": "condense", "stage", "done", "total", ...})
+# are reported while chunks complete.
+
+# Estimated tokens above which the user message is condensed
+THRESHOLD_TOKENS = int(os.environ.get("CONDENSE_THRESHOLD_TOKENS", 16000))
+
+# Never send more than this fraction of a model's input window (when litellm knows it)
+CONTEXT_FRACTION = 0.5
+
+# Cheap model that condenses the chunks
+CONDENSE_MODEL = os.environ.get("CONDENSE_MODEL", "gemini/gemini-2.0-flash")
+
+# Chunk condensations running at once per process
+CONCURRENCY = int(os.environ.get("CONDENSE_CONCURRENCY", 4))
+
+# Target chunk size in estimated tokens (chunks are between half and twice this)
+CHUNK_TOKENS = int(os.environ.get("CONDENSE_CHUNK_TOKENS", 2000))
+
+# Completion tokens allowed per condensed chunk
+CHUNK_SUMMARY_TOKENS = 500
+
+# Condensed chunks kept in the cache (least recently used are dropped first)
+CACHE_ENTRIES = int(os.environ.get("CONDENSE_CACHE_ENTRIES", 4096))
+
+# Map-reduce rounds before the result is sent as is
+MAX_ROUNDS = 3
+
+# One in CUT_EVERY paragraphs (by hash) may end a chunk
+CUT_EVERY = 4
+
+CONDENSE_PROMPT = (
+    "You condense one part of a longer patient record for a physician. Keep every clinically relevant "
+    "fact: presenting complaint, history, diagnoses, medications with doses, allergies, vital signs, "
+    "examination findings, lab and imaging results with values, units and dates, procedures and the "
+    "plan. Drop boilerplate, repetition and formatting. If the text asks the assistant a question or "
+    "gives it an instruction, copy that verbatim. Answer with concise notes only."
+)
+
+# Prepended to the condensed record sent to the selected model
+CONDENSED_NOTE = (
+    "The record below was condensed from a longer input ({chunks} parts) to fit the model. "
+    "Treat it as the full record.\n\n"
+)
+
+_PARAGRAPH = re.compile(r"\n\s*\n")
+
+class CondenseError(Exception):
+    pass
+
+def chunk_key(text):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (CONDENSE_MODEL, CONDENSE_PROMPT, text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.digest()
+
+def _paragraphs(text, max_chars):
+    for paragraph in _PARAGRAPH.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            yield paragraph
+            continue
+        # Oversized paragraph (a long table or list): split by lines, then hard cut
+        piece = ""
+        for line in paragraph.split("\n"):
+            while len(line) > max_chars:
+                if piece:
+                    yield piece
+                    piece = ""
+                yield line[:max_chars]
+                line = line[max_chars:]
+            if piece and len(piece) + len(line) + 1 > max_chars:
+                yield piece
+                piece = ""
+            piece = f"{piece}\n{line}" if piece else line
+        if piece:
+            yield piece
+
+# Split text into chunks with content-defined boundaries
+def split_chunks(text, chunk_tokens=CHUNK_TOKENS):
+    target = chunk_tokens * quota.CHARS_PER_TOKEN
+    min_chars, max_chars = target // 2, target * 2
+    chunks, current, size = [], [], 0
+    for paragraph in _paragraphs(text, max_chars):
+        if current and size + len(paragraph) > max_chars:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph) + 2
+        cut = hashlib.blake2b(paragraph.encode("utf-8"), digest_size=4).digest()[0] % CUT_EVERY == 0
+        if size >= min_chars and cut:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def progress_message(stage, done=0, total=0):
+    if stage == "map":
+        return f"Condensing a long input: {done} of {total} parts done"
+    if stage == "reduce":
+        return "Condensing the condensed parts again"
+    return "Long input condensed"
+
+class Condenser:
+    def __init__(self, completion_func=None, model=CONDENSE_MODEL, threshold_tokens=THRESHOLD_TOKENS,
+                 concurrency=CONCURRENCY, chunk_tokens=CHUNK_TOKENS, cache_entries=CACHE_ENTRIES):
+        self.completion_func = completion_func or providers.completion
+        self.model = model
+        self.threshold_tokens = threshold_tokens
+        self.chunk_tokens = chunk_tokens
+        self.cache_entries = cache_entries
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="condense")
+        self._cache = OrderedDict()
+        # chunk key -> [Future, requests waiting] of a condensation in progress (shared by concurrent requests)
+        self._inflight = {}
+        self._thresholds = {}
+        self._lock = threading.Lock()
+
+    # Token budget of the user message for a model
+    def threshold(self, model):
+        threshold = self._thresholds.get(model)
+        if threshold is not None:
+            return threshold
+        threshold = self.threshold_tokens
+        if not providers.is_loaded():
+            # No completion yet: don't import litellm just for the check (nor cache the result)
+            return threshold
+        try:
+            max_input = providers.get_litellm().get_model_info(model).get("max_input_tokens")
+        except Exception:
+            max_input = None
+        if max_input:
+            threshold = min(threshold, int(max_input * CONTEXT_FRACTION))
+        self._thresholds[model] = threshold
+        return threshold
+
+    def needs_condensing(self, text, model):
+        return quota.estimate_text_tokens(len(text)) > self.threshold(model)
+
+    def _condense_chunk(self, chunk, labels):
+        messages = [{"role": "system", "content": CONDENSE_PROMPT}, {"role": "user", "content": chunk}]
+        response = self.completion_func(
+            model=self.model, messages=messages, max_tokens=CHUNK_SUMMARY_TOKENS,
+            usage_labels={**(labels or {}), "kind": "condense"},
+        )
+        content = response.choices[0].message.content
+        if not content:
+            raise CondenseError("The condensing model returned no text")
+        return content.strip()
+
+    # (key, Future of the chunk's condensed text, whether it came from the cache)
+    def _submit(self, chunk, labels):
+        key = chunk_key(chunk)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(cached)
+                metrics.incr("condense_chunks", source="cache")
+                return key, future, True
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                inflight[1] += 1
+                metrics.incr("condense_chunks", source="shared")
+                return key, inflight[0], False
+            future = self._executor.submit(self._condense_chunk, chunk, labels)
+            self._inflight[key] = [future, 1]
+        metrics.incr("condense_chunks", source="model")
+        future.add_done_callback(lambda done: self._store(key, done))
+        return key, future, False
+
+    def _store(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._cache[key] = future.result()
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+
+    # A request stopped waiting: chunks no other request waits for are dropped if not started
+    def _release(self, submitted):
+        unwanted = []
+        with self._lock:
+            for key, future, _ in submitted:
+                inflight = self._inflight.get(key)
+                if inflight is not None and inflight[0] is future:
+                    inflight[1] -= 1
+                    if inflight[1] <= 0:
+                        unwanted.append(future)
+        # Outside the lock: cancel() runs the done callback (_store) in this thread
+        for future in unwanted:
+            future.cancel()
+
+    def _final(self, text, reduced, chunks, cached, rounds, started):
+        tokens_in = quota.estimate_text_tokens(len(text))
+        tokens_out = quota.estimate_text_tokens(len(reduced))
+        seconds = time.perf_counter() - started
+        metrics.observe("condense_seconds", seconds)
+        metrics.observe("condense_ratio", tokens_out / tokens_in if tokens_in else 1.0)
+        return {
+            "type": "condense", "stage": "done", "message": progress_message("done"), "chunks": chunks,
+            "cached": cached, "rounds": rounds, "tokens_in": tokens_in, "tokens_out": tokens_out,
+            "seconds": seconds, "text": CONDENSED_NOTE.format(chunks=chunks) + reduced,
+        }
+
+    # Condense text; async iterator of progress events, the last one ("done") carries
+    # the condensed text in "text". Unstarted chunks are dropped if the consumer stops.
+    async def condense_async(self, text, model, labels=None):
+        started = time.perf_counter()
+        current, total_chunks, total_cached = text, 0, 0
+        for round_number in range(1, MAX_ROUNDS + 1):
+            chunks = split_chunks(current, self.chunk_tokens)
+            submitted = [self._submit(chunk, labels) for chunk in chunks]
+            cached = sum(from_cache for _, _, from_cache in submitted)
+            total_chunks += len(chunks)
+            total_cached += cached
+            futures = [asyncio.wrap_future(future) for _, future, _ in submitted]
+            stage = "map" if round_number == 1 else "reduce"
+            done = sum(future.done() for future in futures)
+            yield {"type": "condense", "stage": stage, "message": progress_message(stage, done, len(chunks)),
+                   "round": round_number, "done": done, "total": len(chunks), "cached": cached}
+            try:
+                for next_done in asyncio.as_completed([f for f in futures if not f.done()]):
+                    await next_done
+                    done += 1
+                    yield {"type": "condense", "stage": stage, "message": progress_message(stage, done, len(chunks)),
+                           "round": round_number, "done": done, "total": len(chunks), "cached": cached}
+                parts = [future.result() for future in futures]
+            except BaseException as e:
+                # Request gone or failed: chunks not started yet are not needed
+                self._release(submitted)
+                if isinstance(e, Exception):
+                    raise CondenseError(f"Could not condense the input: {str(e)}") from e
+                raise
+            current = "\n\n".join(parts)
+            if not self.needs_condensing(current, model):
+                break
+        yield self._final(text, current, total_chunks, total_cached, round_number, started)
+
+    # Blocking version for the Dash and Streamlit apps; on_progress(event) is called
+    # as chunks complete. Returns the condensed text.
+    def condense(self, text, model, labels=None, on_progress=None):
+        started = time.perf_counter()
+        current, total_chunks, total_cached = text, 0, 0
+        for round_number in range(1, MAX_ROUNDS + 1):
+            chunks = split_chunks(current, self.chunk_tokens)
+            submitted = [self._submit(chunk, labels) for chunk in chunks]
+            cached = sum(from_cache for _, _, from_cache in submitted)
+            total_chunks += len(chunks)
+            total_cached += cached
+            stage = "map" if round_number == 1 else "reduce"
+            done = 0
+            try:
+                for future in as_completed([future for _, future, _ in submitted]):
+                    future.result()
+                    done += 1
+                    if on_progress is not None:
+                        on_progress({"type": "condense", "stage": stage,
+                                     "message": progress_message(stage, done, len(chunks)),
+                                     "round": round_number, "done": done, "total": len(chunks), "cached": cached})
+                parts = [future.result() for _, future, _ in submitted]
+            except Exception as e:
+                self._release(submitted)
+                raise CondenseError(f"Could not condense the input: {str(e)}") from e
+            current = "\n\n".join(parts)
+            if not self.needs_condensing(current, model):
+                break
+        final = self._final(text, current, total_chunks, total_cached, round_number, started)
+        if on_progress is not None:
+            on_progress({key: value for key, value in final.items() if key != "text"})
+        return final["text"]
+
+    def status(self):
+        with self._lock:
+            return {"cached_chunks": len(self._cache), "inflight_chunks": len(self._inflight)}
+
+# Process-wide condenser shared by the frontends of this process
+condenser = Condenser()
@@ -0,0 +1,86 @@
+import asyncio
+import warnings
+
+import drain
+from jobs import read_spool, is_valid_job_id
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # a2wsgi is optional; Starlette's (deprecated) adapter serves Dash the same way
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        from starlette.middleware.wsgi import WSGIMiddleware
+
+# Serving the Dash app inside the FastAPI process (app.py mounts it at DASH_MOUNT_PATH).
+#
+# Standalone, app_dash.py runs on Flask's dev server and calls the provider from
+# its callbacks. Mounted, its Flask server is served through a WSGI adapter
+# (callbacks run in the adapter's threads) and each Dash message becomes a
+# generation job of the FastAPI app (see jobs.py), started on the app's event
+# loop: it streams through the same engine threads (engine.py), drain, quota
+# scheduler, condense cache, ledger and job limit (MAX_ACTIVE_JOBS) as the page,
+# and the Dash interval poll only reads the job's content so far. In comparison
+# mode each ticked model gets its own job. The typing
+# signal warms the FastAPI app's pre-warmer, so a warm-up from either frontend
+# counts for both. Each mount builds its own Dash app (app_dash.create_dash_app),
+# so FastAPI apps created with different paths do not share one.
+
+# Seconds a Dash callback waits for the event loop to start its job
+START_TIMEOUT = 10
+
+# Generation backend handed to app_dash: starts messages as FastAPI generation jobs
+class JobBackend:
+    def __init__(self, registry):
+        self.registry = registry
+        # Event loop of the FastAPI app, noted by the mount on each request
+        self.loop = None
+
+    async def _create(self, params):
+        return self.registry.create(params)
+
+    # Start a generation from a callback thread; returns its job id
+    def start(self, params):
+        if drain.controller.draining:
+            raise RuntimeError(str(drain.Draining()))
+        if self.loop is None:
+            raise RuntimeError("The generation engine is not running")
+        future = asyncio.run_coroutine_threadsafe(self._create(params), self.loop)
+        job = future.result(START_TIMEOUT)
+        if job is None:
+            raise RuntimeError("Too many generations in progress, please try again")
+        return job.id
+
+    # Cancel a job from a callback thread (only jobs of this worker can be cancelled)
+    def cancel(self, job_id):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.registry.cancel, job_id)
+
+    # {"status", "content", "error", "ttft", "duration"} of a job: from memory on the owning worker, else
+    # from its spool file (a poll may reach another worker); None if unknown
+    def poll(self, job_id):
+        job = self.registry.get(job_id)
+        if job is not None:
+            return job.summary()
+        return read_spool(job_id) if is_valid_job_id(job_id) else None
+
+# ASGI app serving Dash's Flask server, noting the running event loop for the backend
+class DashMount:
+    def __init__(self, wsgi_app, backend):
+        self.wsgi = WSGIMiddleware(wsgi_app)
+        self.backend = backend
+
+    async def __call__(self, scope, receive, send):
+        self.backend.loop = asyncio.get_running_loop()
+        await self.wsgi(scope, receive, send)
+
+# Mount the Dash app at `path` of a FastAPI app, generating through `registry` (a
+# JobRegistry) and warming `prewarmer`; returns the Dash app
+def mount(fastapi_app, path, registry, prewarmer):
+    import app_dash
+
+    path = "/" + path.strip("/")
+    backend = JobBackend(registry)
+    # The browser requests /dash/...; the mount strips the prefix before Flask routes it
+    dash_app = app_dash.create_dash_app(path + "/", backend, prewarmer)
+    fastapi_app.mount(path, DashMount(dash_app.server, backend))
+    return dash_app
@@ -0,0 +1,203 @@
+import re
+
+# Incremental parser for differential-diagnosis answers (prompt1).
+#
+# prompt1 asks for "Most likely", "Can't Miss" and "Broader Differential"
+# sections, a comparison table, additional diagnostic steps and a single most
+# helpful next step. DifferentialParser runs on the token stream in one pass:
+# feed() buffers text until a line is complete, classifies each line once and
+# returns the structured events it completes, so downstream systems can act on
+# partial results while the answer is still streaming, at linear cost.
+#
+# Events (dicts with a "type"):
+#   {"type": "section", "section": "most_likely", "title": "Most Likely"}
+#   {"type": "diagnosis", "section": "cant_miss", "index": 0, "name": "Aortic dissection", "detail": "..."}
+#   {"type": "table_row", "table": 0, "index": 0, "cells": [...], "row": {"Diagnosis": "...", ...}}
+#   {"type": "step", "index": 0, "text": "CT angiography of the chest"}
+#   {"type": "next_step", "text": "..."}          # when the summary section ends
+# The first row of each table is its header; "table" is the table's position in the
+# answer and "index" the row's position in its table.
+# result() returns everything parsed so far as one JSON-serialisable dict ("table" is
+# the first table, normally the comparison table; "tables" holds all of them).
+
+# Section ids by heading keywords, checked in order (normalised lower-case heading text).
+# The prompt's own "additional diagnostic steps that would be most helpful" heading must
+# not become the next step, so only the unambiguous next-step keywords come before it.
+SECTION_KEYWORDS = (
+    ("cant_miss", ("can't miss", "cant miss", "cannot miss", "can not miss", "must not miss", "don't miss")),
+    ("most_likely", ("most likely",)),
+    ("broader", ("broader", "broad differential", "other diagnoses", "other considerations")),
+    ("comparison_table", ("table", "comparison", "compare")),
+    ("next_step", ("single most", "next diagnostic step")),
+    ("diagnostic_steps", ("diagnostic step", "additional diagnostic", "further workup", "work-up", "workup", "diagnostic test")),
+    ("next_step", ("most helpful", "next step", "summary")),
+)
+
+# Sections whose list items are diagnoses
+DIAGNOSIS_SECTIONS = ("most_likely", "cant_miss", "broader")
+
+_HEADING = re.compile(r"^\s*#{1,6}\s+(.+?)\s*#*\s*$")
+_BOLD_LINE = re.compile(r"^\s*(?:\d+[.)]\s*)?(\*\*|__)(.+?)\1\s*:?\s*$")
+_COLON_LINE = re.compile(r"^\s*(?:\d+[.)]\s*)?([A-Z][^:|]{2,60}):\s*$")
+_LIST_ITEM = re.compile(r"^(\s*)(?:[-*+•]|\d+[.)])\s+(.*)$")
+_TABLE_SEPARATOR = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?\s*$")
+_EMPHASIS = re.compile(r"(\*\*|__|\*|_|`)(.+?)\1")
+_NAME_SPLIT = re.compile(r"\s*(?::|\s[-–—]\s)\s*")
+
+def normalize_heading(text):
+    return _EMPHASIS.sub(r"\2", text).replace("’", "'").strip().rstrip(":").strip()
+
+def section_id(title):
+    lowered = title.lower()
+    for section, keywords in SECTION_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            return section
+    return None
+
+def strip_emphasis(text):
+    return _EMPHASIS.sub(r"\2", text).strip()
+
+# Split a diagnosis list item into its name and detail
+def split_item(text):
+    bold = re.match(r"^(\*\*|__)(.+?)\1\s*:?\s*(.*)$", text)
+    if bold:
+        name, detail = bold.group(2), bold.group(3)
+        detail = re.sub(r"^[-–—:]\s*", "", detail)
+    else:
+        parts = _NAME_SPLIT.split(text, maxsplit=1)
+        name, detail = parts[0], parts[1] if len(parts) > 1 else ""
+    return strip_emphasis(name).rstrip(":"), strip_emphasis(detail)
+
+def split_cells(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [strip_emphasis(cell) for cell in line.split("|")]
+
+def _copy_table(table):
+    return {"header": list(table["header"]), "rows": list(table["rows"])}
+
+class DifferentialParser:
+    def __init__(self):
+        self._pending = []
+        self.section = None
+        self.sections = []
+        self.diagnoses = {section: [] for section in DIAGNOSIS_SECTIONS}
+        self.tables = []
+        self.steps = []
+        self.next_step_lines = []
+        self.next_step = None
+        self._in_table = False
+
+    # Parse the next piece of the stream; returns the events completed by it
+    def feed(self, text):
+        events = []
+        if "\n" not in text:
+            # Keep partial lines as parts, so a long line is joined once
+            self._pending.append(text)
+            return events
+        self._pending.append(text)
+        lines = "".join(self._pending).split("\n")
+        self._pending = [lines.pop()]
+        for line in lines:
+            self._line(line, events)
+        return events
+
+    # Parse the rest of the stream (no more text will come)
+    def close(self):
+        events = []
+        line, self._pending = "".join(self._pending), []
+        self._line(line, events)
+        self._end_section(events)
+        return events
+
+    def _line(self, line, events):
+        stripped = line.strip()
+        if not stripped:
+            return
+        if stripped.startswith("|"):
+            self._table_line(stripped, events)
+            return
+        self._in_table = False
+
+        title = self._heading(line)
+        if title is not None:
+            section = section_id(title)
+            if section is not None or self.section is None or not _LIST_ITEM.match(line):
+                self._start_section(section or "other", title, events)
+                return
+
+        item = _LIST_ITEM.match(line)
+        if self.section in DIAGNOSIS_SECTIONS:
+            if item and len(item.group(1).expandtabs()) < 2:
+                name, detail = split_item(item.group(2))
+                diagnoses = self.diagnoses[self.section]
+                diagnosis = {"name": name, "detail": detail}
+                diagnoses.append(diagnosis)
+                events.append({
+                    "type": "diagnosis", "section": self.section, "index": len(diagnoses) - 1, **diagnosis,
+                })
+            elif self.diagnoses[self.section]:
+                # Sub-bullets and continuation lines add to the previous diagnosis
+                diagnosis = self.diagnoses[self.section][-1]
+                extra = strip_emphasis(item.group(2) if item else stripped)
+                diagnosis["detail"] = f"{diagnosis['detail']} {extra}".strip()
+        elif self.section == "diagnostic_steps" and item:
+            text = strip_emphasis(item.group(2))
+            self.steps.append(text)
+            events.append({"type": "step", "index": len(self.steps) - 1, "text": text})
+        elif self.section == "next_step":
+            self.next_step_lines.append(strip_emphasis(item.group(2) if item else stripped))
+
+    def _heading(self, line):
+        for pattern, group in ((_HEADING, 1), (_BOLD_LINE, 2), (_COLON_LINE, 1)):
+            match = pattern.match(line)
+            if match:
+                return normalize_heading(match.group(group))
+        return None
+
+    def _start_section(self, section, title, events):
+        self._end_section(events)
+        self.section = section
+        self.sections.append({"section": section, "title": title})
+        events.append({"type": "section", "section": section, "title": title})
+
+    def _end_section(self, events):
+        if self.section == "next_step" and self.next_step_lines and self.next_step is None:
+            self.next_step = " ".join(self.next_step_lines)
+            events.append({"type": "next_step", "text": self.next_step})
+
+    def _table_line(self, line, events):
+        if _TABLE_SEPARATOR.match(line):
+            return
+        cells = split_cells(line)
+        if not self._in_table:
+            # First row of a new table is its header
+            self._in_table = True
+            self.tables.append({"header": cells, "rows": []})
+            return
+        table = self.tables[-1]
+        table["rows"].append(cells)
+        events.append({
+            "type": "table_row", "table": len(self.tables) - 1, "index": len(table["rows"]) - 1,
+            "cells": cells, "row": dict(zip(table["header"], cells)),
+        })
+
+    def result(self):
+        return {
+            "sections": list(self.sections),
+            "diagnoses": {section: list(items) for section, items in self.diagnoses.items()},
+            "table": _copy_table(self.tables[0]) if self.tables else {"header": [], "rows": []},
+            "tables": [_copy_table(table) for table in self.tables],
+            "diagnostic_steps": list(self.steps),
+            "next_step": self.next_step if self.next_step is not None else (" ".join(self.next_step_lines) or None),
+        }
+
+# Parse a complete answer in one call
+def parse_differential(text):
+    parser = DifferentialParser()
+    parser.feed(text)
+    parser.close()
+    return parser.result()
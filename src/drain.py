@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import os
+import time
+
+import metrics
+
+# Graceful drain of in-flight generations when a worker shuts down (deploys,
+# restarts, reloads).
+#
+# Every generation registers itself here while it condenses and streams
+# (generate_deltas in app.py). When the worker receives SIGTERM, serve.py stops
+# listening and calls drain() before uvicorn closes the remaining connections:
+#   1. new generations are refused (503 with Retry-After, or a WebSocket error
+#      frame), so clients retry on another worker or the new deploy;
+#   2. in-flight generations (/stream, /chat, WebSocket, /generations) get until
+#      DRAIN_TIMEOUT to finish normally;
+#   3. generations still running at the deadline are interrupted: they end with
+#      status "interrupted" and their partial output is sent to the client and
+#      persisted (journal response record, and the job spool for /generations),
+#      so it can be shown or resumed instead of being lost.
+# Drain duration and outcome counts are recorded as metrics.
+
+# Seconds in-flight generations get to finish after shutdown starts. Keep this
+# below the platform's kill timeout (Render sends SIGKILL 30 seconds after SIGTERM).
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))
+
+# Seconds interrupted generations get to send their final event and persist
+INTERRUPT_GRACE = 2.0
+
+# Seconds between checks while waiting for in-flight generations
+DRAIN_POLL_INTERVAL = 0.05
+
+# Raised to a new generation while the worker is draining
+class Draining(Exception):
+    def __init__(self):
+        super().__init__("The server is restarting, please try again")
+
+# Raised inside a generation cut off at the drain deadline
+# (content is set to the partial output by the generation)
+class GenerationInterrupted(Exception):
+    def __init__(self):
+        super().__init__("The server restarted before the response was complete")
+        self.content = ""
+
+class InFlight:
+    __slots__ = ("id", "frontend", "model", "started", "_interrupt")
+
+    def __init__(self, generation_id, frontend, model):
+        self.id = generation_id
+        self.frontend = frontend
+        self.model = model
+        self.started = time.monotonic()
+        self._interrupt = None
+
+    # interrupt(exception) raises the exception in the generation's stream
+    # (see engine.stream_deltas, and engine.interruptible_events while condensing)
+    def bind(self, interrupt):
+        self._interrupt = interrupt
+
+    def interrupt(self):
+        if self._interrupt is not None:
+            self._interrupt(GenerationInterrupted())
+
+class DrainController:
+    def __init__(self):
+        self.draining = False
+        self.drain_started = None
+        self._inflight = {}
+        self._ids = itertools.count(1)
+
+    def inflight_count(self):
+        return len(self._inflight)
+
+    # Register a generation until unregister(); raises Draining once shutdown has started
+    def register(self, frontend, model):
+        if self.draining:
+            metrics.incr("drain_rejected", frontend=frontend)
+            raise Draining()
+        inflight = InFlight(next(self._ids), frontend, model)
+        self._inflight[inflight.id] = inflight
+        return inflight
+
+    def unregister(self, inflight):
+        self._inflight.pop(inflight.id, None)
+
+    async def _wait_idle(self, deadline):
+        while self._inflight and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        return not self._inflight
+
+    # Stop accepting generations, wait for in-flight ones until the deadline, then
+    # interrupt the rest; returns a summary of the drain
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        self.draining = True
+        self.drain_started = time.monotonic()
+        inflight_at_start = len(self._inflight)
+        await self._wait_idle(self.drain_started + timeout)
+
+        interrupted = list(self._inflight.values())
+        for inflight in interrupted:
+            inflight.interrupt()
+        if interrupted:
+            await self._wait_idle(time.monotonic() + INTERRUPT_GRACE)
+
+        duration = time.monotonic() - self.drain_started
+        summary = {
+            "duration": duration,
+            "inflight": inflight_at_start,
+            "completed": inflight_at_start - len(interrupted),
+            "interrupted": len(interrupted),
+            "abandoned": len(self._inflight),
+        }
+        metrics.observe("drain_seconds", duration)
+        metrics.incr("drain_completed", summary["completed"])
+        metrics.incr("drain_interrupted", summary["interrupted"])
+        return summary
+
+    def status(self):
+        return {
+            "draining": self.draining,
+            "inflight": len(self._inflight),
+            "drain_elapsed": time.monotonic() - self.drain_started if self.drain_started is not None else None,
+        }
+
+# Per-process controller (each worker drains its own generations)
+controller = DrainController()
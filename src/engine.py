@@ -0,0 +1,104 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import providers
+
+# Async streaming engine for the FastAPI app.
+#
+# litellm's sync streaming iterator blocks, so iterating it inside a coroutine
+# stalls every other request on the worker. stream_deltas() runs the blocking
+# stream in a dedicated thread pool and hands content deltas to the event loop,
+# so many generations can stream concurrently and each one can be cancelled:
+# closing the async iterator (or cancelling the task consuming it) stops the
+# producer thread at the next chunk.
+
+# Maximum generations streaming at once per worker (one thread each)
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("MAX_CONCURRENT_GENERATIONS", 64))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_GENERATIONS, thread_name_prefix="generation")
+
+# Sentinel marking the end of a stream on the queue
+_DONE = object()
+
+# Text content of a litellm stream chunk (None if it carries no content)
+def chunk_content(chunk):
+    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+        delta = chunk.choices[0].delta
+        if hasattr(delta, 'content') and delta.content:
+            return delta.content
+    return None
+
+# Run a blocking completion stream in the thread pool and yield its content deltas.
+# If given, interruptible.bind(interrupt) receives a function that makes the stream
+# raise the exception passed to it (used to cut generations off on shutdown, see drain.py)
+async def stream_deltas(model_name, messages, completion_func=None, interruptible=None, **kwargs):
+    completion_func = completion_func or providers.completion
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    if interruptible is not None:
+        interruptible.bind(queue.put_nowait)
+
+    def emit(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed (worker shutting down)
+            stop.set()
+
+    def produce():
+        try:
+            response_stream = completion_func(model=model_name, messages=messages, stream=True, **kwargs)
+            for chunk in response_stream:
+                if stop.is_set():
+                    break
+                content = chunk_content(chunk)
+                if content:
+                    emit(content)
+            emit(_DONE)
+        except BaseException as e:
+            emit(e)
+
+    future = loop.run_in_executor(_executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Consumer went away (finished, cancelled or closed): stop the producer thread
+        stop.set()
+        if future.done() and not future.cancelled():
+            future.exception()
+
+# Iterate an async generator (e.g. condense.Condenser.condense_async) so that it can
+# be cut off like stream_deltas: interruptible.bind(interrupt) receives a function that
+# stops the iteration (closing the generator) and makes it raise the exception passed to it
+async def interruptible_events(events, interruptible):
+    interrupted = asyncio.get_running_loop().create_future()
+
+    def interrupt(exception):
+        if not interrupted.done():
+            interrupted.set_exception(exception)
+
+    interruptible.bind(interrupt)
+    try:
+        while True:
+            step = asyncio.ensure_future(events.__anext__())
+            await asyncio.wait((step, interrupted), return_when=asyncio.FIRST_COMPLETED)
+            if interrupted.done():
+                step.cancel()
+                await asyncio.gather(step, return_exceptions=True)
+                interrupted.result()
+            try:
+                event = step.result()
+            except StopAsyncIteration:
+                break
+            yield event
+    finally:
+        await events.aclose()
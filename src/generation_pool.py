@@ -0,0 +1,194 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from engine import chunk_content
+
+# Process-wide background generation pool for the Streamlit app.
+#
+# Streamlit runs each session's script in its own thread, so streaming a
+# completion inside the script blocks that session's UI for the whole answer.
+# Instead, sessions submit() a generation here and poll its snapshot() from a
+# fragment that re-runs on a timer, so only the answer area re-renders while the
+# rest of the page stays interactive. All sessions share one pool (created once
+# per process via st.cache_resource), which caps the generations running at once
+# across the whole server; further submissions wait in FIFO order, up to
+# MAX_QUEUED, and are refused beyond that.
+
+# Generations running at once across all Streamlit sessions of the process
+MAX_GENERATIONS = int(os.environ.get("STREAMLIT_MAX_GENERATIONS", 8))
+
+# Generations allowed to wait for a free slot
+MAX_QUEUED = int(os.environ.get("STREAMLIT_MAX_QUEUED", 64))
+
+# Seconds finished generations stay available for polling
+TASK_TTL = 600
+
+class GenerationTask:
+    __slots__ = (
+        "id", "session_key", "model", "messages", "content", "status", "error",
+        "submitted", "started", "finished_at", "ttft", "stop", "on_finish", "usage_labels", "progress",
+    )
+
+    def __init__(self, task_id, session_key, model, messages, on_finish, usage_labels=None):
+        self.id = task_id
+        self.session_key = session_key
+        self.model = model
+        self.messages = messages
+        self.content = ""
+        self.status = "queued"
+        self.error = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished_at = None
+        self.ttft = None
+        self.stop = threading.Event()
+        self.on_finish = on_finish
+        self.usage_labels = usage_labels
+        self.progress = None
+
+    # Set once on_finish has run, so pollers see the final state everywhere
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "content": self.content,
+            "error": self.error,
+            "ttft": self.ttft,
+            "progress": self.progress,
+        }
+
+class GenerationPool:
+    # on_finish(task) passed to submit() is called from the worker thread when the task stops.
+    # With a condenser, oversized last messages are condensed first (see condense.py).
+    def __init__(self, completion_func, max_generations=MAX_GENERATIONS, max_queued=MAX_QUEUED, condenser=None):
+        self.completion_func = completion_func
+        self.condenser = condenser
+        self.max_generations = max_generations
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_generations, thread_name_prefix="streamlit-generation")
+        self._tasks = OrderedDict()
+        self._active_by_session = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # Queue a generation for a session; returns the task, the session's unfinished task
+    # if it already has one, or None if the queue is full (usage_labels label the ledger record)
+    def submit(self, session_key, model, messages, on_finish=None, usage_labels=None):
+        with self._lock:
+            self._sweep()
+            active = self._tasks.get(self._active_by_session.get(session_key))
+            if active is not None and not active.finished:
+                return active
+            if self._count("queued") >= self.max_queued:
+                metrics.incr("streamlit_generations", status="rejected")
+                return None
+            task = GenerationTask(str(next(self._ids)), session_key, model, messages, on_finish, usage_labels)
+            self._tasks[task.id] = task
+            self._active_by_session[session_key] = task.id
+        self._executor.submit(self._run, task)
+        metrics.incr("streamlit_generations", status="submitted")
+        return task
+
+    def _run(self, task):
+        if task.stop.is_set():
+            self._finish(task, "cancelled")
+            return
+        task.started = time.monotonic()
+        metrics.observe("streamlit_queue_seconds", task.started - task.submitted)
+        try:
+            messages = self._condensed(task)
+            if task.stop.is_set():
+                self._finish(task, "cancelled")
+                return
+            task.status = "streaming"
+            chunks = self.completion_func(
+                model=task.model, messages=messages, stream=True, usage_labels=task.usage_labels
+            )
+            for chunk in chunks:
+                if task.stop.is_set():
+                    break
+                content = chunk_content(chunk)
+                if content:
+                    if task.ttft is None:
+                        task.ttft = time.monotonic() - task.started
+                        metrics.observe("ttft_seconds", task.ttft, model=task.model, warmed=False, frontend="streamlit")
+                    task.content += content
+            self._finish(task, "cancelled" if task.stop.is_set() else "complete")
+        except Exception as e:
+            self._finish(task, "error", f"Error: {str(e)}")
+
+    # The task's messages, with an oversized last message condensed (status "condensing"
+    # meanwhile, with the progress text in task.progress)
+    def _condensed(self, task):
+        text = task.messages[-1]["content"]
+        if self.condenser is None or not self.condenser.needs_condensing(text, task.model):
+            return task.messages
+        task.status = "condensing"
+
+        def on_progress(event):
+            task.progress = event["message"]
+
+        condensed = self.condenser.condense(text, task.model, task.usage_labels, on_progress)
+        return task.messages[:-1] + [{**task.messages[-1], "content": condensed}]
+
+    def _finish(self, task, status, error=None):
+        task.status = status
+        task.error = error
+        metrics.incr("streamlit_generations", status=status)
+        try:
+            if task.on_finish is not None:
+                task.on_finish(task)
+        finally:
+            task.finished_at = time.monotonic()
+
+    def get(self, task_id):
+        with self._lock:
+            return self._tasks.get(task_id)
+
+    # Stop a generation (a queued one is dropped when its turn comes)
+    def cancel(self, task_id):
+        task = self.get(task_id)
+        if task is None or task.finished:
+            return False
+        task.stop.set()
+        return True
+
+    # Generations queued ahead of a task (0 once it is running)
+    def queue_position(self, task_id):
+        with self._lock:
+            position = 0
+            for other_id, task in self._tasks.items():
+                if other_id == task_id:
+                    return position if task.status == "queued" else 0
+                if task.status == "queued":
+                    position += 1
+        return 0
+
+    def _count(self, status):
+        return sum(1 for task in self._tasks.values() if task.status == status)
+
+    # Drop finished tasks older than TASK_TTL
+    def _sweep(self):
+        now = time.monotonic()
+        for task_id, task in list(self._tasks.items()):
+            if task.finished and now - task.finished_at > TASK_TTL:
+                del self._tasks[task_id]
+                if self._active_by_session.get(task.session_key) == task_id:
+                    del self._active_by_session[task.session_key]
+
+    def status(self):
+        with self._lock:
+            return {
+                "max_generations": self.max_generations,
+                "streaming": self._count("streaming") + self._count("condensing"),
+                "queued": self._count("queued"),
+            }
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import os
+import secrets
+import tempfile
+import time
+from collections import deque
+
+import metrics
+from drain import GenerationInterrupted
+
+# Two-phase streaming jobs: POST /generations creates a job, GET
+# /generations/{id}/events streams it as SSE with event ids.
+#
+# A job runs as a task on the worker that created it, independent of any client
+# connection. Deltas go into a bounded in-memory buffer (for subscribers on the
+# same worker) and are appended to a spool file, one JSON line per event. A
+# client that reconnects with Last-Event-ID resumes after that event without
+# re-requesting anything upstream:
+#   - on the owning worker from the buffer (or a snapshot of the full content if
+#     the requested event has already left the buffer),
+#   - on any other worker (all workers accept on the same socket) by tailing the
+#     spool file.
+# Spool files hold the answer but not the message (the header only names the job
+# and its worker), are private to the server user (0600 in a 0700 directory) and
+# are written in batches off the event loop. A finished job and its spool file
+# are removed JOB_TTL seconds after it finished; files left by other processes
+# are swept by age. A reader tailing a spool file gives up when the owner has
+# exited, the file was removed or nothing was written for SPOOL_STALE_SECONDS.
+#
+# While an oversized message is condensed (see condense.py), the job also records
+# the condensing progress; it is sent as "progress" events until the answer starts
+# and the latest one is part of the job summary.
+
+# Delta events kept in memory per job
+JOB_BUFFER_EVENTS = int(os.environ.get("JOB_BUFFER_EVENTS", 512))
+
+# Seconds finished jobs (and their spool files) stay available for resume
+JOB_TTL = float(os.environ.get("JOB_TTL", 600))
+
+# Running jobs allowed per worker
+MAX_ACTIVE_JOBS = int(os.environ.get("MAX_ACTIVE_JOBS", 200))
+
+# Directory shared by the workers for spool files
+SPOOL_DIR = os.environ.get("GENERATIONS_DIR", os.path.join(tempfile.gettempdir(), "medical-ai-generations"))
+
+# Seconds between polls when tailing another worker's spool file
+SPOOL_POLL_INTERVAL = 0.05
+
+# Seconds without new spool events after which a reader on another worker stops waiting
+SPOOL_STALE_SECONDS = float(os.environ.get("SPOOL_STALE_SECONDS", 300))
+
+# Seconds between sweeps of the spool directory for files of other processes
+SPOOL_SWEEP_INTERVAL = 60
+
+# Job ids are URL-safe random tokens (also used as spool file names)
+def new_job_id():
+    return secrets.token_urlsafe(16)
+
+def is_valid_job_id(job_id):
+    return 0 < len(job_id) <= 64 and all(c.isalnum() or c in "-_" for c in job_id)
+
+def spool_path(job_id):
+    return os.path.join(SPOOL_DIR, f"{job_id}.jsonl")
+
+# Create the spool directory readable by the server user only
+def _private_spool_dir():
+    os.makedirs(SPOOL_DIR, mode=0o700, exist_ok=True)
+    if os.stat(SPOOL_DIR).st_mode & 0o077:
+        os.chmod(SPOOL_DIR, 0o700)
+
+def _remove_spool(job_id):
+    try:
+        os.remove(spool_path(job_id))
+    except OSError:
+        pass
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class GenerationJob:
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.status = "running"
+        self.error = None
+        self.content = ""
+        # Latest condensing progress event, and how many there were
+        self.progress = None
+        self.progress_count = 0
+        self.last_event_id = 0
+        # (event id, delta text)
+        self.buffer = deque(maxlen=JOB_BUFFER_EVENTS)
+        self.created_at = time.time()
+        self.first_text_at = None
+        self.finished_at = None
+        self.task = None
+        self.changed = asyncio.Condition()
+        self._spool = None
+        # Spool lines not yet written, and the task writing them
+        self._pending = []
+        self._flusher = None
+
+    @property
+    def finished(self):
+        return self.status != "running"
+
+    # Write spool lines (in a worker thread, one batch at a time)
+    def _write_lines(self, lines):
+        try:
+            self._spool.write("".join(lines))
+            self._spool.flush()
+        except OSError:
+            self._spool.close()
+            self._spool = None
+
+    # Queue a spool record; a single task writes queued records in order, off the event loop
+    def _queue_spool(self, record):
+        if self._spool is None:
+            return
+        self._pending.append(json.dumps(record) + "\n")
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._pending and self._spool is not None:
+                lines, self._pending = self._pending, []
+                await asyncio.to_thread(self._write_lines, lines)
+        finally:
+            self._flusher = None
+
+    def open_spool(self):
+        try:
+            _private_spool_dir()
+            fd = os.open(spool_path(self.id), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            self._spool = open(fd, "w", encoding="utf-8")
+        except OSError:
+            self._spool = None
+            return
+        # Written before the job id is handed out, so other workers can always read it
+        self._write_lines([json.dumps({"job": self.id, "pid": os.getpid(), "created_at": self.created_at}) + "\n"])
+
+    async def set_progress(self, event):
+        self.progress = event
+        self.progress_count += 1
+        self._queue_spool({"progress": event})
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def append(self, text):
+        if self.first_text_at is None:
+            self.first_text_at = time.time()
+        self.last_event_id += 1
+        self.content += text
+        self.buffer.append((self.last_event_id, text))
+        self._queue_spool({"id": self.last_event_id, "text": text})
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self._queue_spool({"done": status, "error": error})
+        if self._flusher is not None:
+            await self._flusher
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        async with self.changed:
+            self.changed.notify_all()
+
+    # Events after last_event_id: ("progress", None, event), ("delta", id, text), ("snapshot", id,
+    # content), ("done", status, error); progress only until the answer starts
+    async def events(self, last_event_id=0):
+        cursor = last_event_id
+        progress_seen = 0
+        while True:
+            if self.progress_count > progress_seen:
+                progress_seen = self.progress_count
+                if not self.last_event_id:
+                    yield ("progress", None, self.progress)
+            if self.buffer and cursor < self.buffer[0][0] - 1:
+                # The client is behind the buffer: send everything so far in one snapshot
+                cursor = self.last_event_id
+                yield ("snapshot", cursor, self.content)
+            elif self.buffer:
+                first_id = self.buffer[0][0]
+                for event_id, text in list(self.buffer)[max(0, cursor - first_id + 1):]:
+                    cursor = event_id
+                    yield ("delta", event_id, text)
+            if self.finished and cursor >= self.last_event_id:
+                yield ("done", self.status, self.error)
+                return
+            async with self.changed:
+                await self.changed.wait_for(
+                    lambda: self.last_event_id > cursor or self.finished or self.progress_count > progress_seen
+                )
+
+    # Status and content so far; ttft and duration are seconds since the job was created
+    # (None until its first text / until it finished)
+    def summary(self):
+        return {
+            "id": self.id, "status": self.status, "content": self.content, "error": self.error, "progress": self.progress,
+            "ttft": self.first_text_at - self.created_at if self.first_text_at is not None else None,
+            "duration": self.finished_at - self.created_at if self.finished_at is not None else None,
+        }
+
+# Open a spool file and read its header (blocking; None if the file is gone)
+def _open_spool(job_id):
+    try:
+        f = open(spool_path(job_id), encoding="utf-8")
+    except FileNotFoundError:
+        return None
+    try:
+        return f, json.loads(f.readline() or "{}")
+    except BaseException:
+        f.close()
+        raise
+
+# Text written to an open spool file since the last read, and whether the file still exists (blocking)
+def _poll_spool(f):
+    return f.read(), os.fstat(f.fileno()).st_nlink > 0
+
+# Events of a job owned by another worker (or a previous process), read from its spool
+# file; the file reads run in threads so a slow disk does not stall the event loop
+async def spool_events(job_id, last_event_id=0):
+    opened = await asyncio.to_thread(_open_spool, job_id)
+    if opened is None:
+        yield ("done", "interrupted", "The generation is no longer available")
+        return
+    f, header = opened
+    try:
+        owner_pid = header.get("pid")
+        buffered = ""
+        last_write = time.monotonic()
+        while True:
+            text, linked = await asyncio.to_thread(_poll_spool, f)
+            lines = []
+            if text:
+                last_write = time.monotonic()
+                lines = (buffered + text).split("\n")
+                buffered = lines.pop()
+            for line in lines:
+                record = json.loads(line)
+                if "done" in record:
+                    yield ("done", record["done"], record.get("error"))
+                    return
+                if "progress" in record:
+                    if not last_event_id:
+                        yield ("progress", None, record["progress"])
+                    continue
+                if record["id"] > last_event_id:
+                    yield ("delta", record["id"], record["text"])
+            if lines:
+                continue
+            # No complete line: wait for the owner to write more
+            if owner_pid is not None and not _process_alive(owner_pid):
+                yield ("done", "interrupted", "The generation was interrupted")
+                return
+            if not linked:
+                yield ("done", "interrupted", "The generation is no longer available")
+                return
+            if time.monotonic() - last_write > SPOOL_STALE_SECONDS:
+                yield ("done", "interrupted", "The generation stopped responding")
+                return
+            await asyncio.sleep(SPOOL_POLL_INTERVAL)
+    finally:
+        f.close()
+
+# Status and content of a spooled job (None if unknown); blocking, async callers run it in a thread
+def read_spool(job_id):
+    try:
+        with open(spool_path(job_id), encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    header = json.loads(lines[0]) if lines else {}
+    # Spool records carry no timestamps
+    summary = {
+        "id": job_id, "status": "running", "content": "", "error": None, "progress": None, "ttft": None, "duration": None,
+    }
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        if "done" in record:
+            summary["status"] = record["done"]
+            summary["error"] = record.get("error")
+        elif "progress" in record:
+            summary["progress"] = record["progress"]
+        else:
+            summary["content"] += record["text"]
+    if summary["status"] == "running" and not _process_alive(header.get("pid", -1)):
+        summary["status"] = "interrupted"
+    return summary
+
+class JobRegistry:
+    # generate(user_message, model_name, prompt_name, session_id, progress=True, attachments=..., frontend=...)
+    # -> async iterator of text deltas and condensing progress events (dicts)
+    def __init__(self, generate):
+        self.generate = generate
+        self.jobs = {}
+        self._next_spool_sweep = 0
+
+    def active_count(self):
+        return sum(1 for job in self.jobs.values() if not job.finished)
+
+    # Create a job and start generating in the background (None if the worker is at capacity)
+    def create(self, params):
+        self.sweep()
+        if self.active_count() >= MAX_ACTIVE_JOBS:
+            return None
+        job = GenerationJob(new_job_id(), params)
+        job.open_spool()
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job))
+        metrics.incr("generation_jobs", status="created")
+        return job
+
+    async def _run(self, job):
+        params = job.params
+        try:
+            async for delta in self.generate(
+                params["user_message"], params["model_name"], params["prompt_name"], params.get("session_id"),
+                progress=True, attachments=params.get("attachments"), frontend=params.get("frontend") or "fastapi",
+            ):
+                if isinstance(delta, dict):
+                    await job.set_progress(delta)
+                else:
+                    await job.append(delta)
+        except asyncio.CancelledError:
+            await job.finish("cancelled")
+        except GenerationInterrupted as e:
+            # Worker shutting down: the content so far stays in the spool file
+            await job.finish("interrupted", str(e))
+        except Exception as e:
+            await job.finish("error", f"Error: {str(e)}")
+        else:
+            await job.finish("complete")
+        metrics.incr("generation_jobs", status=job.status)
+        asyncio.get_running_loop().call_later(JOB_TTL, self._reap, job.id)
+
+    # Forget a finished job and remove its spool file (JOB_TTL after it finished)
+    def _reap(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and job.finished:
+            del self.jobs[job_id]
+            asyncio.get_running_loop().run_in_executor(None, _remove_spool, job_id)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.task.cancel()
+        return True
+
+    # Drop finished jobs older than JOB_TTL; every SPOOL_SWEEP_INTERVAL, also remove spool
+    # files older than that (left by other or previous processes) in a worker thread
+    def sweep(self):
+        now = time.time()
+        loop = asyncio.get_running_loop()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished_at > JOB_TTL:
+                del self.jobs[job_id]
+                loop.run_in_executor(None, _remove_spool, job_id)
+        if time.monotonic() >= self._next_spool_sweep:
+            self._next_spool_sweep = time.monotonic() + SPOOL_SWEEP_INTERVAL
+            loop.run_in_executor(None, _sweep_spool_dir)
+
+# Remove spool files last written more than JOB_TTL ago
+def _sweep_spool_dir():
+    now = time.time()
+    try:
+        names = os.listdir(SPOOL_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_TTL:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,659 @@
+import atexit
+import bisect
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+
+import metrics
+
+# Append-only conversation journal (requests and completed responses).
+#
+# Layout: JOURNAL_DIR/stream-N/ holds the segments of one writer process. Each
+# process claims a free stream with an exclusive flock, so prefork workers, Dash
+# and Streamlit never write the same files. A segment is a pair of files:
+#   <first seq>.log  records: [u32 length][u32 crc32][JSON payload]
+#   <first seq>.idx  fixed-size entries: seq, conversation hash, offset, length, kind
+#
+# append() only puts the record on a queue; a writer thread encodes the queued
+# records, writes them as one batch and fsyncs once per batch (group commit), then
+# appends the batch's index entries. Reads go through read-only mmaps of the
+# segments: read_view() returns a memoryview of the payload without copying, and
+# an in-memory conversation -> seq index (integers only) serves history lookups.
+# A record becomes readable once its batch is written (typically within one fsync).
+#
+# When the active segment reaches SEGMENT_BYTES it is sealed and a new one
+# started. On rotation the writer applies retention (RETENTION_DAYS / MAX_BYTES,
+# oldest sealed segments first) and compaction: adjacent small sealed segments
+# are merged, and records of forgotten conversations (forget()) are dropped.
+#
+# Records hold full patient messages and answers: the directories are created (or
+# tightened to) 0700 and the files 0600.
+
+# Set JOURNAL=0 to disable journaling
+ENABLED = os.environ.get("JOURNAL", "1") != "0"
+
+JOURNAL_DIR = os.environ.get(
+    "JOURNAL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "journal"),
+)
+
+# Size at which the active segment is sealed
+SEGMENT_BYTES = int(os.environ.get("JOURNAL_SEGMENT_BYTES", 64 * 1024 * 1024))
+
+# Set JOURNAL_FSYNC=0 to only flush to the OS page cache (faster, not crash safe)
+FSYNC = os.environ.get("JOURNAL_FSYNC", "1") != "0"
+
+# Sealed segments older than this many days are deleted (0 keeps everything)
+RETENTION_DAYS = float(os.environ.get("JOURNAL_RETENTION_DAYS", 0))
+
+# Oldest sealed segments are deleted while the journal is larger than this (0 = no limit)
+MAX_BYTES = int(os.environ.get("JOURNAL_MAX_BYTES", 0))
+
+# Records waiting for the writer; beyond this new records are dropped (and counted)
+MAX_PENDING = int(os.environ.get("JOURNAL_MAX_PENDING", 100000))
+
+RECORD_HEADER = struct.Struct("<II")
+INDEX_ENTRY = struct.Struct("<QQQII")
+
+KINDS = {"request": 1, "response": 2, "forget": 3}
+FORGET = KINDS["forget"]
+
+def conversation_hash(conversation_id):
+    if not conversation_id:
+        return 0
+    return int.from_bytes(hashlib.blake2b(conversation_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+def segment_name(first_seq):
+    return f"{first_seq:020d}"
+
+# Create a journal directory readable by the server user only
+def _private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.stat(path).st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+# Open a journal file, creating it 0600; flags are os.O_* flags, mode the file object's mode
+def _open_private(path, flags, mode):
+    fd = os.open(path, flags | os.O_CREAT, 0o600)
+    if os.fstat(fd).st_mode & 0o077:
+        os.fchmod(fd, 0o600)
+    return os.fdopen(fd, mode)
+
+def _close_map(map_):
+    if map_ is None:
+        return
+    try:
+        map_.close()
+    except BufferError:
+        # A reader still holds a memoryview; the map is released with it
+        pass
+
+class _Segment:
+    __slots__ = ("first_seq", "log_path", "idx_path", "size", "seqs", "hashes", "offsets", "lengths", "kinds", "map")
+
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.log_path = os.path.join(directory, segment_name(first_seq) + ".log")
+        self.idx_path = os.path.join(directory, segment_name(first_seq) + ".idx")
+        self.size = 0
+        self.seqs = array("Q")
+        self.hashes = array("Q")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.kinds = array("I")
+        self.map = None
+
+    @property
+    def last_seq(self):
+        return self.seqs[-1] if self.seqs else None
+
+    def add(self, seq, conv_hash, offset, length, kind):
+        self.seqs.append(seq)
+        self.hashes.append(conv_hash)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.kinds.append(kind)
+
+    def entries(self):
+        return zip(self.seqs, self.hashes, self.offsets, self.lengths, self.kinds)
+
+    def find(self, seq):
+        i = bisect.bisect_left(self.seqs, seq)
+        return i if i < len(self.seqs) and self.seqs[i] == seq else None
+
+    # Payload bytes of entry i, straight from the mmap (no copy)
+    def view(self, i):
+        offset, length = self.offsets[i], self.lengths[i]
+        end = offset + length
+        if self.map is None or len(self.map) < end:
+            with open(self.log_path, "rb") as f:
+                remapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Older views keep the previous map alive; it is released with them
+            self.map = remapped
+        return memoryview(self.map)[offset:end]
+
+    def close(self):
+        _close_map(self.map)
+        self.map = None
+
+    # Load the entries of the index file (False if there is none)
+    def load_index(self):
+        try:
+            with open(self.idx_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for entry in INDEX_ENTRY.iter_unpack(data[:usable]):
+            self.add(*entry)
+        return True
+
+    # Scan the log from offset, verifying every record; returns the end of the last valid record
+    def scan(self, offset=0):
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                try:
+                    record = json.loads(payload)
+                except ValueError:
+                    break
+                self.add(
+                    record["seq"],
+                    conversation_hash(record.get("conversation_id")),
+                    offset + RECORD_HEADER.size,
+                    length,
+                    KINDS.get(record.get("type"), 0),
+                )
+                offset += RECORD_HEADER.size + length
+        return offset
+
+    def _record_ok(self, i):
+        offset, length = self.offsets[i], self.lengths[i]
+        with open(self.log_path, "rb") as f:
+            f.seek(offset - RECORD_HEADER.size)
+            header = f.read(RECORD_HEADER.size)
+            payload = f.read(length)
+        if len(header) < RECORD_HEADER.size or len(payload) < length:
+            return False
+        stored_length, crc = RECORD_HEADER.unpack(header)
+        return stored_length == length and zlib.crc32(payload) == crc
+
+    # Load index and log; returns True if the log had to be truncated to end of its last valid record
+    def recover(self):
+        file_size = os.path.getsize(self.log_path)
+        if self.load_index() and self.seqs:
+            # Drop entries past the end of the log (index written, log not yet synced)
+            while self.seqs and self.offsets[-1] + self.lengths[-1] > file_size:
+                for column in (self.seqs, self.hashes, self.offsets, self.lengths, self.kinds):
+                    column.pop()
+            if self.seqs and not self._record_ok(len(self.seqs) - 1):
+                self._reset()
+        else:
+            self._reset()
+        start = self.offsets[-1] + self.lengths[-1] if self.seqs else 0
+        self.size = self.scan(start)
+        return self.size < file_size
+
+    def _reset(self):
+        for column in (self.seqs, self.hashes, self.offsets, self.lengths, self.kinds):
+            del column[:]
+
+    def write_index(self, path=None):
+        with _open_private(path or self.idx_path, os.O_WRONLY | os.O_TRUNC, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self.entries()))
+            f.flush()
+            os.fsync(f.fileno())
+
+class Journal:
+    def __init__(self, path, segment_bytes=SEGMENT_BYTES, fsync=FSYNC, retention_days=RETENTION_DAYS,
+                 max_bytes=MAX_BYTES, readonly=False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        # Guards the segment list and the in-memory indexes (writer thread vs readers)
+        self._lock = threading.RLock()
+        # Guards the pending queue
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._segments = []
+        self._firsts = []
+        self._by_conversation = {}
+        # conversation hash -> seq of its latest forget record
+        self._forgotten = {}
+        self._closing = False
+        self._maintenance = False
+        self._written_seq = 0
+        self._file = None
+        self._idx_file = None
+        self._writer = None
+
+        _private_dir(path)
+        self._load()
+        last_seq = max((segment.last_seq for segment in self._segments if segment.seqs), default=0)
+        self.next_seq = last_seq + 1
+        if self._segments and not self._segments[-1].seqs:
+            # Empty active segment: new records must not sort before its name
+            self.next_seq = max(self.next_seq, self._segments[-1].first_seq)
+        self._written_seq = last_seq
+        if not readonly:
+            if not self._segments:
+                self._add_segment(_Segment(path, self.next_seq))
+            self._open_active()
+            self._writer = threading.Thread(target=self._run_writer, name="journal-writer", daemon=True)
+            self._writer.start()
+
+    # ---- loading -------------------------------------------------------------
+
+    def _load(self):
+        firsts = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".log") and name[:-4].isdigit())
+        last_seq = 0
+        for n, first_seq in enumerate(firsts):
+            segment = _Segment(self.path, first_seq)
+            if first_seq <= last_seq:
+                # Leftover of an interrupted compaction (its records live in the merged segment)
+                if not self.readonly:
+                    self._remove_files(segment)
+                continue
+            truncated = segment.recover()
+            if truncated and not self.readonly:
+                with open(segment.log_path, "r+b") as f:
+                    f.truncate(segment.size)
+                segment.write_index()
+                metrics.incr("journal_recovered_segments")
+            if segment.seqs:
+                last_seq = segment.last_seq
+            elif n != len(firsts) - 1:
+                continue
+            self._add_segment(segment)
+            self._index_entries(segment.entries())
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._firsts.append(segment.first_seq)
+
+    def _index_entries(self, entries):
+        for seq, conv_hash, _, _, kind in entries:
+            if kind == FORGET:
+                self._forgotten[conv_hash] = seq
+            elif conv_hash:
+                seqs = self._by_conversation.get(conv_hash)
+                if seqs is None:
+                    seqs = self._by_conversation[conv_hash] = array("Q")
+                seqs.append(seq)
+
+    # ---- writing -------------------------------------------------------------
+
+    # Queue a record; returns its seq (None if journaling is stopped or the queue is full)
+    def append(self, kind, conversation_id=None, **fields):
+        if self.readonly:
+            raise RuntimeError("Journal opened read-only")
+        record = {"type": kind, "conversation_id": conversation_id, "ts": time.time(), **fields}
+        with self._cond:
+            if self._closing or len(self._pending) >= MAX_PENDING:
+                metrics.incr("journal_dropped")
+                return None
+            seq = record["seq"] = self.next_seq
+            self.next_seq += 1
+            self._pending.append(record)
+            self._cond.notify_all()
+        return seq
+
+    # Forget a conversation: it disappears from history now and from disk at the next compaction
+    def forget(self, conversation_id):
+        return self.append("forget", conversation_id)
+
+    # Ask the writer thread to run retention and compaction now
+    def maintain(self):
+        with self._cond:
+            self._maintenance = True
+            self._cond.notify_all()
+
+    # Wait until everything appended so far is written (and synced)
+    def flush(self, timeout=None):
+        with self._cond:
+            target = self.next_seq - 1
+            return self._cond.wait_for(lambda: self._written_seq >= target or self._writer is None, timeout)
+
+    def close(self):
+        if self._writer is None:
+            for segment in self._segments:
+                segment.close()
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._writer = None
+        self._file.close()
+        self._idx_file.close()
+        for segment in self._segments:
+            segment.close()
+
+    def _open_active(self):
+        active = self._segments[-1]
+        self._file = _open_private(active.log_path, os.O_WRONLY | os.O_APPEND, "ab")
+        self._idx_file = _open_private(active.idx_path, os.O_WRONLY | os.O_APPEND, "ab")
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing or self._maintenance)
+                batch = list(self._pending)
+                self._pending.clear()
+                closing, maintenance = self._closing, self._maintenance
+                self._maintenance = False
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except OSError:
+                    metrics.incr("journal_write_errors")
+                    metrics.incr("journal_dropped", len(batch))
+            if maintenance:
+                self._maintain()
+            with self._cond:
+                if batch:
+                    self._written_seq = batch[-1]["seq"]
+                self._cond.notify_all()
+                if closing and not self._pending:
+                    return
+
+    def _write_batch(self, batch):
+        buffer = bytearray()
+        entries = []
+        for record in batch:
+            payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            active = self._segments[-1]
+            record_size = RECORD_HEADER.size + len(payload)
+            if (active.seqs or entries) and active.size + len(buffer) + record_size > self.segment_bytes:
+                self._commit(buffer, entries)
+                buffer, entries = bytearray(), []
+                self._rotate(record["seq"])
+                active = self._segments[-1]
+            offset = active.size + len(buffer) + RECORD_HEADER.size
+            buffer += RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+            buffer += payload
+            entries.append((
+                record["seq"],
+                conversation_hash(record["conversation_id"]),
+                offset,
+                len(payload),
+                KINDS.get(record["type"], 0),
+            ))
+        self._commit(buffer, entries)
+
+    # Write one batch: log bytes, one fsync, then the index entries
+    def _commit(self, buffer, entries):
+        if not entries:
+            return
+        started = time.perf_counter()
+        self._file.write(buffer)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._idx_file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        self._idx_file.flush()
+        with self._lock:
+            active = self._segments[-1]
+            for entry in entries:
+                active.add(*entry)
+            active.size += len(buffer)
+            self._index_entries(entries)
+        metrics.incr("journal_appends", len(entries))
+        metrics.incr("journal_bytes", len(buffer))
+        metrics.observe("journal_batch_size", len(entries))
+        metrics.observe("journal_commit_seconds", time.perf_counter() - started)
+
+    # Seal the active segment and start a new one at first_seq
+    def _rotate(self, first_seq):
+        self._file.close()
+        self._idx_file.close()
+        with self._lock:
+            self._add_segment(_Segment(self.path, first_seq))
+        self._open_active()
+        metrics.incr("journal_rotations")
+        self._maintain()
+
+    # ---- retention and compaction (writer thread only) ----------------------
+
+    def _maintain(self):
+        try:
+            self._apply_retention()
+            self._compact()
+        except OSError:
+            metrics.incr("journal_maintenance_errors")
+
+    def _remove_files(self, segment):
+        segment.close()
+        for path in (segment.log_path, segment.idx_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _apply_retention(self):
+        if not self.retention_days and not self.max_bytes:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        total = sum(segment.size for segment in self._segments)
+        removed = []
+        for segment in self._segments[:-1]:
+            expired = self.retention_days and os.path.getmtime(segment.log_path) < cutoff
+            oversize = self.max_bytes and total > self.max_bytes
+            if not (expired or oversize):
+                break
+            removed.append(segment)
+            total -= segment.size
+        if not removed:
+            return
+        with self._lock:
+            del self._segments[:len(removed)]
+            del self._firsts[:len(removed)]
+            oldest = self._segments[0].first_seq
+            for conv_hash, seqs in list(self._by_conversation.items()):
+                keep = bisect.bisect_left(seqs, oldest)
+                if keep == len(seqs):
+                    del self._by_conversation[conv_hash]
+                elif keep:
+                    del seqs[:keep]
+        for segment in removed:
+            self._remove_files(segment)
+        metrics.incr("journal_retention_removed", len(removed))
+
+    def _is_dead(self, seq, conv_hash, kind):
+        forgotten = self._forgotten.get(conv_hash)
+        return kind != FORGET and forgotten is not None and seq < forgotten
+
+    # Merge adjacent sealed segments that fit in one, dropping forgotten records
+    def _compact(self):
+        sealed = self._segments[:-1]
+        groups, group, group_size = [], [], 0
+        for segment in sealed:
+            live = sum(
+                RECORD_HEADER.size + length
+                for seq, conv_hash, _, length, kind in segment.entries()
+                if not self._is_dead(seq, conv_hash, kind)
+            )
+            if group and group_size + live > self.segment_bytes:
+                groups.append(group)
+                group, group_size = [], 0
+            group.append(segment)
+            group_size += live
+        if group:
+            groups.append(group)
+
+        for group in groups:
+            has_dead = any(self._is_dead(*entry) for segment in group for entry in _entry_keys(segment))
+            if len(group) > 1 or has_dead:
+                self._rewrite(group)
+
+    def _rewrite(self, group):
+        merged = _Segment(self.path, group[0].first_seq)
+        tmp_log = merged.log_path + ".compact"
+        tmp_idx = merged.idx_path + ".compact"
+        with _open_private(tmp_log, os.O_WRONLY | os.O_TRUNC, "wb") as out:
+            for segment in group:
+                for i, (seq, conv_hash, offset, length, kind) in enumerate(segment.entries()):
+                    if self._is_dead(seq, conv_hash, kind):
+                        continue
+                    view = segment.view(i)
+                    out.write(RECORD_HEADER.pack(length, zlib.crc32(view)))
+                    out.write(view)
+                    view.release()
+                    merged.add(seq, conv_hash, merged.size + RECORD_HEADER.size, length, kind)
+                    merged.size += RECORD_HEADER.size + length
+            out.flush()
+            os.fsync(out.fileno())
+        merged.write_index(tmp_idx)
+        # Replace the first segment, then drop the rest; a crash in between leaves
+        # segments overlapping the merged one, which _load() discards
+        os.replace(tmp_log, merged.log_path)
+        os.replace(tmp_idx, merged.idx_path)
+        with self._lock:
+            position = self._segments.index(group[0])
+            self._segments[position:position + len(group)] = [merged]
+            self._firsts[position:position + len(group)] = [merged.first_seq]
+            dropped = {
+                seq for segment in group for seq, conv_hash, _, _, kind in segment.entries()
+                if self._is_dead(seq, conv_hash, kind)
+            }
+            if dropped:
+                for conv_hash, seqs in list(self._by_conversation.items()):
+                    if conv_hash in self._forgotten:
+                        remaining = array("Q", (seq for seq in seqs if seq not in dropped))
+                        if remaining:
+                            self._by_conversation[conv_hash] = remaining
+                        else:
+                            del self._by_conversation[conv_hash]
+        group[0].close()
+        for segment in group[1:]:
+            self._remove_files(segment)
+        metrics.incr("journal_compactions")
+
+    # ---- reading -------------------------------------------------------------
+
+    def _locate(self, seq):
+        position = bisect.bisect_right(self._firsts, seq) - 1
+        if position < 0:
+            return None, None
+        segment = self._segments[position]
+        return segment, segment.find(seq)
+
+    # Payload of a record as a memoryview into the segment mmap (None if unknown or not yet written)
+    def read_view(self, seq):
+        with self._lock:
+            segment, i = self._locate(seq)
+            if i is None:
+                return None
+            return segment.view(i)
+
+    def read(self, seq):
+        view = self.read_view(seq)
+        if view is None:
+            return None
+        with view:
+            return json.loads(bytes(view))
+
+    # Records of a conversation, oldest first (the last `limit` ones if given)
+    def history(self, conversation_id, limit=None):
+        conv_hash = conversation_hash(conversation_id)
+        with self._lock:
+            seqs = self._by_conversation.get(conv_hash)
+            if not seqs:
+                return []
+            forgotten = self._forgotten.get(conv_hash, 0)
+            seqs = seqs[bisect.bisect_left(seqs, forgotten):]
+            if limit is not None:
+                seqs = seqs[-limit:] if limit else seqs[:0]
+        records = []
+        for seq in seqs:
+            record = self.read(seq)
+            # The hash is 64 bits; compare ids to rule out collisions
+            if record is not None and record.get("conversation_id") == conversation_id:
+                records.append(record)
+        return records
+
+    def stats(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "segments": len(self._segments),
+                "bytes": sum(segment.size for segment in self._segments),
+                "records": sum(len(segment.seqs) for segment in self._segments),
+                "conversations": len(self._by_conversation),
+                "pending": len(self._pending),
+                "next_seq": self.next_seq,
+            }
+
+def _entry_keys(segment):
+    return zip(segment.seqs, segment.hashes, segment.kinds)
+
+# Claim a stream directory under root for this process (exclusive flock held while the process lives)
+def claim_stream(root=JOURNAL_DIR):
+    _private_dir(root)
+    n = 0
+    while True:
+        path = os.path.join(root, f"stream-{n}")
+        _private_dir(path)
+        fd = os.open(os.path.join(path, "LOCK"), os.O_CREAT | os.O_RDWR, 0o600)
+        if os.fstat(fd).st_mode & 0o077:
+            os.fchmod(fd, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            n += 1
+            continue
+        return path, fd
+
+_journal = None
+_journal_pid = None
+_journal_lock = threading.Lock()
+
+# This process's journal, opened on first use (after fork, so each worker gets its own stream)
+def get_journal():
+    global _journal, _journal_pid
+    with _journal_lock:
+        if _journal is None or _journal_pid != os.getpid():
+            path, lock_fd = claim_stream(JOURNAL_DIR)
+            _journal = Journal(path)
+            _journal.lock_fd = lock_fd
+            _journal_pid = os.getpid()
+            atexit.register(_journal.close)
+        return _journal
+
+# Flush and close this process's journal if it is open (forked workers leave
+# through os._exit, which skips atexit handlers; see serve.py)
+def close():
+    global _journal
+    with _journal_lock:
+        if _journal is not None and _journal_pid == os.getpid():
+            _journal.close()
+            _journal = None
+
+# Record an exchange event in this process's journal (no-op when disabled or on error)
+def record(kind, conversation_id=None, **fields):
+    if not ENABLED:
+        return None
+    try:
+        return get_journal().append(kind, conversation_id, **fields)
+    except OSError:
+        metrics.incr("journal_dropped")
+        return None
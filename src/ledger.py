@@ -0,0 +1,426 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import metrics
+import quota
+
+# Per-request token usage and cost ledger.
+#
+# providers.completion() meters every completion of the three frontends: prompt,
+# completion and cached prompt tokens come from the provider's usage (streams
+# ask for it with stream_options include_usage), or from the quota estimate
+# (characters / 4) when a response carries none, flagged as estimated. record()
+# only queues the record; a writer thread prices each batch, appends it as JSON
+# lines to this process's raw file and adds it to in-memory rolling aggregates
+# by (hour, model, prompt, frontend, kind), which are also written to a small
+# per-process summary file every SUMMARY_INTERVAL.
+#
+# Layout: LEDGER_DIR/usage-<stream>.jsonl (raw records, one file per process)
+# and LEDGER_DIR/hourly-<stream>.json (that process's aggregates). query() reads
+# aggregates only: this process's in memory, and the other processes' summary
+# files (prefork workers, Dash, Streamlit, earlier runs), re-read only when they
+# change. Raw records are never scanned to answer a query.
+#
+# Cost is computed from LEDGER_PRICES when the model is listed there, else from
+# litellm's model cost map; models priced by neither count as unpriced.
+
+# Set LEDGER=0 to disable usage recording
+ENABLED = os.environ.get("LEDGER", "1") != "0"
+
+LEDGER_DIR = os.environ.get(
+    "LEDGER_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "ledger"),
+)
+
+# Seconds between rewrites of this process's summary file
+SUMMARY_INTERVAL = float(os.environ.get("LEDGER_SUMMARY_INTERVAL", 5))
+
+# Aggregates and files older than this many days are dropped (0 keeps everything)
+RETENTION_DAYS = float(os.environ.get("LEDGER_RETENTION_DAYS", 90))
+
+# Records waiting for the writer; beyond this new records are dropped (and counted)
+MAX_PENDING = 100000
+
+# Price overrides in USD per million tokens, as JSON:
+# {"claude-3-opus-20240229": {"input": 15, "output": 75, "cached_input": 1.5}}
+PRICES = json.loads(os.environ.get("LEDGER_PRICES") or "{}")
+
+# Dimensions of the aggregates (plus "day", derived from the hour)
+KEY_FIELDS = ("hour", "model", "prompt", "frontend", "kind")
+GROUP_FIELDS = ("hour", "day", "model", "prompt", "frontend", "kind")
+
+# Summed values of an aggregate row, in summary file order
+VALUE_FIELDS = (
+    "requests", "errors", "estimated", "prompt_tokens", "completion_tokens", "cached_tokens", "cost", "unpriced",
+)
+
+class Totals:
+    __slots__ = VALUE_FIELDS
+
+    def __init__(self, values=None):
+        for field, value in zip(VALUE_FIELDS, values or (0,) * len(VALUE_FIELDS)):
+            setattr(self, field, value)
+
+    def add_record(self, record):
+        self.requests += 1
+        self.errors += record["status"] == "error"
+        self.estimated += record["estimated"]
+        self.prompt_tokens += record["prompt_tokens"]
+        self.completion_tokens += record["completion_tokens"]
+        self.cached_tokens += record["cached_tokens"]
+        if record["cost"] is None:
+            self.unpriced += 1
+        else:
+            self.cost += record["cost"]
+
+    def merge(self, other):
+        for field in VALUE_FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def values(self):
+        return [getattr(self, field) for field in VALUE_FIELDS]
+
+    def to_dict(self):
+        row = dict(zip(VALUE_FIELDS, self.values()))
+        row["total_tokens"] = self.prompt_tokens + self.completion_tokens
+        row["cost"] = round(self.cost, 6)
+        return row
+
+def hour_of(timestamp):
+    return int(timestamp // 3600 * 3600)
+
+def hour_label(hour):
+    return datetime.fromtimestamp(hour, timezone.utc).strftime("%Y-%m-%dT%H:00:00Z")
+
+def day_label(hour):
+    return datetime.fromtimestamp(hour, timezone.utc).strftime("%Y-%m-%d")
+
+def retention_cutoff(now=None):
+    if not RETENTION_DAYS:
+        return 0
+    return hour_of((now or time.time()) - RETENTION_DAYS * 86400)
+
+# (prompt, completion, cached prompt) tokens from a litellm usage object, or None
+def usage_counts(usage):
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    if not prompt_tokens and not completion_tokens:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "cache_read_input_tokens", None)
+    return prompt_tokens, completion_tokens, cached or 0
+
+_unpriced_models = set()
+
+# USD cost of a request, or None when the model has no known price
+def price(model, prompt_tokens, completion_tokens, cached_tokens):
+    if not prompt_tokens and not completion_tokens:
+        return 0.0
+    override = PRICES.get(model)
+    if override is not None:
+        cached_price = override.get("cached_input", override.get("input", 0))
+        return (
+            (prompt_tokens - cached_tokens) * override.get("input", 0)
+            + cached_tokens * cached_price
+            + completion_tokens * override.get("output", 0)
+        ) / 1e6
+    # Only priced through litellm once it is loaded (a completion ran in this process)
+    litellm = sys.modules.get("litellm")
+    if litellm is None or model in _unpriced_models:
+        return None
+    provider = quota.provider_for(model)
+    try:
+        prompt_cost, completion_cost = litellm.cost_per_token(
+            model=model,
+            custom_llm_provider=provider if provider != "default" else None,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cache_read_input_tokens=cached_tokens,
+        )
+    except Exception:
+        # Not in the cost map: don't retry (and log) for every request
+        _unpriced_models.add(model)
+        return None
+    return prompt_cost + completion_cost
+
+class Ledger:
+    def __init__(self, path, stream_id=None):
+        self.path = path
+        self.stream_id = stream_id or f"{os.getpid()}-{int(time.time() * 1000)}"
+        self.raw_path = os.path.join(path, f"usage-{self.stream_id}.jsonl")
+        self.summary_path = os.path.join(path, f"hourly-{self.stream_id}.json")
+        # Guards the aggregates (writer thread vs queries)
+        self._lock = threading.Lock()
+        # Guards the pending queue
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._aggregates = {}
+        # Other streams' summary files: path -> (mtime_ns, size, {key: Totals})
+        self._other = {}
+        self._dirty = False
+        self._closing = False
+        self._file = None
+
+        os.makedirs(path, exist_ok=True)
+        self._remove_expired()
+        self._writer = threading.Thread(target=self._run_writer, name="ledger-writer", daemon=True)
+        self._writer.start()
+
+    def append(self, record):
+        with self._cond:
+            if len(self._pending) >= MAX_PENDING:
+                metrics.incr("ledger_dropped")
+                return
+            self._pending.append(record)
+            self._cond.notify()
+
+    def close(self):
+        if self._writer is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._writer = None
+        if self._file is not None:
+            self._file.close()
+
+    def _run_writer(self):
+        last_summary = time.monotonic()
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing, SUMMARY_INTERVAL)
+                batch = list(self._pending)
+                self._pending.clear()
+                closing = self._closing
+            if batch:
+                self._write_batch(batch)
+            now = time.monotonic()
+            if self._dirty and (closing or now - last_summary >= SUMMARY_INTERVAL):
+                self._write_summary()
+                last_summary = now
+            if closing:
+                with self._cond:
+                    if not self._pending:
+                        return
+
+    def _write_batch(self, batch):
+        lines = []
+        with self._lock:
+            for record in batch:
+                record["cost"] = price(
+                    record["model"], record["prompt_tokens"], record["completion_tokens"], record["cached_tokens"]
+                )
+                key = (hour_of(record["ts"]),) + tuple(record[field] for field in KEY_FIELDS[1:])
+                totals = self._aggregates.get(key)
+                if totals is None:
+                    totals = self._aggregates[key] = Totals()
+                totals.add_record(record)
+                lines.append(json.dumps(record, separators=(",", ":")))
+            self._dirty = True
+        try:
+            if self._file is None:
+                self._file = open(self.raw_path, "a", encoding="utf-8")
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+        except OSError:
+            metrics.incr("ledger_write_errors")
+
+    # Atomically replace this process's summary file with its current aggregates
+    def _write_summary(self):
+        cutoff = retention_cutoff()
+        with self._lock:
+            for key in [key for key in self._aggregates if key[0] < cutoff]:
+                del self._aggregates[key]
+            rows = [list(key) + totals.values() for key, totals in self._aggregates.items()]
+            self._dirty = False
+        tmp_path = self.summary_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stream": self.stream_id, "updated": time.time(), "rows": rows}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.summary_path)
+        except OSError:
+            metrics.incr("ledger_write_errors")
+
+    # Delete raw and summary files last written before the retention window
+    def _remove_expired(self):
+        if not RETENTION_DAYS:
+            return
+        cutoff = time.time() - RETENTION_DAYS * 86400
+        for name in os.listdir(self.path):
+            if name.startswith(("usage-", "hourly-")):
+                file_path = os.path.join(self.path, name)
+                try:
+                    if os.path.getmtime(file_path) < cutoff:
+                        os.remove(file_path)
+                except OSError:
+                    pass
+
+    # Aggregates of the other streams' summary files (each re-read only when it changed)
+    def _other_aggregates(self):
+        seen = set()
+        for name in os.listdir(self.path):
+            if not (name.startswith("hourly-") and name.endswith(".json")) or name == os.path.basename(self.summary_path):
+                continue
+            file_path = os.path.join(self.path, name)
+            seen.add(file_path)
+            try:
+                stat = os.stat(file_path)
+                cached = self._other.get(file_path)
+                if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                with open(file_path, encoding="utf-8") as f:
+                    rows = json.load(f)["rows"]
+            except (OSError, ValueError, KeyError):
+                continue
+            width = len(KEY_FIELDS)
+            self._other[file_path] = (
+                stat.st_mtime_ns, stat.st_size, {tuple(row[:width]): Totals(row[width:]) for row in rows},
+            )
+        for file_path in set(self._other) - seen:
+            del self._other[file_path]
+        return [aggregates for _, _, aggregates in self._other.values()]
+
+    # Usage summed by group_by fields over [since, until) (epoch seconds), optionally
+    # filtered by model, prompt, frontend and kind; rows sorted by their group values
+    def query(self, since=None, until=None, group_by=("model",), **filters):
+        unknown = [field for field in group_by if field not in GROUP_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown group_by field(s): {', '.join(unknown)}")
+        filters = {KEY_FIELDS.index(field): value for field, value in filters.items() if value is not None}
+        first_hour = max(hour_of(since) if since is not None else 0, retention_cutoff())
+        with self._lock:
+            sources = [dict(self._aggregates)] + self._other_aggregates()
+
+        groups = {}
+        totals = Totals()
+        for aggregates in sources:
+            for key, values in aggregates.items():
+                hour = key[0]
+                if hour < first_hour or (until is not None and hour >= until):
+                    continue
+                if any(key[index] != value for index, value in filters.items()):
+                    continue
+                group = tuple(
+                    day_label(hour) if field == "day" else hour_label(hour) if field == "hour"
+                    else key[KEY_FIELDS.index(field)]
+                    for field in group_by
+                )
+                group_totals = groups.get(group)
+                if group_totals is None:
+                    group_totals = groups[group] = Totals()
+                group_totals.merge(values)
+                totals.merge(values)
+        rows = [
+            {**dict(zip(group_by, group)), **groups[group].to_dict()}
+            for group in sorted(groups, key=lambda group: tuple(str(value) for value in group))
+        ]
+        return {"group_by": list(group_by), "rows": rows, "totals": totals.to_dict()}
+
+    def stats(self):
+        with self._lock:
+            series = len(self._aggregates)
+        with self._cond:
+            pending = len(self._pending)
+        return {"stream": self.stream_id, "series": series, "pending": pending}
+
+_ledger = None
+_ledger_pid = None
+_ledger_lock = threading.Lock()
+
+# This process's ledger, opened on first use (after fork, so each worker gets its own stream)
+def get_ledger():
+    global _ledger, _ledger_pid
+    with _ledger_lock:
+        if _ledger is None or _ledger_pid != os.getpid():
+            _ledger = Ledger(LEDGER_DIR)
+            _ledger_pid = os.getpid()
+            atexit.register(_ledger.close)
+        return _ledger
+
+# Flush and close this process's ledger if it is open (forked workers leave
+# through os._exit, which skips atexit handlers; see serve.py)
+def close():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is not None and _ledger_pid == os.getpid():
+            _ledger.close()
+            _ledger = None
+
+# Queue a usage record (no-op when disabled)
+def record(model, labels, status, prompt_tokens, completion_tokens, cached_tokens=0, estimated=False):
+    if not ENABLED:
+        return
+    labels = labels or {}
+    get_ledger().append({
+        "ts": time.time(),
+        "model": model,
+        "prompt": labels.get("prompt") or "",
+        "frontend": labels.get("frontend") or "",
+        "kind": labels.get("kind") or "chat",
+        "status": status,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "estimated": estimated,
+    })
+
+# Record the usage of a completion response; a stream is wrapped and recorded
+# when it ends (exhausted, closed early or failed)
+def meter(response, model, messages, labels=None, stream=False):
+    if not ENABLED:
+        return response
+    if not stream:
+        counts = usage_counts(getattr(response, "usage", None))
+        if counts is None:
+            content = ""
+            choices = getattr(response, "choices", None)
+            if choices:
+                content = getattr(choices[0].message, "content", None) or ""
+            record(model, labels, "complete", quota.estimate_prompt_tokens(messages),
+                   quota.estimate_text_tokens(len(content)), estimated=True)
+        else:
+            record(model, labels, "complete", *counts)
+        return response
+    return _metered_stream(response, model, messages, labels)
+
+def _metered_stream(response, model, messages, labels):
+    counts = None
+    completion_chars = 0
+    status = "cancelled"
+    try:
+        for chunk in response:
+            counts = usage_counts(getattr(chunk, "usage", None)) or counts
+            choices = getattr(chunk, "choices", None)
+            if choices:
+                content = getattr(choices[0].delta, "content", None)
+                if content:
+                    completion_chars += len(content)
+            yield chunk
+        status = "complete"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        close_response = getattr(response, "close", None)
+        if status == "cancelled" and close_response is not None:
+            close_response()
+        if counts is None:
+            record(model, labels, status, quota.estimate_prompt_tokens(messages),
+                   quota.estimate_text_tokens(completion_chars), estimated=True)
+        else:
+            record(model, labels, status, *counts)
+
+# Usage queries served from the aggregates (see Ledger.query)
+def query(since=None, until=None, group_by=("model",), **filters):
+    return get_ledger().query(since, until, group_by, **filters)
@@ -0,0 +1,270 @@
+import html
+import re
+
+# Incremental markdown rendering for streamed answers.
+#
+# The streamed text is split into blocks (paragraphs, headings, lists, tables,
+# code fences) at block boundaries. Finished blocks are rendered to HTML exactly
+# once; only the open tail block is re-rendered as more text arrives. Each update
+# is a "markdown frame":
+#
+#   {"start": 3, "blocks": ["<p>...</p>", ...], "tail": "<table>...</table>"}
+#
+# meaning: the finished blocks from index `start` onwards are `blocks`, and the
+# still-growing last block currently renders as `tail`. assets/markdown_stream.js
+# applies frames to the DOM for both the FastAPI page and the Dash app.
+#
+# All text is HTML-escaped before formatting and only http(s)/mailto links are
+# emitted, so the output is safe to insert with innerHTML.
+
+FENCE_RE = re.compile(r"^\s*(`{3,}|~{3,})\s*([\w+-]*)")
+HEADING_RE = re.compile(r"^\s*(#{1,6})\s+(.*?)\s*#*\s*$")
+HR_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+LIST_ITEM_RE = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+CODE_SPAN_RE = re.compile(r"(`+)(.+?)\1")
+LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)\s]+)\)")
+BOLD_RE = re.compile(r"\*\*(?!\s)(.+?)(?<!\s)\*\*|__(?!\s)(.+?)(?<!\s)__")
+ITALIC_RE = re.compile(r"(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?!\*)|(?<!\w)_(?![\s_])(.+?)(?<![\s_])_(?!\w)")
+SAFE_URL_PREFIXES = ("http://", "https://", "mailto:")
+
+# Render a link if its URL scheme is safe, otherwise just its text
+def _render_link(match):
+    text, url = match.group(1), match.group(2)
+    if not url.lower().startswith(SAFE_URL_PREFIXES):
+        return text
+    return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{text}</a>'
+
+def _format_text(escaped):
+    escaped = LINK_RE.sub(_render_link, escaped)
+    escaped = BOLD_RE.sub(lambda m: f"<strong>{m.group(1) or m.group(2)}</strong>", escaped)
+    return ITALIC_RE.sub(lambda m: f"<em>{m.group(1) or m.group(2)}</em>", escaped)
+
+# Inline markdown (code spans, links, bold, italic) on escaped text
+def render_inline(text):
+    parts = []
+    position = 0
+    for match in CODE_SPAN_RE.finditer(text):
+        parts.append(_format_text(html.escape(text[position:match.start()])))
+        parts.append(f"<code>{html.escape(match.group(2).strip())}</code>")
+        position = match.end()
+    parts.append(_format_text(html.escape(text[position:])))
+    return "".join(parts)
+
+def _split_row(line):
+    cells = line.strip()
+    if cells.startswith("|"):
+        cells = cells[1:]
+    if cells.endswith("|"):
+        cells = cells[:-1]
+    return [cell.strip() for cell in cells.split("|")]
+
+def render_table(lines):
+    rows = [_split_row(line) for line in lines]
+    header = None
+    alignments = []
+    if len(lines) >= 2 and TABLE_SEPARATOR_RE.match(lines[1]):
+        header = rows[0]
+        for cell in rows[1]:
+            if cell.startswith(":") and cell.endswith(":"):
+                alignments.append("center")
+            elif cell.endswith(":"):
+                alignments.append("right")
+            elif cell.startswith(":"):
+                alignments.append("left")
+            else:
+                alignments.append(None)
+        rows = rows[2:]
+    elif len(lines) == 1:
+        # A lone first row is still streaming in; show it as the header
+        header, rows = rows[0], []
+
+    def cell_html(tag, index, cell):
+        align = alignments[index] if index < len(alignments) else None
+        style = f' style="text-align: {align}"' if align else ""
+        return f"<{tag}{style}>{render_inline(cell)}</{tag}>"
+
+    parts = ["<table>"]
+    if header is not None:
+        parts.append("<thead><tr>")
+        parts.extend(cell_html("th", i, cell) for i, cell in enumerate(header))
+        parts.append("</tr></thead>")
+    if rows:
+        parts.append("<tbody>")
+        for row in rows:
+            parts.append("<tr>")
+            parts.extend(cell_html("td", i, cell) for i, cell in enumerate(row))
+            parts.append("</tr>")
+        parts.append("</tbody>")
+    parts.append("</table>")
+    return "".join(parts)
+
+def render_list(lines):
+    parts = []
+    # Open lists as (indent, tag)
+    stack = []
+    for line in lines:
+        match = LIST_ITEM_RE.match(line)
+        if match is None:
+            # Continuation line of the current item
+            parts.append(" " + render_inline(line.strip()))
+            continue
+        indent = len(match.group(1).expandtabs(4))
+        marker = match.group(2)
+        tag = "ol" if marker[0].isdigit() else "ul"
+        while stack and indent < stack[-1][0]:
+            parts.append(f"</li></{stack.pop()[1]}>")
+        if stack and indent == stack[-1][0]:
+            if tag != stack[-1][1]:
+                parts.append(f"</li></{stack.pop()[1]}>")
+            else:
+                parts.append("</li>")
+        if not stack or indent > stack[-1][0]:
+            start = int(marker[:-1]) if tag == "ol" else 1
+            parts.append(f'<{tag} start="{start}">' if start != 1 else f"<{tag}>")
+            stack.append((indent, tag))
+        parts.append("<li>" + render_inline(match.group(3)))
+    while stack:
+        parts.append(f"</li></{stack.pop()[1]}>")
+    return "".join(parts)
+
+def _line_kind(line):
+    stripped = line.strip()
+    if stripped.startswith("|"):
+        return "table"
+    if stripped.startswith(">"):
+        return "quote"
+    if LIST_ITEM_RE.match(line):
+        return "list"
+    return "paragraph"
+
+# Render one block (possibly still incomplete) to HTML
+def render_block(text):
+    lines = text.split("\n")
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if not lines:
+        return ""
+
+    fence = FENCE_RE.match(lines[0])
+    if fence:
+        marker = fence.group(1)
+        body = lines[1:]
+        if body and body[-1].strip().startswith(marker) and not body[-1].strip().strip(marker[0]):
+            body = body[:-1]
+        language = f' class="language-{html.escape(fence.group(2))}"' if fence.group(2) else ""
+        return f"<pre><code{language}>{html.escape(chr(10).join(body))}</code></pre>"
+
+    heading = HEADING_RE.match(lines[0])
+    if heading and len(lines) == 1:
+        level = len(heading.group(1))
+        return f"<h{level}>{render_inline(heading.group(2))}</h{level}>"
+    if HR_RE.match(lines[0]) and len(lines) == 1:
+        return "<hr>"
+
+    # Group consecutive lines of the same kind (a table may directly follow a paragraph)
+    parts = []
+    group, group_kind = [], None
+    for line in lines:
+        kind = _line_kind(line)
+        # Indented non-item lines continue a list
+        if group_kind == "list" and kind == "paragraph" and line[:1].isspace():
+            kind = "list"
+        if kind != group_kind and group:
+            parts.append(_render_group(group_kind, group))
+            group = []
+        group.append(line)
+        group_kind = kind
+    if group:
+        parts.append(_render_group(group_kind, group))
+    return "".join(parts)
+
+def _render_group(kind, lines):
+    if kind == "table":
+        return render_table(lines)
+    if kind == "list":
+        return render_list(lines)
+    if kind == "quote":
+        inner = "\n".join(re.sub(r"^\s*>\s?", "", line) for line in lines)
+        return f"<blockquote>{render_block(inner)}</blockquote>"
+    return "<p>" + "\n".join(render_inline(line.strip()) for line in lines) + "</p>"
+
+# Split text into finished blocks and the unfinished remainder (the open tail)
+def split_blocks(text):
+    lines = text.split("\n")
+    last = lines.pop()  # Incomplete line (empty if text ends with a newline)
+    blocks = []
+    current = []
+    fence_marker = None
+
+    def flush():
+        if current:
+            blocks.append("\n".join(current))
+            current.clear()
+
+    for line in lines:
+        stripped = line.strip()
+        if fence_marker is not None:
+            current.append(line)
+            if stripped.startswith(fence_marker) and not stripped.strip(fence_marker[0]):
+                fence_marker = None
+                flush()
+            continue
+        fence = FENCE_RE.match(line)
+        if fence:
+            flush()
+            fence_marker = fence.group(1)
+            current.append(line)
+        elif not stripped:
+            flush()
+        elif HEADING_RE.match(line) or (HR_RE.match(line) and not LIST_ITEM_RE.match(line)):
+            flush()
+            blocks.append(line)
+        else:
+            current.append(line)
+
+    remainder = "\n".join(current + [last]) if current else last
+    return blocks, remainder
+
+# Stateless frame for the text so far, given how many finished blocks the client has
+def render_frame(text, start=0):
+    blocks, remainder = split_blocks(text)
+    frame = {
+        "start": start,
+        "blocks": [render_block(block) for block in blocks[start:]],
+        "tail": render_block(remainder),
+    }
+    return frame, len(blocks)
+
+# Stateful renderer fed with deltas; every finished block is rendered once
+class IncrementalMarkdownRenderer:
+    def __init__(self):
+        self._pending = ""
+        self._block_count = 0
+        self._last_tail = None
+
+    # Add streamed text; returns a frame, or None if the rendered output did not change
+    def feed(self, delta):
+        self._pending += delta
+        blocks, self._pending = split_blocks(self._pending)
+        tail = render_block(self._pending)
+        if not blocks and tail == self._last_tail:
+            return None
+        frame = {
+            "start": self._block_count,
+            "blocks": [render_block(block) for block in blocks],
+            "tail": tail,
+        }
+        self._block_count += len(blocks)
+        self._last_tail = tail
+        return frame
+
+    # End of stream: the tail becomes a finished block
+    def close(self):
+        blocks = [render_block(self._pending)] if self._pending.strip() else []
+        frame = {"start": self._block_count, "blocks": blocks, "tail": ""}
+        self._block_count += len(blocks)
+        self._pending = ""
+        self._last_tail = ""
+        return frame
@@ -0,0 +1,243 @@
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import metrics
+
+# Compact in-process conversation storage with a global memory budget.
+#
+# Messages are __slots__ records holding a small role id and prompt id (both
+# interned, so a session stores ints instead of repeated strings) and the body as
+# UTF-8 bytes. Once a message is older than the KEEP_RECENT newest messages of its
+# session and longer than COMPRESS_MIN_BYTES, its body is zlib-compressed and only
+# decompressed when read.
+#
+# Sessions are kept in LRU order. When the estimated total size exceeds
+# MEMORY_BUDGET, the least recently used sessions that have been idle for at least
+# MIN_IDLE_SECONDS are evicted; if that is not enough, the least recently used
+# other sessions go too, so a worker never grows past its budget. Sessions idle for
+# longer than SESSION_TTL are evicted regardless of the budget. memory_report()
+# returns the total usage and the sizes of the largest sessions (GET /metrics).
+
+# Estimated bytes all sessions may use together
+MEMORY_BUDGET = int(float(os.environ.get("MESSAGE_STORE_BUDGET_MB", 64)) * 1024 * 1024)
+
+# Sessions idle for less than this are only evicted if idle sessions don't free enough
+MIN_IDLE_SECONDS = float(os.environ.get("MESSAGE_STORE_MIN_IDLE", 300))
+
+# Sessions idle for longer than this are dropped
+SESSION_TTL = float(os.environ.get("MESSAGE_STORE_TTL", 6 * 3600))
+
+# Set MESSAGE_STORE_COMPRESS=0 to keep every body uncompressed
+COMPRESS = os.environ.get("MESSAGE_STORE_COMPRESS", "1") != "0"
+
+# Newest messages per session kept uncompressed, and the smallest body worth compressing
+KEEP_RECENT = 8
+COMPRESS_MIN_BYTES = 256
+
+ROLES = ("system", "user", "assistant")
+
+# Interning table: value <-> small int id
+class _Interned:
+    def __init__(self, initial=()):
+        self._ids = {}
+        self._values = []
+        self._lock = threading.Lock()
+        for value in initial:
+            self.id(value)
+
+    def id(self, value):
+        if value is None:
+            return -1
+        value_id = self._ids.get(value)
+        if value_id is None:
+            with self._lock:
+                value_id = self._ids.get(value)
+                if value_id is None:
+                    value_id = self._ids[value] = len(self._values)
+                    self._values.append(value)
+        return value_id
+
+    def value(self, value_id):
+        return None if value_id < 0 else self._values[value_id]
+
+_roles = _Interned(ROLES)
+_prompts = _Interned()
+
+class StoredMessage:
+    __slots__ = ("role_id", "prompt_id", "created", "body", "compressed")
+
+    def __init__(self, role, content, prompt=None):
+        self.role_id = _roles.id(role)
+        self.prompt_id = _prompts.id(prompt)
+        self.created = time.time()
+        self.body = content.encode("utf-8")
+        self.compressed = False
+
+    @property
+    def role(self):
+        return _roles.value(self.role_id)
+
+    @property
+    def prompt(self):
+        return _prompts.value(self.prompt_id)
+
+    @property
+    def content(self):
+        body = zlib.decompress(self.body) if self.compressed else self.body
+        return body.decode("utf-8")
+
+    # Compress the body in place; returns the bytes saved
+    def compress(self):
+        if self.compressed or len(self.body) < COMPRESS_MIN_BYTES:
+            return 0
+        packed = zlib.compress(self.body, 6)
+        if len(packed) >= len(self.body):
+            return 0
+        saved = sys.getsizeof(self.body) - sys.getsizeof(packed)
+        self.body = packed
+        self.compressed = True
+        return saved
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.body)
+
+    def to_dict(self):
+        message = {"role": self.role, "content": self.content}
+        if self.prompt_id >= 0:
+            message["prompt"] = self.prompt
+        return message
+
+class _Session:
+    __slots__ = ("id", "messages", "last_access", "nbytes")
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.messages = []
+        self.last_access = time.monotonic()
+        self.nbytes = sys.getsizeof(self) + sys.getsizeof(self.messages)
+
+class MessageStore:
+    def __init__(self, budget=MEMORY_BUDGET, min_idle=MIN_IDLE_SECONDS, ttl=SESSION_TTL, compress=COMPRESS):
+        self.budget = budget
+        self.min_idle = min_idle
+        self.ttl = ttl
+        self.compress = compress
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+    def _touch(self, session_id, create=False):
+        session = self._sessions.get(session_id)
+        if session is None:
+            if not create:
+                return None
+            session = self._sessions[session_id] = _Session(session_id)
+            self.total_bytes += session.nbytes
+        else:
+            self._sessions.move_to_end(session_id)
+        session.last_access = time.monotonic()
+        return session
+
+    def _resize(self, session, delta):
+        session.nbytes += delta
+        self.total_bytes += delta
+
+    # Add a message to a session (created on first use); returns the record
+    def append(self, session_id, role, content, prompt=None):
+        message = StoredMessage(role, content, prompt)
+        with self._lock:
+            session = self._touch(session_id, create=True)
+            old_list_size = sys.getsizeof(session.messages)
+            session.messages.append(message)
+            self._resize(session, message.nbytes + sys.getsizeof(session.messages) - old_list_size)
+            if self.compress and len(session.messages) > KEEP_RECENT:
+                saved = session.messages[-KEEP_RECENT - 1].compress()
+                if saved:
+                    self._resize(session, -saved)
+                    metrics.incr("message_store_compressed_bytes", saved)
+            self._enforce_budget(session_id)
+        return message
+
+    # Remove and return the newest message of a session (None if empty)
+    def pop(self, session_id):
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None or not session.messages:
+                return None
+            message = session.messages.pop()
+            self._resize(session, -message.nbytes)
+            return message.to_dict()
+
+    # Messages of a session as {"role", "content"[, "prompt"]} dicts, oldest first
+    def messages(self, session_id, limit=None):
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                return []
+            records = session.messages[-limit:] if limit else list(session.messages)
+        return [message.to_dict() for message in records]
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def drop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.total_bytes -= session.nbytes
+            return session is not None
+
+    def _evict(self, session_id, reason):
+        session = self._sessions.pop(session_id)
+        self.total_bytes -= session.nbytes
+        metrics.incr("message_store_evictions", reason=reason)
+
+    # Drop expired sessions, then LRU idle sessions (then LRU others) until within budget
+    def _enforce_budget(self, current_id=None):
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_access <= self.ttl:
+                break
+            self._evict(session_id, "ttl")
+        if self.total_bytes <= self.budget:
+            return
+        for session_id, session in list(self._sessions.items()):
+            if self.total_bytes <= self.budget or now - session.last_access < self.min_idle:
+                break
+            self._evict(session_id, "idle")
+        for session_id in list(self._sessions):
+            if self.total_bytes <= self.budget:
+                break
+            if session_id != current_id:
+                self._evict(session_id, "budget")
+
+    # Drop expired sessions (call periodically; append() also does this)
+    def sweep(self):
+        with self._lock:
+            self._enforce_budget()
+
+    def session_bytes(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session.nbytes if session is not None else 0
+
+    # Estimated memory in total and the sizes of the `top` largest sessions (no session ids:
+    # the report is served on the unauthenticated GET /metrics)
+    def memory_report(self, top=10):
+        with self._lock:
+            sizes = [(session.nbytes, len(session.messages)) for session in self._sessions.values()]
+            total = self.total_bytes
+        sizes.sort(reverse=True)
+        return {
+            "total_bytes": total,
+            "budget_bytes": self.budget,
+            "sessions": len(sizes),
+            "messages": sum(count for _, count in sizes),
+            "largest_sessions": [{"bytes": nbytes, "messages": count} for nbytes, count in sizes[:top]],
+        }
@@ -0,0 +1,96 @@
+import threading
+from collections import deque
+
+# Minimal in-process metrics registry shared by the app modules.
+# Counters are monotonically increasing totals; timings/observations keep count,
+# sum, min, max and a bounded window of recent samples for percentiles.
+# Metrics are per worker process and exposed as JSON on GET /metrics.
+
+# Recent samples kept per observed series for percentile estimates
+SAMPLE_WINDOW = 1024
+
+# Series key: metric name plus sorted labels, e.g. "compression_bytes_out{encoding=br}"
+def series_key(name, labels):
+    if not labels:
+        return name
+    label_str = ",".join(f"{key}={labels[key]}" for key in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class Observation:
+    __slots__ = ("count", "total", "minimum", "maximum", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.samples.append(value)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": percentile(ordered, 0.50),
+            "p95": percentile(ordered, 0.95),
+        }
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._observations = {}
+
+    def incr(self, name, value=1, **labels):
+        key = series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = series_key(name, labels)
+        with self._lock:
+            observation = self._observations.get(key)
+            if observation is None:
+                observation = self._observations[key] = Observation()
+            observation.add(value)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(series_key(name, labels), 0)
+
+    def snapshot(self, prefix=""):
+        with self._lock:
+            counters = {key: value for key, value in self._counters.items() if key.startswith(prefix)}
+            observations = {
+                key: observation.summary()
+                for key, observation in self._observations.items()
+                if key.startswith(prefix)
+            }
+        return {"counters": counters, "observations": observations}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+# Process-wide registry
+registry = MetricsRegistry()
+incr = registry.incr
+observe = registry.observe
+snapshot = registry.snapshot
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Upstream pre-warming while the user is typing.
+#
+# The chat input sends a debounced "typing started" signal (POST /warm) with the
+# selected model and system prompt. The Prewarmer then runs a warm-up call in a
+# background thread: a 1-token streamed completion through the same litellm path
+# as the real request, which imports/initialises the provider client, opens the
+# pooled upstream connection and sends the system prompt prefix so providers with
+# prompt caching can cache it. Warm-ups are idempotent (a warm (model, prompt) is
+# not warmed again within WARM_TTL) and rate-limited per session and per process
+# (MAX_PER_MINUTE, since session ids are chosen by the client). Only the models
+# and prompts the UIs offer are warmed; anything else is rejected.
+#
+# Time-to-first-token is recorded with a warmed=True/False label (GET /metrics)
+# so the effect of pre-warming can be measured.
+
+# Set PREWARM=0 to disable warm-ups (each one is a small paid request)
+ENABLED = os.environ.get("PREWARM", "1") != "0"
+
+# Seconds a warmed (model, prompt) counts as warm
+WARM_TTL = float(os.environ.get("PREWARM_TTL", 120))
+
+# Minimum seconds between two warm-ups started by the same session
+SESSION_MIN_INTERVAL = float(os.environ.get("PREWARM_MIN_INTERVAL", 20))
+
+# Warm-ups started per minute by this process, whatever the session
+MAX_PER_MINUTE = int(os.environ.get("PREWARM_MAX_PER_MINUTE", 30))
+
+# Sessions tracked for rate limiting (least recently seen are dropped first)
+MAX_SESSIONS = 10000
+
+class _SessionState:
+    __slots__ = ("last_started", "warm")
+
+    def __init__(self):
+        self.last_started = 0.0
+        # (model, prompt_name) -> time the session's warm-up was requested
+        self.warm = {}
+
+class Prewarmer:
+    # `models` and `prompts` are the model and prompt names that may be warmed
+    def __init__(self, warm_func, models, prompts, ttl=WARM_TTL, min_interval=SESSION_MIN_INTERVAL,
+                 max_per_minute=MAX_PER_MINUTE, enabled=ENABLED, max_workers=2):
+        self.warm_func = warm_func
+        self.models = frozenset(models)
+        self.prompts = frozenset(prompts)
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.max_per_minute = max_per_minute
+        self.enabled = enabled
+        # Start times of the warm-ups of the last minute
+        self._started = deque()
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        # (model, prompt_name) -> time the last successful warm-up finished (any session)
+        self._warm = {}
+        self._inflight = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prewarm")
+
+    def _session(self, session_id):
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = _SessionState()
+            if len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return state
+
+    # Handle a typing signal; returns what happened ("started", "already_warm", ...,
+    # "rejected" for a model or prompt that is not offered)
+    def request(self, session_id, model_name, prompt_name):
+        if not self.enabled:
+            return "disabled"
+        if model_name not in self.models or prompt_name not in self.prompts:
+            metrics.incr("prewarm_requests", status="rejected")
+            return "rejected"
+        key = (model_name, prompt_name)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            state = self._session(session_id or "")
+            finished_at = self._warm.get(key)
+            if finished_at is not None and now - finished_at < self.ttl:
+                state.warm[key] = now
+                status = "already_warm"
+            elif key in self._inflight:
+                state.warm[key] = now
+                status = "in_progress"
+            elif now - state.last_started < self.min_interval or len(self._started) >= self.max_per_minute:
+                status = "rate_limited"
+            else:
+                state.last_started = now
+                state.warm[key] = now
+                self._started.append(now)
+                self._inflight.add(key)
+                status = "started"
+        metrics.incr("prewarm_requests", status=status)
+        if status == "started":
+            self._executor.submit(self._run, key)
+        return status
+
+    # Drop warm-up starts older than a minute and warm entries past their TTL (lock held)
+    def _expire(self, now):
+        while self._started and now - self._started[0] >= 60:
+            self._started.popleft()
+        for key, finished_at in list(self._warm.items()):
+            if now - finished_at >= self.ttl:
+                del self._warm[key]
+
+    def _run(self, key):
+        model_name, prompt_name = key
+        started = time.perf_counter()
+        try:
+            self.warm_func(model_name, prompt_name)
+        except Exception:
+            metrics.incr("prewarm_errors", model=model_name)
+            with self._lock:
+                self._inflight.discard(key)
+            return
+        metrics.observe("prewarm_seconds", time.perf_counter() - started, model=model_name)
+        with self._lock:
+            self._warm[key] = time.monotonic()
+            self._inflight.discard(key)
+
+    # True if the (model, prompt) was warmed recently, for this session or (session_id=None) any
+    def is_warm(self, session_id, model_name, prompt_name):
+        key = (model_name, prompt_name)
+        now = time.monotonic()
+        with self._lock:
+            finished_at = self._warm.get(key)
+            if finished_at is None or now - finished_at >= self.ttl:
+                return False
+            if session_id is None:
+                return True
+            state = self._sessions.get(session_id)
+            return state is not None and key in state.warm
+
+# Time-to-first-token tracker for one generation, labelled by warm state
+class TTFTTimer:
+    def __init__(self, model_name, warmed, frontend="fastapi"):
+        self.labels = {"model": model_name, "warmed": bool(warmed), "frontend": frontend}
+        self.started = time.perf_counter()
+        self.first_token_at = None
+
+    # Call on every content chunk; only the first one is recorded
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            metrics.observe("ttft_seconds", self.first_token_at - self.started, **self.labels)
@@ -0,0 +1,97 @@
+import importlib
+import os
+import sys
+import threading
+import time
+
+import ledger
+import quota
+import shadow
+
+# Provider SDK access shared by all three apps.
+# litellm is heavy to import (hundreds of modules plus the model cost map), so it
+# is loaded on first use instead of at app import time. warm() lets a pre-fork
+# server pay that cost once in the parent process (see serve.py).
+
+# Heavy modules imported by warm(), in order
+PROVIDER_MODULES = ("litellm",)
+
+# Models offered in the UI dropdowns; warm() resolves their provider routes up front
+DEFAULT_MODELS = ("gemini/gemini-2.0-flash", "claude-3-opus-20240229")
+
+_litellm = None
+_lock = threading.Lock()
+
+# Import litellm on first use (thread-safe, imported only once per process)
+def get_litellm():
+    global _litellm
+    if _litellm is None:
+        with _lock:
+            if _litellm is None:
+                _litellm = importlib.import_module("litellm")
+    return _litellm
+
+# Drop-in replacement for litellm.completion that defers the import, waits for
+# provider quota (RPM/TPM per key) before dispatching (see quota.py) and records
+# token usage and cost in the ledger. usage_labels ({"frontend", "prompt", "kind"})
+# label the ledger record and are not sent to the provider (see ledger.py).
+# A sample of live requests is also mirrored to candidate models (see shadow.py);
+# background=True (used by those) schedules the request at the lowest quota priority.
+def completion(*args, usage_labels=None, background=False, **kwargs):
+    started = time.perf_counter()
+    model = kwargs.get("model", args[0] if args else "")
+    stream = bool(kwargs.get("stream"))
+    if stream and ledger.ENABLED:
+        # Ask for the final usage chunk (litellm computes it when the provider does not send one)
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    try:
+        response = quota.scheduler.completion(get_litellm().completion, *args, background=background, **kwargs)
+    except Exception:
+        ledger.record(model, usage_labels, "error", 0, 0)
+        raise
+    response = ledger.meter(response, model, kwargs.get("messages"), usage_labels, stream)
+    return shadow.shadow.mirror(response, model, kwargs.get("messages"), usage_labels, stream, started, completion)
+
+# True once litellm has been imported in this process
+def is_loaded():
+    return _litellm is not None or "litellm" in sys.modules
+
+# Import and warm the heavy provider modules, returning seconds spent per step
+def warm(models=DEFAULT_MODELS):
+    timings = {}
+    for module_name in PROVIDER_MODULES:
+        start = time.perf_counter()
+        importlib.import_module(module_name)
+        timings[f"import {module_name}"] = time.perf_counter() - start
+
+    litellm = get_litellm()
+    suppress_debug_info = litellm.suppress_debug_info
+    litellm.suppress_debug_info = True
+    for model in models:
+        start = time.perf_counter()
+        try:
+            # Resolving the provider pulls in the provider-specific modules litellm loads lazily
+            litellm.get_llm_provider(model)
+        except Exception:
+            pass
+        timings[f"resolve {model}"] = time.perf_counter() - start
+    litellm.suppress_debug_info = suppress_debug_info
+    return timings
+
+# Resident and shared memory of the current process in MB (Linux only, else None)
+def memory_usage_mb():
+    try:
+        with open(f"/proc/{os.getpid()}/smaps_rollup") as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+        shared = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+        return {
+            "rss": fields.get("Rss", 0) / 1024,
+            "pss": fields.get("Pss", 0) / 1024,
+            "shared": shared / 1024,
+        }
+    except OSError:
+        return None
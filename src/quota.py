@@ -0,0 +1,486 @@
+import email.utils
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+import metrics
+
+# Provider quota scheduler (requests-per-minute and tokens-per-minute).
+#
+# Every completion goes through QuotaScheduler.completion() (see providers.py).
+# Before dispatch the request's tokens are estimated (prompt characters / 4 plus
+# the expected completion) and the request acquires a lease on one of the
+# provider's API keys. Each key has a requests bucket and a tokens bucket that
+# refill continuously at limit/60 per second. If no key has room, the request is
+# held instead of being sent to fail: waiters are served in arrival order, except
+# that a smaller request that fits may pass a larger one that does not, as long as
+# the larger one has waited less than STARVATION_SECONDS.
+#
+# Limits come from QUOTA_<PROVIDER>_RPM / QUOTA_<PROVIDER>_TPM and are corrected
+# from the rate limit headers of every response (x-ratelimit-*, which litellm also
+# fills from Anthropic's anthropic-ratelimit-*). Each process schedules on its own,
+# so both are split evenly between the QUOTA_WORKERS processes sharing the keys
+# (serve.py sets it to its worker count): every process gets limit / QUOTA_WORKERS
+# and the same share of the remaining quota a header reports. A 429, at dispatch or
+# raised by the stream before any content, puts the key on cooldown (Retry-After if
+# given) and the request is retried on the next available key; a 429 after content
+# has been streamed only puts the key on cooldown.
+# Several keys per provider are read from <PROVIDER>_API_KEYS (comma separated),
+# falling back to <PROVIDER>_API_KEY; load is spread to the key with most headroom.
+#
+# Background requests (shadow traffic, see shadow.py) have the lowest priority:
+# they only take a key while it has more than BACKGROUND_RESERVE of its quota
+# left, never ahead of a waiting foreground request of the same provider, give up
+# after BACKGROUND_MAX_WAIT and are not retried after a 429.
+
+# Seconds a request may be held before it fails with a quota error
+MAX_WAIT = float(os.environ.get("QUOTA_MAX_WAIT", 60))
+
+# Waiting longer than this stops smaller requests from passing this one
+STARVATION_SECONDS = float(os.environ.get("QUOTA_STARVATION_SECONDS", 5))
+
+# Fraction of each key's quota that background requests leave to foreground ones
+BACKGROUND_RESERVE = float(os.environ.get("QUOTA_BACKGROUND_RESERVE", 0.5))
+
+# Seconds a background request may be held before it fails with a quota error
+BACKGROUND_MAX_WAIT = float(os.environ.get("QUOTA_BACKGROUND_MAX_WAIT", 5))
+
+# Retries after a 429 from the provider
+MAX_RETRIES = int(os.environ.get("QUOTA_MAX_RETRIES", 3))
+
+# Cooldown of a key after a 429 without Retry-After
+RATE_LIMIT_COOLDOWN = 10.0
+
+# Processes sharing each key's limits, read when a provider's keys are first used
+# (serve.py sets it to --workers unless it is already set)
+def worker_count():
+    try:
+        return max(1, int(os.environ.get("QUOTA_WORKERS", 1)))
+    except ValueError:
+        return 1
+
+# Token estimate: characters per token and completion tokens assumed when max_tokens is not set
+CHARS_PER_TOKEN = 4
+EXPECTED_COMPLETION_TOKENS = int(os.environ.get("QUOTA_EXPECTED_COMPLETION_TOKENS", 1000))
+
+# Environment variable holding each provider's key(s)
+KEY_ENV = {
+    "gemini": "GEMINI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "openai": "OPENAI_API_KEY",
+}
+
+class QuotaExceeded(Exception):
+    pass
+
+def provider_for(model):
+    if "/" in model:
+        return model.split("/", 1)[0]
+    if model.startswith("claude"):
+        return "anthropic"
+    if model.startswith("gemini"):
+        return "gemini"
+    if model.startswith(("gpt", "o1", "o3", "o4")):
+        return "openai"
+    return "default"
+
+def _env_number(name):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+def estimate_prompt_tokens(messages):
+    chars = sum(len(str(message.get("content") or "")) for message in messages or ())
+    # A few tokens of per-message overhead (role markers)
+    return chars // CHARS_PER_TOKEN + 4 * len(messages or ())
+
+def estimate_text_tokens(text_length):
+    return text_length // CHARS_PER_TOKEN
+
+# Seconds from a reset header: "20", "1.5s", "6m0s", "250ms" or an RFC 3339 / HTTP date
+def parse_reset(value, now=None):
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    now = time.time() if now is None else now
+    try:
+        if "T" in value:
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        else:
+            moment = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, moment - now)
+
+# {"requests": {"limit", "remaining", "reset"}, "tokens": {...}, "retry_after": seconds} from headers
+def parse_rate_limit_headers(headers):
+    result = {"requests": {}, "tokens": {}, "retry_after": None}
+    for name, value in (headers or {}).items():
+        name = name.lower()
+        if name.startswith("llm_provider-"):
+            name = name[len("llm_provider-"):]
+        if name == "retry-after":
+            result["retry_after"] = parse_reset(value)
+            continue
+        match = re.fullmatch(r"x-ratelimit-(limit|remaining|reset)-(requests|tokens)", name)
+        if match is None:
+            continue
+        field, resource = match.groups()
+        if field == "reset":
+            result[resource]["reset"] = parse_reset(value)
+        else:
+            try:
+                result[resource][field] = float(value)
+            except ValueError:
+                pass
+    return result
+
+# Rate limit headers of a litellm response / stream wrapper / exception
+def response_headers(obj):
+    hidden = getattr(obj, "_hidden_params", None) or {}
+    headers = hidden.get("additional_headers") if isinstance(hidden, dict) else None
+    if headers:
+        return headers
+    headers = getattr(obj, "headers", None) or getattr(obj, "litellm_response_headers", None)
+    if headers:
+        return dict(headers)
+    response = getattr(obj, "response", None)
+    return dict(getattr(response, "headers", None) or {})
+
+def is_rate_limit_error(error):
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+# Continuously refilling bucket holding up to `per_minute` units (None = unlimited)
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, per_minute=None, now=None):
+        self.capacity = None
+        self.rate = None
+        self.level = 0.0
+        self.updated = time.monotonic() if now is None else now
+        self.set_limit(per_minute, fill=True)
+
+    def set_limit(self, per_minute, fill=False):
+        if per_minute is None or per_minute <= 0:
+            self.capacity = self.rate = None
+            return
+        # A bucket that was unlimited starts full
+        fill = fill or self.capacity is None
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity if fill else min(self.level, self.capacity)
+
+    def refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `amount` fits (a request larger than the bucket fits when it is full)
+    def wait_time(self, amount):
+        if self.capacity is None:
+            return 0.0
+        deficit = min(amount, self.capacity) - self.level
+        return max(0.0, deficit / self.rate)
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def give(self, amount):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + amount)
+
+class KeyState:
+    __slots__ = ("provider", "index", "api_key", "requests", "tokens", "blocked_until", "last_used")
+
+    def __init__(self, provider, index, api_key, rpm=None, tpm=None):
+        self.provider = provider
+        self.index = index
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.last_used = 0.0
+
+    @property
+    def label(self):
+        return f"{self.provider}#{self.index}"
+
+    def wait_time(self, tokens, now):
+        return max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    # Fraction of quota left (1.0 when unlimited), used to spread load
+    def headroom(self):
+        fractions = [
+            bucket.level / bucket.capacity for bucket in (self.requests, self.tokens) if bucket.capacity
+        ]
+        return min(fractions) if fractions else 1.0
+
+    def status(self, now):
+        return {
+            "rpm": self.requests.capacity,
+            "requests_left": self.requests.level if self.requests.capacity else None,
+            "tpm": self.tokens.capacity,
+            "tokens_left": self.tokens.level if self.tokens.capacity else None,
+            "blocked_for": max(0.0, self.blocked_until - now),
+        }
+
+class Lease:
+    __slots__ = ("key", "tokens")
+
+    def __init__(self, key, tokens):
+        self.key = key
+        self.tokens = tokens
+
+class _Waiter:
+    __slots__ = ("provider", "tokens", "arrived", "background", "lease")
+
+    def __init__(self, provider, tokens, arrived, background=False):
+        self.provider = provider
+        self.tokens = tokens
+        self.arrived = arrived
+        self.background = background
+        self.lease = None
+
+class QuotaScheduler:
+    def __init__(self, max_wait=MAX_WAIT, starvation_seconds=STARVATION_SECONDS, max_retries=MAX_RETRIES):
+        self.max_wait = max_wait
+        self.starvation_seconds = starvation_seconds
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._keys = {}
+        self._waiters = []
+        # This process's share of every key's limits (1 / QUOTA_WORKERS)
+        self.share = None
+
+    # Keys of a provider from the environment (created on first use)
+    def keys(self, provider):
+        keys = self._keys.get(provider)
+        if keys is None:
+            env = KEY_ENV.get(provider, f"{provider.upper()}_API_KEY")
+            values = [k.strip() for k in os.environ.get(env + "S", "").split(",") if k.strip()]
+            if not values:
+                # None: let litellm read the usual environment variable itself
+                values = [None]
+            prefix = f"QUOTA_{provider.upper()}"
+            rpm, tpm = self._shared(_env_number(prefix + "_RPM")), self._shared(_env_number(prefix + "_TPM"))
+            keys = self._keys[provider] = [KeyState(provider, n, key, rpm, tpm) for n, key in enumerate(values)]
+        return keys
+
+    # This process's part of a per-key amount (limit or remaining quota)
+    def _shared(self, amount):
+        if self.share is None:
+            self.share = 1.0 / worker_count()
+        return None if amount is None else amount * self.share
+
+    # Limits of this process (not divided by QUOTA_WORKERS)
+    def configure(self, provider, api_keys=None, rpm=None, tpm=None):
+        with self._cond:
+            if api_keys is not None:
+                self._keys[provider] = [KeyState(provider, n, key, rpm, tpm) for n, key in enumerate(api_keys)]
+            else:
+                for key in self.keys(provider):
+                    key.requests.set_limit(rpm, fill=True)
+                    key.tokens.set_limit(tpm, fill=True)
+            self._cond.notify_all()
+
+    # Key with room for `tokens` and most headroom (at least `reserve` left), or None
+    def _best_key(self, provider, tokens, now, reserve=0.0):
+        best = None
+        for key in self.keys(provider):
+            key.requests.refill(now)
+            key.tokens.refill(now)
+            if key.wait_time(tokens, now) > 0 or key.headroom() < reserve:
+                continue
+            if best is None or (key.headroom(), -key.last_used) > (best.headroom(), -best.last_used):
+                best = key
+        return best
+
+    # Grant leases to waiters that fit, in arrival order (smaller ones may pass until starvation;
+    # background ones only while no foreground request of their provider is held)
+    def _schedule(self, now):
+        blocked = set()
+        held = set()
+        granted = False
+        for waiter in self._waiters:
+            if waiter.lease is not None or waiter.provider in blocked:
+                continue
+            if waiter.background and waiter.provider in held:
+                continue
+            reserve = BACKGROUND_RESERVE if waiter.background else 0.0
+            key = self._best_key(waiter.provider, waiter.tokens, now, reserve)
+            if key is None:
+                if not waiter.background:
+                    held.add(waiter.provider)
+                    if now - waiter.arrived >= self.starvation_seconds:
+                        blocked.add(waiter.provider)
+                continue
+            key.requests.take(1)
+            key.tokens.take(waiter.tokens)
+            key.last_used = now
+            waiter.lease = Lease(key, waiter.tokens)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _next_wait(self, waiter, now):
+        return min(key.wait_time(waiter.tokens, now) for key in self.keys(waiter.provider))
+
+    # Block until a key of the model's provider has room for `tokens`; returns a Lease
+    def acquire(self, model, tokens, timeout=None, background=False):
+        provider = provider_for(model)
+        if timeout is None:
+            timeout = BACKGROUND_MAX_WAIT if background else self.max_wait
+        started = time.monotonic()
+        with self._cond:
+            waiter = _Waiter(provider, tokens, started, background)
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._schedule(now)
+                    if waiter.lease is not None:
+                        break
+                    remaining = started + timeout - now
+                    if remaining <= 0:
+                        metrics.incr("quota_timeouts", provider=provider)
+                        raise QuotaExceeded(
+                            f"Rate limit for {provider} reached; the request waited {timeout:g}s for quota"
+                        )
+                    # Re-check at least every second: other leases release tokens or headers change limits
+                    self._cond.wait(min(remaining, max(0.01, self._next_wait(waiter, now)), 1.0))
+            finally:
+                self._waiters.remove(waiter)
+        waited = time.monotonic() - started
+        metrics.observe("quota_wait_seconds", waited, provider=provider)
+        metrics.incr("quota_requests", key=waiter.lease.key.label, held=waited > 0.01)
+        return waiter.lease
+
+    # Return a lease: reconcile the tokens actually used and learn limits from headers
+    def release(self, lease, used_tokens=None, headers=None, rate_limited=False):
+        key = lease.key
+        with self._cond:
+            now = time.monotonic()
+            key.requests.refill(now)
+            key.tokens.refill(now)
+            if used_tokens is not None:
+                # Refund the over-estimate (or charge the under-estimate)
+                key.tokens.give(lease.tokens - used_tokens)
+            info = parse_rate_limit_headers(headers)
+            for resource, bucket in (("requests", key.requests), ("tokens", key.tokens)):
+                learned = info[resource]
+                if learned.get("limit"):
+                    bucket.set_limit(self._shared(learned["limit"]))
+                if learned.get("remaining") is not None and bucket.capacity is not None:
+                    bucket.level = min(bucket.level, self._shared(learned["remaining"]))
+                    if learned["remaining"] <= 0 and learned.get("reset"):
+                        key.blocked_until = max(key.blocked_until, now + learned["reset"])
+            if rate_limited:
+                cooldown = info["retry_after"] or RATE_LIMIT_COOLDOWN
+                key.blocked_until = max(key.blocked_until, now + cooldown)
+                metrics.incr("quota_rate_limited", key=key.label)
+            self._cond.notify_all()
+
+    # Scheduled drop-in for litellm.completion (stream=True returns a metered iterator);
+    # background=True schedules it at the lowest priority
+    def completion(self, completion_func, *args, background=False, **kwargs):
+        prompt_tokens = estimate_prompt_tokens(kwargs.get("messages"))
+        lease, response, attempt = self._dispatch(completion_func, args, kwargs, background, prompt_tokens, 0)
+        if kwargs.get("stream"):
+            return self._metered_stream(lease, response, prompt_tokens, completion_func, args, kwargs, background, attempt)
+        self.release(lease, _usage_tokens(response), response_headers(response))
+        return response
+
+    # Acquire a lease and call the provider, retrying 429s on the next available key;
+    # returns (lease, response, attempts so far)
+    def _dispatch(self, completion_func, args, kwargs, background, prompt_tokens, attempt):
+        model = kwargs.get("model", args[0] if args else "")
+        tokens = prompt_tokens + (kwargs.get("max_tokens") or EXPECTED_COMPLETION_TOKENS)
+        while True:
+            lease = self.acquire(model, tokens, background=background)
+            call_kwargs = dict(kwargs)
+            if lease.key.api_key is not None:
+                call_kwargs["api_key"] = lease.key.api_key
+            try:
+                return lease, completion_func(*args, **call_kwargs), attempt
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self.release(lease, used_tokens=0, headers=response_headers(e), rate_limited=True)
+                    if self._may_retry(attempt, background, lease):
+                        attempt += 1
+                        continue
+                else:
+                    # Failed before generating anything: refund the tokens (the request still counts)
+                    self.release(lease, used_tokens=0)
+                raise
+
+    def _may_retry(self, attempt, background, lease):
+        if attempt >= self.max_retries or background:
+            return False
+        metrics.incr("quota_retries", provider=lease.key.provider)
+        return True
+
+    def _metered_stream(self, lease, response, prompt_tokens, completion_func, args, kwargs, background, attempt):
+        while True:
+            completion_chars = 0
+            usage = None
+            rate_limit_headers = None
+            try:
+                for chunk in response:
+                    usage = _usage_tokens(chunk) or usage
+                    choices = getattr(chunk, "choices", None)
+                    if choices:
+                        content = getattr(choices[0].delta, "content", None)
+                        if content:
+                            completion_chars += len(content)
+                    yield chunk
+                return
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                rate_limit_headers = response_headers(e)
+                # Content already reached the consumer: the request can't be replayed
+                if completion_chars or not self._may_retry(attempt, background, lease):
+                    raise
+            finally:
+                # Also runs when the consumer stops early (generator closed)
+                rate_limited = rate_limit_headers is not None
+                if rate_limited and not completion_chars:
+                    used = 0
+                else:
+                    used = usage if usage is not None else prompt_tokens + estimate_text_tokens(completion_chars)
+                self.release(
+                    lease, used, rate_limit_headers if rate_limited else response_headers(response),
+                    rate_limited=rate_limited,
+                )
+            # Rate limited before any content: retry on the next available key
+            attempt += 1
+            lease, response, attempt = self._dispatch(completion_func, args, kwargs, background, prompt_tokens, attempt)
+
+    def status(self):
+        with self._cond:
+            now = time.monotonic()
+            for keys in self._keys.values():
+                for key in keys:
+                    key.requests.refill(now)
+                    key.tokens.refill(now)
+            return {
+                "waiting": len(self._waiters),
+                "keys": {key.label: key.status(now) for keys in self._keys.values() for key in keys},
+            }
+
+def _usage_tokens(response):
+    usage = getattr(response, "usage", None)
+    total = getattr(usage, "total_tokens", None) if usage is not None else None
+    return total or None
+
+# Process-wide scheduler used by providers.completion()
+scheduler = QuotaScheduler()
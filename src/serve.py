@@ -0,0 +1,317 @@
+import argparse
+import gc
+import importlib
+import importlib.util
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+import uvicorn
+
+# Production entry point for the FastAPI app.
+#
+#   python src/serve.py --workers 4 --preload --profile fast   # production (Docker/Render)
+#   python src/serve.py --profile-startup                       # import-time / memory breakdown
+#
+# With --preload the parent imports the app and warms litellm once, then forks the
+# workers, so every worker starts ready and shares those pages copy-on-write.
+# Without it each worker imports everything itself after the fork.
+#
+# On SIGTERM (deploys, restarts) each worker stops listening and drains its
+# in-flight generations for up to --drain-timeout seconds before closing
+# connections; generations still running then are interrupted with their partial
+# output persisted (see drain.py).
+#
+# --profile selects the serving profile: "default" runs the stdlib asyncio loop,
+# the h11 HTTP parser and the stdlib JSON encoder; "fast" runs uvloop, httptools
+# and orjson (each only if installed, falling back to the default part otherwise).
+# benchmarks/serving_benchmark.py compares their CPU cost per streamed token.
+#
+# The parent restarts workers that exit. A worker failing within
+# FAST_FAILURE_SECONDS of its start (bad import, bind error, ...) is restarted
+# after an exponentially growing delay, and after MAX_FAST_FAILURES such failures
+# in a row the server stops its workers and exits with an error.
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(src_dir)
+
+import providers  # noqa: E402  (lightweight, does not import litellm)
+import drain  # noqa: E402
+import journal  # noqa: E402
+import ledger  # noqa: E402
+import shadow  # noqa: E402
+import sse  # noqa: E402
+
+# Module and attribute of the ASGI app served by the workers
+APP_MODULE = "app"
+APP_ATTR = "app"
+
+# A worker exiting sooner than this after its start counts as a failed start
+FAST_FAILURE_SECONDS = 10
+
+# Restart delay after a failed start, doubled for each further one in a row
+RESTART_BASE_DELAY = 0.5
+RESTART_MAX_DELAY = 10
+
+# Failed starts in a row after which the server gives up
+MAX_FAST_FAILURES = int(os.environ.get("WORKER_MAX_FAST_FAILURES", 5))
+
+# Serving profiles: uvicorn event loop and HTTP parser, and whether to use orjson
+PROFILES = {
+    "default": {"loop": "asyncio", "http": "h11", "fast_json": False},
+    "fast": {"loop": "uvloop", "http": "httptools", "fast_json": True},
+}
+
+# Apply a serving profile in this process; returns the uvicorn settings to use
+def apply_profile(name):
+    profile = PROFILES[name]
+    loop = profile["loop"] if importlib.util.find_spec(profile["loop"]) else "asyncio"
+    http = profile["http"] if importlib.util.find_spec(profile["http"]) else "h11"
+    json_encoder = "orjson" if sse.use_fast_json(profile["fast_json"]) else "json"
+    print(f"Serving profile {name}: loop {loop}, http {http}, json {json_encoder}", flush=True)
+    return {"loop": loop, "http": http}
+
+# Import the app module and return the ASGI app
+def load_app():
+    module = importlib.import_module(APP_MODULE)
+    return getattr(module, APP_ATTR)
+
+# Format a memory snapshot for log lines
+def format_memory(memory):
+    if not memory:
+        return "memory n/a"
+    return f"rss {memory['rss']:.1f} MB, pss {memory['pss']:.1f} MB, shared {memory['shared']:.1f} MB"
+
+# Run one timed startup stage and record its duration and memory afterwards
+def _timed_stage(stages, name, func):
+    start = time.perf_counter()
+    func()
+    stages.append((name, time.perf_counter() - start, providers.memory_usage_mb()))
+
+# Aggregate `python -X importtime` output by top-level package (self time, seconds)
+def import_breakdown(code, top=15):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=src_dir,
+        capture_output=True,
+        text=True,
+    )
+    totals = {}
+    pattern = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(\S.*)$")
+    for line in result.stderr.splitlines():
+        match = pattern.match(line)
+        if not match:
+            continue
+        package = match.group(3).strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(match.group(1)) / 1e6
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+# Print the startup profile: staged time-to-ready plus per-package import cost
+def profile_startup(top=15):
+    stages = []
+    baseline = providers.memory_usage_mb()
+    _timed_stage(stages, "import fastapi", lambda: importlib.import_module("fastapi"))
+    _timed_stage(stages, "import app (create_app)", load_app)
+    _timed_stage(stages, "warm providers (litellm)", providers.warm)
+
+    print("Startup stages")
+    print(f"  {'baseline':<28} {'':>8}  {format_memory(baseline)}")
+    for name, seconds, memory in stages:
+        print(f"  {name:<28} {seconds:>7.3f}s  {format_memory(memory)}")
+    print(f"  {'time-to-ready (lazy)':<28} {sum(s for _, s, _ in stages[:2]):>7.3f}s")
+    print(f"  {'time-to-ready (eager)':<28} {sum(s for _, s, _ in stages):>7.3f}s")
+
+    print(f"\nImport time by package (top {top}, self time)")
+    code = f"import {APP_MODULE}, providers; providers.warm()"
+    for package, seconds in import_breakdown(code, top):
+        print(f"  {package:<28} {seconds:>7.3f}s")
+
+# uvicorn server that logs time-to-ready and memory once it is accepting connections,
+# and drains in-flight generations on shutdown
+class WorkerServer(uvicorn.Server):
+    def __init__(self, config, started_at, drain_timeout=drain.DRAIN_TIMEOUT):
+        super().__init__(config)
+        self.started_at = started_at
+        self.drain_timeout = drain_timeout
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        print(
+            f"Worker {os.getpid()} ready in {time.perf_counter() - self.started_at:.2f}s "
+            f"({format_memory(providers.memory_usage_mb())}, litellm loaded: {providers.is_loaded()})",
+            flush=True,
+        )
+
+    async def shutdown(self, sockets=None):
+        # Stop accepting connections, then let in-flight generations finish before
+        # uvicorn closes the connections that remain
+        for server in self.servers:
+            server.close()
+        summary = await drain.controller.drain(self.drain_timeout)
+        print(
+            f"Worker {os.getpid()} drained {summary['inflight']} generation(s) in {summary['duration']:.2f}s "
+            f"({summary['completed']} completed, {summary['interrupted']} interrupted)",
+            flush=True,
+        )
+        await super().shutdown(sockets=sockets)
+        # Cut off shadow requests still running (see shadow.py)
+        shadow.close()
+        # Persist journaled responses (including interrupted ones) and usage records:
+        # uvicorn re-raises the termination signal once serving stops, so the worker
+        # exits right after
+        journal.close()
+        ledger.close()
+
+# Body of a forked worker: serve the (possibly preloaded) app on the shared socket
+def run_worker(sock, application, args, started_at, server_settings):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if application is None:
+        application = load_app()
+    # Connections still open after the drain are closed within a few seconds
+    config = uvicorn.Config(
+        application, log_level=args.log_level, lifespan="on", timeout_graceful_shutdown=drain.INTERRUPT_GRACE + 1,
+        **server_settings,
+    )
+    WorkerServer(config, started_at, args.drain_timeout).run(sockets=[sock])
+
+# Fork a worker process; returns the child pid in the parent
+def spawn_worker(sock, application, args, started_at, server_settings):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock, application, args, started_at, server_settings)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            print(f"Worker {os.getpid()} failed:", file=sys.stderr, flush=True)
+            traceback.print_exc()
+            code = 1
+        finally:
+            # os._exit skips the interpreter's flush of the standard streams
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    return pid
+
+# Pre-fork server: bind once, optionally preload, then fork and supervise workers
+def serve(args):
+    started_at = time.perf_counter()
+    # Every worker schedules its share of the provider quotas (see quota.py)
+    os.environ.setdefault("QUOTA_WORKERS", str(max(1, args.workers)))
+    server_settings = apply_profile(args.profile)
+    application = None
+    if args.preload:
+        timings = providers.warm()
+        application = load_app()
+        print(
+            f"Preloaded app in {time.perf_counter() - started_at:.2f}s "
+            f"(litellm {timings.get('import litellm', 0):.2f}s, {format_memory(providers.memory_usage_mb())})",
+            flush=True,
+        )
+        # Move preloaded objects out of GC tracking so collections in workers don't dirty shared pages
+        gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    print(f"Listening on http://{args.host}:{args.port} with {args.workers} workers", flush=True)
+
+    if args.workers <= 1:
+        run_worker(sock, application, args, started_at, server_settings)
+        return
+
+    # Worker pid -> time.monotonic() of its start
+    workers = {}
+    for _ in range(args.workers):
+        workers[spawn_worker(sock, application, args, started_at, server_settings)] = time.monotonic()
+
+    shutting_down = False
+    fast_failures = 0
+
+    # Forward termination signals to the workers and stop respawning
+    def handle_signal(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_started = workers.pop(pid, None)
+        if shutting_down or worker_started is None:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if time.monotonic() - worker_started >= FAST_FAILURE_SECONDS:
+            fast_failures = 0
+            delay = 0.0
+        else:
+            fast_failures += 1
+            if fast_failures >= MAX_FAST_FAILURES:
+                print(
+                    f"Worker {pid} exited with status {code}; {fast_failures} workers in a row failed within "
+                    f"{FAST_FAILURE_SECONDS}s of starting, giving up",
+                    file=sys.stderr, flush=True,
+                )
+                handle_signal(signal.SIGTERM, None)
+                for pid in list(workers):
+                    try:
+                        os.waitpid(pid, 0)
+                    except ChildProcessError:
+                        pass
+                sock.close()
+                sys.exit(1)
+            delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** (fast_failures - 1))
+        print(f"Worker {pid} exited with status {code}, restarting in {delay:g}s", flush=True)
+        # Sleep in steps so a shutdown signal during the delay is not held up
+        restart_at = time.monotonic() + delay
+        while not shutting_down and time.monotonic() < restart_at:
+            time.sleep(max(0.0, min(0.1, restart_at - time.monotonic())))
+        if not shutting_down:
+            workers[spawn_worker(sock, application, args, time.perf_counter(), server_settings)] = time.monotonic()
+    sock.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the Medical AI Assistant FastAPI app")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)))
+    parser.add_argument("--preload", action="store_true", help="import and warm heavy modules before forking workers")
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument(
+        "--profile", choices=sorted(PROFILES), default=os.environ.get("SERVING_PROFILE", "default"),
+        help="serving profile: fast uses uvloop, httptools and orjson when installed",
+    )
+    parser.add_argument(
+        "--drain-timeout", type=float, default=drain.DRAIN_TIMEOUT,
+        help="seconds in-flight generations get to finish on shutdown",
+    )
+    parser.add_argument("--profile-startup", action="store_true", help="print the startup import-time breakdown and exit")
+    parser.add_argument("--top", type=int, default=15, help="packages shown by --profile-startup")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.profile_startup:
+        profile_startup(args.top)
+    else:
+        serve(args)
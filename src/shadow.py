@@ -0,0 +1,589 @@
+import hashlib
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import metrics
+import quota
+from ledger import usage_counts
+
+# Shadow traffic to candidate models.
+#
+# providers.completion() hands every dispatched completion to mirror(). A sample
+# (SHADOW_SAMPLE_RATE) of the live ones (ledger kind "chat", so no warm-ups,
+# condensing calls or shadow calls) is sent again, with the same messages, to
+# each model in SHADOW_MODELS. The candidates run in this process's shadow
+# thread pool (SHADOW_CONCURRENCY threads at a lowered OS priority), separate
+# from the generation threads, and at background priority in the quota
+# scheduler, so they never hold up live requests; when SHADOW_MAX_PENDING
+# candidates are already queued the sample is dropped. The primary response is
+# returned untouched apart from a pass-through iterator that notes its first
+# token, end, usage and text; nothing a candidate does can delay or fail it.
+#
+# Once the primary and all candidates of a sample have finished, the comparison
+# (input hash and length, then model, status, TTFT, duration, tokens and output
+# hash of each) is appended to SHADOW_DIR/shadow-<day>-<pid>.jsonl, a private
+# (0600) file in a private (0700) directory. The message and answers are patient
+# data and only stored with SHADOW_STORE_TEXT=1; files are deleted
+# SHADOW_RETENTION_DAYS after their last write. Times are measured from each
+# run's completion call (quota waits included); a candidate's time in the queue
+# is recorded separately. report() summarizes the comparisons of all processes
+# per model, with each candidate's TTFT and duration relative to the primary of
+# the same request, and never includes text (GET /shadow, which needs the admin
+# token). Files are read incrementally, from where the previous report stopped.
+# Candidates are billed and appear in the ledger with kind "shadow".
+
+# Candidate models, comma separated (empty disables shadow traffic)
+MODELS = [model.strip() for model in os.environ.get("SHADOW_MODELS", "").split(",") if model.strip()]
+
+# Fraction of live requests mirrored to the candidates
+SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", 0.05))
+
+# Candidate requests streaming at once per process
+CONCURRENCY = int(os.environ.get("SHADOW_CONCURRENCY", 2))
+
+# Candidate requests queued per process; further samples are dropped
+MAX_PENDING = int(os.environ.get("SHADOW_MAX_PENDING", 20))
+
+# Request timeout of candidate calls (seconds)
+TIMEOUT = float(os.environ.get("SHADOW_TIMEOUT", 120))
+
+# Niceness added to the shadow threads (Linux; 0 leaves their priority alone)
+NICE = int(os.environ.get("SHADOW_NICE", 10))
+
+SHADOW_DIR = os.environ.get(
+    "SHADOW_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "shadow"),
+)
+
+# Set SHADOW_STORE_TEXT=1 to also store the message and answers of each comparison
+# (patient data); by default only their SHA-256 and length are stored
+STORE_TEXT = os.environ.get("SHADOW_STORE_TEXT", "0") == "1"
+
+# Input and output characters stored per comparison (with SHADOW_STORE_TEXT=1)
+MAX_TEXT_CHARS = int(os.environ.get("SHADOW_MAX_TEXT_CHARS", 20000))
+
+# Days comparison files are kept after their last write (0 keeps them)
+RETENTION_DAYS = float(os.environ.get("SHADOW_RETENTION_DAYS", 30))
+
+# Seconds between sweeps for expired comparison files
+SWEEP_INTERVAL = 3600
+
+# Fields holding text, never returned by report()
+TEXT_FIELDS = ("input", "output")
+
+# Ledger kinds that are mirrored
+KINDS = ("chat",)
+
+# Most recent comparisons per process file read by report()
+REPORT_WINDOW = 5000
+
+class _Run:
+    __slots__ = (
+        "model", "started", "queued", "ttft", "duration", "status", "error", "usage", "chars", "output", "truncated",
+        "keep_text", "digest",
+    )
+
+    def __init__(self, model, started, keep_text=False):
+        self.model = model
+        self.started = started
+        self.queued = None
+        self.ttft = None
+        self.duration = None
+        self.status = None
+        self.error = None
+        self.usage = None
+        self.chars = 0
+        self.output = []
+        self.truncated = False
+        self.keep_text = keep_text
+        self.digest = hashlib.sha256()
+
+    # Note one stream chunk (content and usage)
+    def observe(self, chunk):
+        self.usage = usage_counts(getattr(chunk, "usage", None)) or self.usage
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            return
+        delta = getattr(choices[0], "delta", None)
+        content = getattr(delta, "content", None)
+        if content:
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self.started
+            self.add_text(content)
+
+    def add_text(self, text):
+        self.digest.update(text.encode("utf-8", "surrogatepass"))
+        if self.keep_text and self.chars < MAX_TEXT_CHARS:
+            self.output.append(text[:MAX_TEXT_CHARS - self.chars])
+        self.truncated = self.keep_text and (self.truncated or self.chars + len(text) > MAX_TEXT_CHARS)
+        self.chars += len(text)
+
+    def to_dict(self, messages):
+        if self.usage is None:
+            prompt_tokens = quota.estimate_prompt_tokens(messages)
+            completion_tokens = quota.estimate_text_tokens(self.chars)
+        else:
+            prompt_tokens, completion_tokens, _ = self.usage
+        run = {
+            "model": self.model,
+            "status": self.status,
+            "ttft": _rounded(self.ttft),
+            "duration": _rounded(self.duration),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "estimated": self.usage is None,
+            "chars": self.chars,
+            "output_sha256": self.digest.hexdigest(),
+        }
+        if self.keep_text:
+            run["output"] = "".join(self.output)
+        if self.truncated:
+            run["truncated"] = True
+        if self.queued is not None:
+            run["queued"] = _rounded(self.queued)
+        if self.error:
+            run["error"] = self.error
+        return run
+
+def _rounded(seconds):
+    return None if seconds is None else round(seconds, 4)
+
+# One mirrored request: the primary run and one run per candidate
+class Comparison:
+    # on_done(comparison) is called once every run has finished; keep_text stores the
+    # message and outputs besides their hashes
+    def __init__(self, model, messages, labels, started, on_done, keep_text=False):
+        self.on_done = on_done
+        self.keep_text = keep_text
+        self.id = uuid.uuid4().hex
+        self.time = time.time()
+        self.messages = messages
+        self.labels = {name: value for name, value in (labels or {}).items() if name != "kind"}
+        self.primary = _Run(model, started, keep_text)
+        self.candidates = []
+        self._remaining = 1
+        self._lock = threading.Lock()
+
+    def add_candidate(self, model):
+        run = _Run(model, time.perf_counter(), self.keep_text)
+        with self._lock:
+            self.candidates.append(run)
+            self._remaining += 1
+        return run
+
+    def drop_candidate(self, run):
+        with self._lock:
+            self.candidates.remove(run)
+        self.finish(None)
+
+    # Called once per run (None for a dropped candidate)
+    def finish(self, run, status=None, error=None):
+        if run is not None:
+            run.duration = time.perf_counter() - run.started
+            run.status = status
+            run.error = error
+        with self._lock:
+            self._remaining -= 1
+            done = self._remaining == 0
+        if done and self.candidates:
+            self.on_done(self)
+
+    def to_dict(self):
+        message = ""
+        for item in reversed(self.messages or ()):
+            if item.get("role") == "user":
+                message = str(item.get("content") or "")
+                break
+        record = {
+            "id": self.id,
+            "time": round(self.time, 3),
+            **self.labels,
+            "input_sha256": _sha256(message),
+            "input_chars": len(message),
+            "primary": self.primary.to_dict(self.messages),
+            "candidates": [run.to_dict(self.messages) for run in self.candidates],
+        }
+        if self.keep_text:
+            record["input"] = message[:MAX_TEXT_CHARS]
+        return record
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+# A comparison record without its text fields
+def _without_text(record):
+    record = {name: value for name, value in record.items() if name not in TEXT_FIELDS}
+    for key in ("primary", "candidates"):
+        runs = record.get(key)
+        if isinstance(runs, dict):
+            record[key] = {name: value for name, value in runs.items() if name not in TEXT_FIELDS}
+        elif isinstance(runs, list):
+            record[key] = [{name: value for name, value in run.items() if name not in TEXT_FIELDS} for run in runs]
+    return record
+
+def _lower_priority():
+    if NICE:
+        try:
+            # Per-thread on Linux (the thread id is a process id for setpriority)
+            niceness = min(19, os.getpriority(os.PRIO_PROCESS, 0) + NICE)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+        except (AttributeError, OSError):
+            pass
+
+class Shadow:
+    def __init__(self, models=MODELS, sample_rate=SAMPLE_RATE, concurrency=CONCURRENCY, max_pending=MAX_PENDING,
+                 shadow_dir=SHADOW_DIR, store_text=STORE_TEXT, retention_days=RETENTION_DAYS):
+        self.models = list(models)
+        self.sample_rate = sample_rate
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.shadow_dir = shadow_dir
+        self.store_text = store_text
+        self.retention_days = retention_days
+        self.pending = 0
+        self.running = 0
+        self.mirrored = 0
+        self.dropped = 0
+        self.written = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._next_sweep = 0
+        # Comparison files read by report(): name -> [offset, inode, deque of records without text]
+        self._read = {}
+        self._read_lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.models) and self.sample_rate > 0
+
+    # Thread pool of this process (created on first use, so forked workers get their own)
+    def _get_executor(self):
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                # Nothing of the parent's pool carries over a fork
+                self._executor = None
+                self._executor_pid = os.getpid()
+                self.pending = self.running = 0
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix="shadow", initializer=_lower_priority
+                )
+            return self._executor
+
+    # Called by providers.completion() with a dispatched primary response; returns the
+    # response to hand back (the same one, or a pass-through iterator when sampled)
+    def mirror(self, response, model, messages, labels, stream, started, completion):
+        if not self.enabled or ((labels or {}).get("kind") or "chat") not in KINDS:
+            return response
+        if self._closed or random.random() >= self.sample_rate:
+            return response
+        try:
+            comparison = self._start(model, messages, labels, started, completion)
+        except Exception:
+            metrics.incr("shadow_errors")
+            return response
+        if comparison is None:
+            return response
+        if stream:
+            return self._observed(response, comparison)
+        self._observe_complete(response, comparison)
+        return response
+
+    def _start(self, model, messages, labels, started, completion):
+        candidates = [candidate for candidate in self.models if candidate != model]
+        if not candidates:
+            return None
+        executor = self._get_executor()
+        with self._lock:
+            if self.pending + len(candidates) > self.max_pending:
+                self.dropped += 1
+                metrics.incr("shadow_dropped")
+                return None
+            self.pending += len(candidates)
+            self.mirrored += 1
+        metrics.incr("shadow_mirrored")
+        comparison = Comparison(model, messages, labels, started, self._finished, self.store_text)
+        for candidate in candidates:
+            run = comparison.add_candidate(candidate)
+            try:
+                executor.submit(self._run_candidate, comparison, run, completion)
+            except RuntimeError:
+                # Shutting down
+                with self._lock:
+                    self.pending -= 1
+                comparison.drop_candidate(run)
+        return comparison
+
+    # Pass-through of the primary stream that notes timings, usage and text
+    def _observed(self, response, comparison):
+        run = comparison.primary
+        status, error = "cancelled", None
+        try:
+            for chunk in response:
+                try:
+                    run.observe(chunk)
+                except Exception:
+                    pass
+                yield chunk
+            status = "complete"
+        except Exception as e:
+            status, error = "error", str(e)
+            raise
+        finally:
+            try:
+                comparison.finish(run, status, error)
+            except Exception:
+                metrics.incr("shadow_errors")
+
+    def _observe_complete(self, response, comparison):
+        run = comparison.primary
+        try:
+            run.ttft = time.perf_counter() - run.started
+            run.usage = usage_counts(getattr(response, "usage", None))
+            choices = getattr(response, "choices", None)
+            if choices:
+                run.add_text(getattr(choices[0].message, "content", None) or "")
+            comparison.finish(run, "complete")
+        except Exception:
+            metrics.incr("shadow_errors")
+
+    def _run_candidate(self, comparison, run, completion):
+        with self._lock:
+            self.pending -= 1
+            self.running += 1
+        run.queued = time.perf_counter() - run.started
+        run.started = time.perf_counter()
+        status, error = "cancelled", None
+        try:
+            if not self._closed:
+                response = completion(
+                    model=run.model, messages=comparison.messages, stream=True, timeout=TIMEOUT,
+                    usage_labels={**comparison.labels, "kind": "shadow"}, background=True,
+                )
+                for chunk in response:
+                    if self._closed:
+                        response.close()
+                        break
+                    run.observe(chunk)
+                else:
+                    status = "complete"
+        except quota.QuotaExceeded as e:
+            status, error = "skipped", str(e)
+        except Exception as e:
+            status, error = "error", str(e) or type(e).__name__
+        finally:
+            with self._lock:
+                self.running -= 1
+            metrics.incr("shadow_runs", model=run.model, status=status)
+            if run.ttft is not None:
+                metrics.observe("shadow_ttft_seconds", run.ttft, model=run.model)
+            comparison.finish(run, status, error)
+
+    # Write a finished comparison from the shadow pool (the last run may be the primary's)
+    def _finished(self, comparison):
+        try:
+            self._get_executor().submit(self.write, comparison)
+        except RuntimeError:
+            # Shutting down
+            pass
+
+    # Append a finished comparison to this process's file of the day
+    def write(self, comparison):
+        line = json.dumps(comparison.to_dict(), ensure_ascii=False) + "\n"
+        day = datetime.fromtimestamp(comparison.time, timezone.utc).strftime("%Y%m%d")
+        try:
+            with self._write_lock:
+                self._private_dir()
+                path = os.path.join(self.shadow_dir, f"shadow-{day}-{os.getpid()}.jsonl")
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                with open(fd, "a", encoding="utf-8") as f:
+                    f.write(line)
+            self.written += 1
+        except OSError:
+            metrics.incr("shadow_errors")
+        self._sweep_due()
+
+    # Create the comparison directory readable by the server user only
+    def _private_dir(self):
+        os.makedirs(self.shadow_dir, mode=0o700, exist_ok=True)
+        if os.stat(self.shadow_dir).st_mode & 0o077:
+            os.chmod(self.shadow_dir, 0o700)
+
+    # Sweep for expired files at most every SWEEP_INTERVAL (after writes and reports)
+    def _sweep_due(self):
+        with self._lock:
+            if time.monotonic() < self._next_sweep:
+                return
+            self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+        self.remove_expired()
+
+    # Delete comparison files last written before the retention window
+    def remove_expired(self):
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        try:
+            names = os.listdir(self.shadow_dir)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith("shadow-") and name.endswith(".jsonl"):
+                file_path = os.path.join(self.shadow_dir, name)
+                try:
+                    if os.path.getmtime(file_path) < cutoff:
+                        os.remove(file_path)
+                        metrics.incr("shadow_files_expired")
+                except OSError:
+                    pass
+
+    # Stop mirroring in this process: queued candidates are dropped and running ones
+    # cut off at their next chunk (forked workers call this on shutdown, see serve.py)
+    def close(self):
+        self._closed = True
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "models": self.models,
+            "sample_rate": self.sample_rate,
+            "store_text": self.store_text,
+            "pending": self.pending,
+            "running": self.running,
+            "mirrored": self.mirrored,
+            "dropped": self.dropped,
+            "written": self.written,
+        }
+
+    # Recent comparisons of all processes (the last REPORT_WINDOW of each file, without
+    # text), newest first
+    def comparisons(self, limit=None):
+        self._sweep_due()
+        try:
+            names = {name for name in os.listdir(self.shadow_dir) if name.startswith("shadow-")}
+        except OSError:
+            names = set()
+        records = []
+        with self._read_lock:
+            for name in list(self._read):
+                if name not in names:
+                    del self._read[name]
+            for name in names:
+                records.extend(self._read_new(name))
+        records.sort(key=lambda record: record.get("time", 0), reverse=True)
+        return records if limit is None else records[:limit]
+
+    # Records of one file, reading only the lines appended since the previous call
+    def _read_new(self, name):
+        file_path = os.path.join(self.shadow_dir, name)
+        try:
+            with open(file_path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                state = self._read.get(name)
+                if state is None or state[1] != stat.st_ino or stat.st_size < state[0]:
+                    state = self._read[name] = [0, stat.st_ino, deque(maxlen=REPORT_WINDOW)]
+                f.seek(state[0])
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Still being written
+                        break
+                    state[0] += len(line)
+                    try:
+                        state[2].append(_without_text(json.loads(line)))
+                    except ValueError:
+                        pass
+        except OSError:
+            state = self._read.pop(name, None)
+            return state[2] if state else ()
+        return state[2]
+
+    # Per-model side-by-side summary plus the `recent` latest comparisons (metrics and
+    # hashes only)
+    def report(self, since=None, recent=20, model=None):
+        records = [record for record in self.comparisons() if since is None or record.get("time", 0) >= since]
+        if model is not None:
+            records = [
+                record for record in records
+                if record["primary"]["model"] == model or any(run["model"] == model for run in record["candidates"])
+            ]
+        primaries, candidates = {}, {}
+        for record in records:
+            primary = record["primary"]
+            primaries.setdefault(primary["model"], []).append((primary, None))
+            for run in record["candidates"]:
+                candidates.setdefault((primary["model"], run["model"]), []).append((run, primary))
+        return {
+            **self.status(),
+            "comparisons": len(records),
+            "primary": [_summary(name, runs) for name, runs in sorted(primaries.items())],
+            "candidates": [
+                {"primary_model": primary, **_summary(name, runs)} for (primary, name), runs in sorted(candidates.items())
+            ],
+            "recent": records[:recent],
+        }
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 4)
+
+def _median(values):
+    return round(statistics.median(values), 4) if values else None
+
+# Summary of one model's runs; `paired` runs also get their difference to the primary
+def _summary(model, runs):
+    complete = [run for run, _ in runs if run["status"] == "complete"]
+    ttfts = [run["ttft"] for run in complete if run["ttft"] is not None]
+    durations = [run["duration"] for run in complete if run["duration"] is not None]
+    summary = {
+        "model": model,
+        "runs": len(runs),
+        "complete": len(complete),
+        "errors": sum(run["status"] == "error" for run, _ in runs),
+        "skipped": sum(run["status"] in ("skipped", "cancelled") for run, _ in runs),
+        "ttft_p50": _percentile(ttfts, 0.5),
+        "ttft_p95": _percentile(ttfts, 0.95),
+        "duration_p50": _percentile(durations, 0.5),
+        "duration_p95": _percentile(durations, 0.95),
+        "completion_tokens_mean": (
+            round(statistics.fmean(run["completion_tokens"] for run in complete), 1) if complete else None
+        ),
+        "output_chars_mean": round(statistics.fmean(run["chars"] for run in complete), 1) if complete else None,
+    }
+    pairs = [
+        (run, primary) for run, primary in runs
+        if primary is not None and run["status"] == "complete" and primary["status"] == "complete"
+    ]
+    if any(primary is not None for _, primary in runs):
+        summary["vs_primary"] = {
+            "pairs": len(pairs),
+            "ttft_delta_p50": _median([
+                run["ttft"] - primary["ttft"] for run, primary in pairs
+                if run["ttft"] is not None and primary["ttft"] is not None
+            ]),
+            "duration_delta_p50": _median([run["duration"] - primary["duration"] for run, primary in pairs]),
+            "completion_tokens_ratio_p50": _median([
+                run["completion_tokens"] / primary["completion_tokens"] for run, primary in pairs
+                if primary["completion_tokens"]
+            ]),
+        }
+    return summary
+
+# Process-wide shadow traffic used by providers.completion()
+shadow = Shadow()
+
+def close():
+    shadow.close()
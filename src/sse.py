@@ -0,0 +1,58 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is optional (fast serving profile); the stdlib encoder is always available
+    orjson = None
+
+# Wire encoding of streamed events (SSE frames, NDJSON lines, WebSocket messages).
+#
+# Frames are built as bytes in one step: the JSON payload is encoded straight to
+# bytes and joined with pre-encoded "event: ...\ndata: " prefixes, so no
+# intermediate str is formatted and re-encoded per chunk. The JSON encoder is
+# the stdlib one by default; the fast serving profile (serve.py --profile fast,
+# or SERVING_PROFILE=fast) switches to orjson when it is installed.
+
+# "fast" selects orjson at import time (serve.py applies the rest of the profile)
+SERVING_PROFILE = os.environ.get("SERVING_PROFILE", "default")
+
+def _stdlib_dumps(data):
+    return json.dumps(data).encode("utf-8")
+
+def _orjson_dumps(data):
+    return orjson.dumps(data)
+
+# JSON-encode data to bytes with the active encoder
+dumps = _stdlib_dumps
+
+# Switch the JSON encoder; returns True if orjson is active
+def use_fast_json(enabled=True):
+    global dumps
+    dumps = _orjson_dumps if enabled and orjson is not None else _stdlib_dumps
+    return dumps is _orjson_dumps
+
+# Encoded "event: <name>\ndata: " prefix per event name
+_prefixes = {None: b"data: "}
+
+def _prefix(event):
+    prefix = _prefixes.get(event)
+    if prefix is None:
+        prefix = _prefixes[event] = f"event: {event}\ndata: ".encode("utf-8")
+    return prefix
+
+# One SSE frame as bytes
+def frame(data, event=None, event_id=None):
+    if event_id is not None:
+        return b"id: %d\n%s%s\n\n" % (event_id, _prefix(event), dumps(data))
+    return _prefix(event) + dumps(data) + b"\n\n"
+
+# One NDJSON line as bytes
+def ndjson_line(data):
+    return dumps(data) + b"\n"
+
+# JSON text for a WebSocket text message
+def dumps_text(data):
+    return dumps(data).decode("utf-8")
+
+use_fast_json(SERVING_PROFILE == "fast")
@@ -0,0 +1,268 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import tempfile
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always built
+    brotli = None
+
+# Asset pipeline for the FastAPI app.
+#
+#   python src/static_assets.py      # build step (run in the Docker image)
+#
+# Every file in assets/ is fingerprinted with a content hash (style.css ->
+# style.<hash>.css) and precompressed to gzip and brotli under assets/build/.
+# At startup the app loads all variants into memory and serves them with
+# Accept-Encoding negotiation, strong ETags and immutable cache headers. Missing
+# or stale build outputs are rebuilt at startup, so a fresh checkout still works.
+# Outputs and the manifest (written last) are written to a temporary file and
+# renamed into place, so a crash mid-build or several workers building at once
+# never leave a truncated file behind.
+
+BUILD_DIRNAME = "build"
+MANIFEST_NAME = "manifest.json"
+
+# Fingerprinted URLs never change content, so browsers may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Unfingerprinted URLs (and the index page) must be revalidated with the ETag
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Only text-like assets are worth compressing
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Encodings in server preference order when the client accepts several equally
+ENCODING_PREFERENCE = ("br", "gzip", "identity")
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Short content hash used in fingerprinted file names and ETags
+def fingerprint(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+def guess_content_type(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type == "application/javascript":
+        content_type += "; charset=utf-8"
+    return content_type
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+# Compress data into every supported encoding (slow, maximum-ratio settings)
+def compress_variants(data: bytes) -> dict:
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    # Keep only encodings that actually make the payload smaller
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+# Pick the response encoding from an Accept-Encoding header
+def negotiate_encoding(accept_encoding: str, available) -> str:
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        fields = part.strip().split(";")
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = "identity", 0.0
+    for encoding in ENCODING_PREFERENCE:
+        if encoding != "identity" and encoding not in available:
+            continue
+        quality = qualities.get(encoding, qualities.get("*", 1.0 if encoding == "identity" else 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+# One asset held in memory with all of its encoded variants
+class StaticAsset:
+    def __init__(self, content_type: str, identity: bytes, variants: dict):
+        self.content_type = content_type
+        self.digest = fingerprint(identity)
+        self.variants = {"identity": identity, **variants}
+
+    @classmethod
+    def from_bytes(cls, data: bytes, content_type: str):
+        variants = compress_variants(data) if is_compressible(content_type) else {}
+        return cls(content_type, data, variants)
+
+    # Build the response for this request, honouring Accept-Encoding and If-None-Match
+    def response(self, request: Request, cache_control: str) -> Response:
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), self.variants)
+        # Strong ETags must differ between encodings of the same resource
+        etag = f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+
+        body = self.variants[encoding]
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            return Response(headers=headers, media_type=self.content_type)
+        return Response(content=body, headers=headers, media_type=self.content_type)
+
+# Source files of the pipeline (top-level files in assets/, excluding the build output)
+def source_files(assets_dir: str):
+    for name in sorted(os.listdir(assets_dir)):
+        path = os.path.join(assets_dir, name)
+        if os.path.isfile(path) and not name.startswith("."):
+            yield name, path
+
+# Write `data` to `path` atomically (temporary file in the same directory, then rename);
+# an existing file with the same content is left alone
+def _write_atomic(path: str, data: bytes):
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return
+    except OSError:
+        pass
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# Build step: fingerprint and precompress every asset, returning the manifest
+def build_assets(assets_dir: str) -> dict:
+    build_dir = os.path.join(assets_dir, BUILD_DIRNAME)
+    os.makedirs(build_dir, exist_ok=True)
+
+    manifest = {}
+    outputs = {MANIFEST_NAME}
+    for name, path in source_files(assets_dir):
+        with open(path, "rb") as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        hashed_name = f"{stem}.{fingerprint(data)}{ext}"
+        manifest[name] = hashed_name
+
+        variants = {"identity": data}
+        if is_compressible(guess_content_type(name)):
+            variants.update(compress_variants(data))
+        for encoding, body in variants.items():
+            output_name = hashed_name + ENCODING_SUFFIXES.get(encoding, "")
+            outputs.add(output_name)
+            _write_atomic(os.path.join(build_dir, output_name), body)
+
+    # Remove outputs of previous asset versions (not the temporary files of a concurrent build)
+    for name in os.listdir(build_dir):
+        if name not in outputs and not name.startswith("."):
+            try:
+                os.remove(os.path.join(build_dir, name))
+            except FileNotFoundError:
+                pass
+
+    manifest_data = json.dumps(manifest, indent=2, sort_keys=True).encode()
+    _write_atomic(os.path.join(build_dir, MANIFEST_NAME), manifest_data)
+    return manifest
+
+# In-memory asset registry served under /assets
+class AssetRegistry:
+    def __init__(self, assets_dir: str, url_prefix: str = "/assets"):
+        self.assets_dir = assets_dir
+        self.url_prefix = url_prefix
+        self.manifest = {}
+        # URL file name -> (asset, cache control)
+        self.files = {}
+        self.load()
+
+    # Load build outputs into memory, rebuilding them first if missing, stale or damaged
+    def load(self):
+        build_dir = os.path.join(self.assets_dir, BUILD_DIRNAME)
+        manifest = self._read_manifest(build_dir)
+        expected = {}
+        for name, path in source_files(self.assets_dir):
+            with open(path, "rb") as f:
+                stem, ext = os.path.splitext(name)
+                expected[name] = f"{stem}.{fingerprint(f.read())}{ext}"
+        if manifest != expected or not all(self._intact(build_dir, hashed) for hashed in manifest.values()):
+            manifest = build_assets(self.assets_dir)
+
+        self.manifest = manifest
+        self.files = {}
+        for name, hashed_name in manifest.items():
+            content_type = guess_content_type(name)
+            with open(os.path.join(build_dir, hashed_name), "rb") as f:
+                identity = f.read()
+            variants = {}
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                variant_path = os.path.join(build_dir, hashed_name + suffix)
+                if os.path.exists(variant_path):
+                    with open(variant_path, "rb") as f:
+                        variants[encoding] = f.read()
+            asset = StaticAsset(content_type, identity, variants)
+            self.files[hashed_name] = (asset, IMMUTABLE_CACHE_CONTROL)
+            self.files[name] = (asset, REVALIDATE_CACHE_CONTROL)
+
+    # True if a fingerprinted output exists and its content matches its fingerprint
+    @staticmethod
+    def _intact(build_dir: str, hashed_name: str) -> bool:
+        try:
+            with open(os.path.join(build_dir, hashed_name), "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        return os.path.splitext(hashed_name)[0].endswith("." + fingerprint(data))
+
+    @staticmethod
+    def _read_manifest(build_dir: str) -> dict:
+        try:
+            with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Fingerprinted URL of an asset, for use in templates
+    def url(self, name: str) -> str:
+        return f"{self.url_prefix}/{self.manifest.get(name, name)}"
+
+    # Response for /assets/{name}, or None if there is no such asset
+    def response(self, request: Request, name: str):
+        entry = self.files.get(name)
+        if entry is None:
+            return None
+        asset, cache_control = entry
+        return asset.response(request, cache_control)
+
+# Run the build step from the command line
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assets_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, "assets")
+    for source, built in build_assets(assets_dir).items():
+        print(f"{source} -> {BUILD_DIRNAME}/{built}")
+    if brotli is None:
+        print("brotli is not installed; only gzip variants were built")
@@ -0,0 +1,614 @@
+import asyncio
+import codecs
+import json
+import os
+import queue
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+import metrics
+
+# Streaming ingestion of attached lab results and reports (POST /uploads).
+#
+# Uploads are parsed while the body streams in, never buffered whole: a CSV's
+# bytes go through a bounded pipe to a chunked pandas reader (read_csv with
+# chunksize) in a thread, text reports are scanned line by line. Each file is
+# reduced to a compact digest of its abnormal values only (lab rows flagged
+# H/L/abnormal or outside their reference range, flagged report lines), which
+# is stored as a small JSON file under UPLOADS_DIR so any worker can attach it
+# to the next chat message (attachments=[id]). Memory per upload is bounded by
+# PIPE_CHUNKS body chunks plus one CSV_CHUNK_ROWS block of rows.
+#
+# Digests hold patient data: UPLOADS_DIR is created readable by the server user
+# only (0700) and digests are written 0600. save(), load() and attach() do file
+# I/O and are called from worker threads (asyncio.to_thread); expired digests
+# are deleted by a per-process sweeper thread every SWEEP_INTERVAL seconds.
+
+# Largest accepted upload (bytes of the request body)
+MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 200 * 1024 * 1024))
+
+# Uploads parsed at once per worker
+MAX_CONCURRENT = int(os.environ.get("UPLOAD_MAX_CONCURRENT", 4))
+
+# Directory shared by the workers for digests
+UPLOADS_DIR = os.environ.get("UPLOADS_DIR", os.path.join(tempfile.gettempdir(), "medical-ai-uploads"))
+
+# Seconds a digest can be attached after its upload
+UPLOAD_TTL = float(os.environ.get("UPLOAD_TTL", 24 * 3600))
+
+# Seconds between sweeps for expired digests
+SWEEP_INTERVAL = 600
+
+# Rows per pandas chunk
+CSV_CHUNK_ROWS = 50000
+
+# Body chunks waiting for the CSV reader (backpressure on the upload beyond this)
+PIPE_CHUNKS = 16
+
+# Abnormal tests listed in a digest (most frequently abnormal first)
+MAX_DIGEST_ITEMS = 40
+
+# Distinct tests tracked per upload
+MAX_TESTS = 10000
+
+# Flagged lines kept from a text report, and their maximum length
+MAX_TEXT_LINES = 60
+MAX_LINE_CHARS = 240
+
+CSV_EXTENSIONS = {".csv": ",", ".tsv": "\t"}
+TEXT_EXTENSIONS = (".txt", ".text", ".log", ".md", ".hl7")
+
+# Lab column names, exact matches first, then names containing one of them
+COLUMN_NAMES = {
+    "test": ("test", "test name", "analyte", "component", "lab", "lab test", "name", "parameter", "observation", "item"),
+    "value": ("value", "result", "result value", "observed value", "measurement"),
+    "unit": ("unit", "units", "uom"),
+    "range": ("reference range", "ref range", "reference interval", "normal range", "range", "reference"),
+    "low": ("ref low", "reference low", "low", "lower limit", "normal low"),
+    "high": ("ref high", "reference high", "high", "upper limit", "normal high"),
+    "flag": ("flag", "abnormal flag", "abnormal", "interpretation", "status"),
+    "date": ("date", "collection date", "collected", "result date", "datetime", "time"),
+}
+
+# Flag values that mean "not abnormal"
+NORMAL_FLAGS = {"", "N", "NORMAL", "NEG", "NEGATIVE", "WNL", "-", "NAN", "NONE"}
+
+_RANGE = r"^\s*(-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)"
+_UPPER_LIMIT = r"^\s*(?:<|≤|<=)\s*(-?\d+(?:\.\d+)?)"
+_LOWER_LIMIT = r"^\s*(?:>|≥|>=)\s*(-?\d+(?:\.\d+)?)"
+_NUMBER_NOISE = r"[<>≤≥=,\s]"
+
+# Text report lines with an abnormal flag, and section headings whose lines are kept
+_FLAGGED_LINE = re.compile(r"(?:\s|\()(?:H|L|HH|LL|A|\*|HIGH|LOW)(?:\s|\)|$)|\b(?i:abnormal|critical|elevated)\b")
+_KEY_SECTION = re.compile(r"^\s*(impression|conclusion|assessment|diagnosis|findings)\s*:?", re.IGNORECASE)
+
+class UploadError(Exception):
+    pass
+
+class UnsupportedUpload(UploadError):
+    def __init__(self):
+        super().__init__("Only CSV and plain-text reports can be attached")
+
+class UploadTooLarge(UploadError):
+    def __init__(self, max_bytes):
+        super().__init__(f"Uploads are limited to {max_bytes // (1024 * 1024)} MB")
+
+def new_upload_id():
+    return secrets.token_urlsafe(12)
+
+def is_valid_upload_id(upload_id):
+    return 0 < len(upload_id) <= 64 and all(c.isalnum() or c in "-_" for c in upload_id)
+
+def digest_path(upload_id):
+    return os.path.join(UPLOADS_DIR, f"{upload_id}.json")
+
+# Create the digest directory readable by the server user only
+def _private_dir():
+    os.makedirs(UPLOADS_DIR, mode=0o700, exist_ok=True)
+    if os.stat(UPLOADS_DIR).st_mode & 0o077:
+        os.chmod(UPLOADS_DIR, 0o700)
+
+# "csv" or "text" from the file name (then content type); None if not supported
+def file_kind(filename, content_type=None):
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension in CSV_EXTENSIONS:
+        return "csv"
+    if extension in TEXT_EXTENSIONS:
+        return "text"
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in ("text/csv", "text/tab-separated-values", "application/csv"):
+        return "csv"
+    if content_type.startswith("text/"):
+        return "text"
+    return None
+
+def _find_column(columns, role):
+    normalized = {column: str(column).strip().lower() for column in columns}
+    for name in COLUMN_NAMES[role]:
+        for column, lowered in normalized.items():
+            if lowered == name:
+                return column
+    for name in COLUMN_NAMES[role]:
+        for column, lowered in normalized.items():
+            if name in lowered:
+                return column
+    return None
+
+# Lower and upper bound of each reference range ("3.5-5.1", "<0.04", ">60"; NaN if none).
+# A lab file repeats a handful of ranges, so each distinct one is parsed once.
+def _range_bounds(ranges):
+    import pandas as pd
+
+    codes, distinct = pd.factorize(ranges.fillna(""))
+    distinct = pd.Series(distinct, dtype=object)
+    bounds = distinct.str.extract(_RANGE).apply(pd.to_numeric, errors="coerce")
+    upper = pd.to_numeric(distinct.str.extract(_UPPER_LIMIT)[0], errors="coerce")
+    lower = pd.to_numeric(distinct.str.extract(_LOWER_LIMIT)[0], errors="coerce")
+    low = bounds[0].fillna(lower).to_numpy(dtype=float)[codes]
+    high = bounds[1].fillna(upper).to_numpy(dtype=float)[codes]
+    return pd.Series(low, index=ranges.index), pd.Series(high, index=ranges.index)
+
+# File-like object fed from the request (write) and read by pandas in another thread
+class _Pipe:
+    def __init__(self, max_chunks=PIPE_CHUNKS):
+        self._chunks = queue.Queue(max_chunks)
+        self._buffer = b""
+        self._eof = False
+
+    def write(self, data):
+        self._chunks.put(bytes(data))
+
+    def close(self):
+        self._chunks.put(None)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    # Drop what is left so a blocked writer can finish (reader failed)
+    def drain(self):
+        self._eof = True
+        self._buffer = b""
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                return
+
+    def readable(self):
+        return True
+
+class _TestStats:
+    __slots__ = ("count", "minimum", "maximum", "value", "unit", "range", "flag", "date")
+
+    def __init__(self):
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.value = None
+        self.unit = None
+        self.range = None
+        self.flag = None
+        self.date = None
+
+class CsvDigest:
+    kind = "csv"
+
+    def __init__(self, name, sep=","):
+        self.name = name
+        self.sep = sep
+        self.rows = 0
+        self.abnormal_rows = 0
+        self.columns = []
+        self.roles = {}
+        self.tests = {}
+        self.untracked = 0
+        self.error = None
+        self._pipe = _Pipe()
+        self._reader = threading.Thread(target=self._read, name="upload-csv", daemon=True)
+        self._reader.start()
+
+    # Blocks while the reader is PIPE_CHUNKS behind (run it in a thread)
+    def feed(self, data):
+        if self.error is None:
+            self._pipe.write(data)
+
+    def finish(self):
+        self._pipe.close()
+        self._reader.join()
+        if self.error is not None:
+            raise UploadError(f"Could not read {self.name} as CSV: {self.error}")
+
+    def _read(self):
+        import pandas as pd  # Heavy; only needed for CSV uploads
+
+        try:
+            reader = pd.read_csv(
+                self._pipe, sep=self.sep, dtype=str, chunksize=CSV_CHUNK_ROWS, encoding_errors="replace",
+                on_bad_lines="skip", skipinitialspace=True,
+            )
+            for chunk in reader:
+                self._chunk(chunk)
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            self._pipe.drain()
+
+    def _chunk(self, chunk):
+        if not self.columns:
+            self.columns = [str(column) for column in chunk.columns]
+            self.roles = {role: _find_column(chunk.columns, role) for role in COLUMN_NAMES}
+        self.rows += len(chunk)
+        test_col, value_col = self.roles["test"], self.roles["value"]
+        if test_col is None or value_col is None:
+            return
+        import pandas as pd
+
+        raw = chunk[value_col].fillna("").str.strip()
+        values = pd.to_numeric(raw, errors="coerce")
+        noisy = values.isna() & (raw != "")
+        if noisy.any():
+            # "<0.01", "1,200", "= 5": strip the noise only where plain parsing failed
+            values[noisy] = pd.to_numeric(raw[noisy].str.replace(_NUMBER_NOISE, "", regex=True), errors="coerce")
+        low = high = None
+        if self.roles["low"] is not None and self.roles["low"] != self.roles["range"]:
+            low = pd.to_numeric(chunk[self.roles["low"]], errors="coerce")
+        if self.roles["high"] is not None and self.roles["high"] != self.roles["range"]:
+            high = pd.to_numeric(chunk[self.roles["high"]], errors="coerce")
+        if self.roles["range"] is not None and (low is None or high is None):
+            range_low, range_high = _range_bounds(chunk[self.roles["range"]])
+            low = range_low if low is None else low
+            high = range_high if high is None else high
+
+        is_high = values > high if high is not None else pd.Series(False, index=chunk.index)
+        is_low = values < low if low is not None else pd.Series(False, index=chunk.index)
+        flags = None
+        if self.roles["flag"] is not None:
+            flags = chunk[self.roles["flag"]].fillna("").str.strip().str.upper()
+            flagged = ~flags.isin(NORMAL_FLAGS)
+            is_high |= flags.str.startswith("H")
+            is_low |= flags.str.startswith("L")
+        else:
+            flagged = pd.Series(False, index=chunk.index)
+        abnormal = flagged | is_high | is_low
+        count = int(abnormal.sum())
+        if not count:
+            return
+        self.abnormal_rows += count
+
+        frame = pd.DataFrame({
+            "test": chunk.loc[abnormal, test_col].fillna("").str.strip(),
+            "raw": raw[abnormal],
+            "value": values[abnormal],
+            "flag": (is_high[abnormal].map({True: "HIGH"})
+                     .fillna(is_low[abnormal].map({True: "LOW"}))
+                     .fillna(flags[abnormal] if flags is not None else "ABNORMAL")),
+        })
+        for role in ("unit", "range", "date"):
+            column = self.roles[role]
+            frame[role] = chunk.loc[abnormal, column] if column is not None else None
+        grouped = frame.groupby("test", sort=False).agg(
+            count=("raw", "size"), minimum=("value", "min"), maximum=("value", "max"), value=("raw", "last"),
+            unit=("unit", "last"), range=("range", "last"), flag=("flag", "last"), date=("date", "last"),
+        )
+        for test, row in zip(grouped.index, grouped.itertuples(index=False)):
+            stats = self.tests.get(test)
+            if stats is None:
+                if len(self.tests) >= MAX_TESTS:
+                    self.untracked += row.count
+                    continue
+                stats = self.tests[test] = _TestStats()
+            stats.count += row.count
+            if row.minimum == row.minimum:  # not NaN
+                stats.minimum = row.minimum if stats.minimum is None else min(stats.minimum, row.minimum)
+                stats.maximum = row.maximum if stats.maximum is None else max(stats.maximum, row.maximum)
+            # Rows are in file order: the last abnormal result wins
+            stats.value, stats.flag = row.value, row.flag
+            stats.unit = row.unit if isinstance(row.unit, str) else stats.unit
+            stats.range = row.range if isinstance(row.range, str) else stats.range
+            stats.date = row.date if isinstance(row.date, str) else stats.date
+
+    def items(self):
+        ranked = sorted(self.tests.items(), key=lambda item: (-item[1].count, item[0]))
+        return [
+            {
+                "test": test, "value": stats.value, "unit": stats.unit, "range": stats.range, "flag": stats.flag,
+                "count": stats.count, "min": stats.minimum, "max": stats.maximum, "date": stats.date,
+            }
+            for test, stats in ranked[:MAX_DIGEST_ITEMS]
+        ]
+
+    def summary(self):
+        recognized = self.roles.get("test") is not None and self.roles.get("value") is not None
+        return {
+            "rows": self.rows,
+            "columns": self.columns,
+            "recognized": recognized,
+            "abnormal_rows": self.abnormal_rows,
+            "abnormal_tests": len(self.tests),
+            "abnormal": self.items(),
+        }
+
+    def text(self):
+        if not (self.roles.get("test") and self.roles.get("value")):
+            return (
+                f"Attached {self.name}: {self.rows} rows with columns {', '.join(self.columns[:20])} "
+                "(no test/value columns recognized)."
+            )
+        if not self.tests:
+            return f"Attached lab results {self.name}: {self.rows} results, no abnormal values."
+        lines = [
+            f"Attached lab results {self.name}: {self.rows} results, {self.abnormal_rows} abnormal "
+            f"in {len(self.tests)} tests (abnormal values only, latest per test):"
+        ]
+        for item in self.items():
+            line = f"- {item['test']}: {item['value']}"
+            if item["unit"]:
+                line += f" {item['unit']}"
+            if item["flag"]:
+                line += f" {item['flag']}"
+            if item["range"]:
+                line += f" (ref {item['range']})"
+            if item["count"] > 1:
+                spread = f", {item['min']:g}-{item['max']:g}" if item["min"] is not None else ""
+                line += f"; {item['count']} abnormal results{spread}"
+            if item["date"]:
+                line += f"; last {item['date']}"
+            lines.append(line)
+        if len(self.tests) > MAX_DIGEST_ITEMS:
+            lines.append(f"- ... {len(self.tests) - MAX_DIGEST_ITEMS} more abnormal tests")
+        return "\n".join(lines)
+
+class TextDigest:
+    kind = "text"
+
+    def __init__(self, name):
+        self.name = name
+        self.lines = 0
+        self.kept = []
+        self.dropped = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self._in_key_section = False
+
+    def feed(self, data):
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def finish(self):
+        self._line(self._partial + self._decoder.decode(b"", final=True))
+        self._partial = ""
+
+    def _line(self, line):
+        line = line.strip()
+        if not line:
+            self._in_key_section = False
+            return
+        self.lines += 1
+        if _KEY_SECTION.match(line):
+            self._in_key_section = True
+        elif not (self._in_key_section or _FLAGGED_LINE.search(f" {line} ")):
+            return
+        if len(self.kept) < MAX_TEXT_LINES:
+            self.kept.append(line[:MAX_LINE_CHARS])
+        else:
+            self.dropped += 1
+
+    def summary(self):
+        return {"lines": self.lines, "kept_lines": len(self.kept), "dropped_lines": self.dropped}
+
+    def text(self):
+        if not self.kept:
+            return f"Attached report {self.name}: {self.lines} lines, no flagged findings."
+        lines = [f"Attached report {self.name} (flagged lines and impression only, {self.lines} lines in total):"]
+        lines.extend(f"- {line}" for line in self.kept)
+        if self.dropped:
+            lines.append(f"- ... {self.dropped} more flagged lines")
+        return "\n".join(lines)
+
+def new_digest(filename, content_type=None):
+    kind = file_kind(filename, content_type)
+    if kind == "csv":
+        extension = os.path.splitext(filename or "")[1].lower()
+        sep = CSV_EXTENSIONS.get(extension, "\t" if "tab-separated" in (content_type or "") else ",")
+        return CsvDigest(filename or "upload.csv", sep)
+    if kind == "text":
+        return TextDigest(filename or "upload.txt")
+    raise UnsupportedUpload()
+
+# Streaming multipart/form-data: the first file part is digested, other parts are skipped
+class _MultipartFile:
+    def __init__(self, boundary):
+        from python_multipart import MultipartParser
+
+        self.digest = None
+        self._headers = {}
+        self._field = b""
+        self._value = b""
+        self._current = False
+        self._pieces = []
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._part_begin,
+            "on_header_field": lambda data, start, end: self._add("_field", data[start:end]),
+            "on_header_value": lambda data, start, end: self._add("_value", data[start:end]),
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+        })
+
+    def _add(self, name, data):
+        setattr(self, name, getattr(self, name) + data)
+
+    def _part_begin(self):
+        self._headers = {}
+        self._current = False
+
+    def _header_end(self):
+        self._headers[self._field.decode("latin-1").lower()] = self._value.decode("latin-1")
+        self._field, self._value = b"", b""
+
+    def _headers_finished(self):
+        from python_multipart.multipart import parse_options_header
+
+        _, options = parse_options_header(self._headers.get("content-disposition", ""))
+        filename = options.get(b"filename")
+        if filename is not None and self.digest is None:
+            self.digest = new_digest(filename.decode("utf-8", "replace"), self._headers.get("content-type"))
+            self._current = True
+
+    def _part_data(self, data, start, end):
+        if self._current:
+            self._pieces.append(data[start:end])
+
+    # File bytes found in this piece of the body
+    def write(self, data):
+        self._parser.write(data)
+        pieces, self._pieces = self._pieces, []
+        return pieces
+
+# Parse an upload body as it streams in; returns the finished digest.
+# body: async iterator of bytes (request.stream()); multipart or the raw file.
+async def ingest(body, content_type, filename=None, max_bytes=MAX_BYTES):
+    content_type = content_type or ""
+    multipart = None
+    digest = None
+    if content_type.startswith("multipart/form-data"):
+        from python_multipart.multipart import parse_options_header
+
+        _, options = parse_options_header(content_type)
+        boundary = options.get(b"boundary")
+        if not boundary:
+            raise UploadError("Missing multipart boundary")
+        multipart = _MultipartFile(boundary)
+    else:
+        digest = new_digest(filename, content_type)
+
+    started = time.perf_counter()
+    received = 0
+    try:
+        async for data in body:
+            received += len(data)
+            if received > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            pieces = [data] if multipart is None else multipart.write(data)
+            digest = digest or (multipart.digest if multipart is not None else None)
+            for piece in pieces:
+                if digest.kind == "csv":
+                    # May wait for the CSV reader (bounded pipe)
+                    await asyncio.to_thread(digest.feed, piece)
+                else:
+                    digest.feed(piece)
+        if digest is None:
+            raise UploadError("No file in the upload")
+    except BaseException:
+        if digest is not None:
+            # Stop the CSV reader of an aborted upload
+            try:
+                await asyncio.to_thread(digest.finish)
+            except UploadError:
+                pass
+        metrics.incr("upload_rejected")
+        raise
+    await asyncio.to_thread(digest.finish)
+    metrics.incr("upload_bytes", received, kind=digest.kind)
+    metrics.observe("upload_seconds", time.perf_counter() - started, kind=digest.kind)
+    digest.size = received
+    return digest
+
+# Store a finished digest for attachment; returns its public record
+def save(digest):
+    record = {
+        "id": new_upload_id(),
+        "name": digest.name,
+        "kind": digest.kind,
+        "bytes": digest.size,
+        "created": time.time(),
+        **digest.summary(),
+        "text": digest.text(),
+    }
+    _private_dir()
+    start_sweeper()
+    # mkstemp creates the file 0600
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{record['id']}.", suffix=".tmp", dir=UPLOADS_DIR)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, digest_path(record["id"]))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return record
+
+def load(upload_id):
+    if not is_valid_upload_id(upload_id):
+        return None
+    start_sweeper()
+    try:
+        with open(digest_path(upload_id), encoding="utf-8") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - record.get("created", 0) > UPLOAD_TTL:
+        return None
+    return record
+
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+# Start this process's sweeper thread (once per process, so forked workers get their own)
+def start_sweeper():
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+        threading.Thread(target=_run_sweeper, name="upload-sweeper", daemon=True).start()
+
+def _run_sweeper():
+    while True:
+        sweep()
+        time.sleep(SWEEP_INTERVAL)
+
+# Delete digests past UPLOAD_TTL
+def sweep():
+    cutoff = time.time() - UPLOAD_TTL
+    try:
+        names = os.listdir(UPLOADS_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(UPLOADS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+# The user message with the digests of its attachments appended
+def attach(user_message, attachment_ids):
+    parts = [user_message]
+    for upload_id in attachment_ids:
+        record = load(upload_id)
+        if record is None:
+            raise UploadError(f"Attachment {upload_id} was not found or has expired; please upload it again")
+        parts.append(record["text"])
+    return "\n\n".join(parts)
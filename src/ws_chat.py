@@ -0,0 +1,231 @@
+import asyncio
+import os
+import time
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+import metrics
+import sse
+from drain import GenerationInterrupted
+from markdown_stream import IncrementalMarkdownRenderer
+
+# Multiplexed WebSocket chat transport (GET /ws).
+#
+# One long-lived connection carries any number of concurrent messages, each
+# identified by a client-chosen id (and optionally tagged with a conversation id).
+#
+# Client -> server:
+#   {"type": "start", "id": "m1", "conversation_id": "c1", "user_message": "...",
+#    "model_name": "...", "prompt_name": "prompt1", "render": "markdown", "attachments": ["<upload id>"]}
+#   {"type": "ack", "id": "m1", "count": 1}     # frames processed (flow control)
+#   {"type": "compare", "id": "c1", "models": ["gemini/...", "claude-..."],
+#    "user_message": "...", "prompt_name": "prompt1", "render": "markdown"}
+#   {"type": "cancel", "id": "m1"}
+#   {"type": "ping"}
+#
+# Server -> client:
+#   {"type": "started", "id": "m1", "conversation_id": "c1", "model": "..."}
+#   {"type": "progress", "id": "m1", "stage": "map", "done": 2, "total": 8, "message": "..."}
+#   {"type": "delta", "id": "m1", "seq": 0, "text": "...", "markdown": {...}, "ttft": 0.41}
+#   {"type": "done", "id": "m1", "status": "complete" | "cancelled" | "interrupted" | "error",
+#    "error": "...", "markdown": {...}, "model": "...", "ttft": 0.41, "duration": 7.9}
+#   {"type": "error", "id": "m1", "error": "..."}    # rejected start / bad message
+#   {"type": "pong"}
+#
+# A compare message starts one message per model (ids "c1:<model>", conversation
+# id "c1"), so the same question streams from several models concurrently and
+# side by side; each can be cancelled on its own id. The first delta frame of a
+# message carries its time-to-first-token and the done frame its total duration.
+#
+# Delta frames carry only the new text (plus, with render=markdown, a markdown
+# frame from markdown_stream.py). Flow control is credit based: each message may
+# have WS_WINDOW unacknowledged delta frames in flight. When the window is full,
+# new text is coalesced into the next frame instead of blocking the upstream
+# stream, so a slow client receives fewer, larger frames.
+
+# Unacknowledged delta frames allowed per message
+WS_WINDOW = int(os.environ.get("WS_WINDOW", 32))
+
+# Concurrent messages allowed per connection
+WS_MAX_STREAMS = int(os.environ.get("WS_MAX_STREAMS", 8))
+
+class _MessageStream:
+    __slots__ = (
+        "id", "conversation_id", "model", "task", "credits", "pending", "seq", "renderer", "credit_event",
+        "started", "ttft",
+    )
+
+    def __init__(self, message_id, conversation_id, model, render):
+        self.id = message_id
+        self.conversation_id = conversation_id
+        self.model = model
+        self.task = None
+        self.credits = WS_WINDOW
+        self.pending = ""
+        self.seq = 0
+        self.renderer = IncrementalMarkdownRenderer() if render == "markdown" else None
+        self.credit_event = asyncio.Event()
+        self.started = time.perf_counter()
+        self.ttft = None
+
+class ChatSocket:
+    # generate(user_message, model_name, prompt_name, session_id, progress=True, attachments=...) -> async iterator
+    # of text deltas and progress events (dicts, sent as progress frames)
+    def __init__(self, websocket: WebSocket, generate, session_id=None):
+        self.websocket = websocket
+        self.generate = generate
+        self.session_id = session_id
+        self.streams = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, message):
+        async with self._send_lock:
+            await self.websocket.send_text(sse.dumps_text(message))
+
+    # Serve the connection until the client disconnects
+    async def run(self):
+        await self.websocket.accept()
+        metrics.incr("ws_connections")
+        try:
+            while True:
+                try:
+                    message = await self.websocket.receive_json()
+                    await self.dispatch(message)
+                except (ValueError, TypeError) as e:
+                    await self.send({"type": "error", "error": f"Invalid message: {str(e)}"})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for stream in list(self.streams.values()):
+                if stream.task is not None:
+                    stream.task.cancel()
+
+    async def dispatch(self, message):
+        if not isinstance(message, dict):
+            await self.send({"type": "error", "error": "Messages must be JSON objects"})
+            return
+        message_type = message.get("type")
+        message_id = message.get("id")
+        if message_type == "start":
+            await self.start(message)
+        elif message_type == "compare":
+            await self.compare(message)
+        elif message_type == "ack":
+            stream = self.streams.get(message_id)
+            if stream is not None:
+                stream.credits += max(1, int(message.get("count", 1)))
+                stream.credit_event.set()
+                if stream.pending and stream.credits > 0:
+                    await self.flush(stream)
+        elif message_type == "cancel":
+            stream = self.streams.get(message_id)
+            if stream is not None and stream.task is not None:
+                stream.task.cancel()
+        elif message_type == "ping":
+            await self.send({"type": "pong"})
+        else:
+            await self.send({"type": "error", "id": message_id, "error": f"Unknown message type: {message_type}"})
+
+    async def start(self, message):
+        message_id = message.get("id")
+        if not message_id or message_id in self.streams:
+            await self.send({"type": "error", "id": message_id, "error": "Message id missing or already in use"})
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            await self.send({"type": "error", "id": message_id, "error": "Too many concurrent messages"})
+            return
+        if not message.get("user_message") or not message.get("model_name"):
+            await self.send({"type": "error", "id": message_id, "error": "user_message and model_name are required"})
+            return
+
+        stream = _MessageStream(message_id, message.get("conversation_id"), message["model_name"], message.get("render"))
+        self.streams[message_id] = stream
+        await self.send({
+            "type": "started", "id": message_id, "conversation_id": stream.conversation_id, "model": stream.model,
+        })
+        stream.task = asyncio.create_task(self.run_stream(stream, message))
+        metrics.incr("ws_messages")
+
+    # Start the same message on several models at once (one message per model)
+    async def compare(self, message):
+        group_id = message.get("id")
+        models = list(dict.fromkeys(message.get("models") or []))
+        if not group_id or not models or not all(isinstance(model, str) and model for model in models):
+            await self.send({"type": "error", "id": group_id, "error": "id and a list of models are required"})
+            return
+        if len(self.streams) + len(models) > WS_MAX_STREAMS:
+            await self.send({"type": "error", "id": group_id, "error": "Too many concurrent messages"})
+            return
+        metrics.incr("ws_comparisons", models=len(models))
+        for model in models:
+            await self.start({
+                **message, "type": "start", "id": f"{group_id}:{model}", "conversation_id": group_id,
+                "model_name": model,
+            })
+
+    # Send the coalesced pending text as one delta frame (uses one credit)
+    async def flush(self, stream):
+        text, stream.pending = stream.pending, ""
+        frame = {"type": "delta", "id": stream.id, "seq": stream.seq, "text": text}
+        if stream.seq == 0:
+            frame["ttft"] = stream.ttft
+        if stream.renderer is not None:
+            markdown = stream.renderer.feed(text)
+            if markdown:
+                frame["markdown"] = markdown
+        stream.seq += 1
+        stream.credits -= 1
+        if stream.credits <= 0:
+            stream.credit_event.clear()
+        await self.send(frame)
+
+    async def run_stream(self, stream, message):
+        done = {"type": "done", "id": stream.id, "status": "complete", "model": stream.model}
+        try:
+            async for delta in self.generate(
+                message["user_message"],
+                message["model_name"],
+                message.get("prompt_name", "prompt1"),
+                message.get("session_id") or self.session_id,
+                progress=True,
+                attachments=message.get("attachments"),
+            ):
+                if isinstance(delta, dict):
+                    # Condensing an oversized message (see condense.py)
+                    await self.send({**delta, "type": "progress", "id": stream.id})
+                    continue
+                if stream.ttft is None:
+                    stream.ttft = time.perf_counter() - stream.started
+                stream.pending += delta
+                if stream.credits > 0:
+                    await self.flush(stream)
+                else:
+                    metrics.incr("ws_coalesced_deltas")
+            # Deliver the remaining text once the client has room for it
+            while stream.pending:
+                await stream.credit_event.wait()
+                if stream.pending and stream.credits > 0:
+                    await self.flush(stream)
+        except asyncio.CancelledError:
+            done["status"] = "cancelled"
+            metrics.incr("ws_cancelled")
+        except GenerationInterrupted as e:
+            # Worker shutting down: the client keeps the text received so far
+            done["status"] = "interrupted"
+            done["error"] = str(e)
+            if stream.pending:
+                await self.flush(stream)
+        except Exception as e:
+            done["status"] = "error"
+            done["error"] = f"Error: {str(e)}"
+        finally:
+            self.streams.pop(stream.id, None)
+        if stream.renderer is not None:
+            done["markdown"] = stream.renderer.close()
+        done["ttft"] = stream.ttft
+        done["duration"] = time.perf_counter() - stream.started
+        try:
+            await self.send(done)
+        except Exception:
+            # Connection already gone
+            pass
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The app modules import each other by name (as when run from src/), and the journal
+# and ledger would otherwise write under data/ while the tests run
+os.environ.setdefault("JOURNAL", "0")
+os.environ.setdefault("LEDGER", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "src"))
@@ -1,85 +1,81 @@
-import pytest
+import types
 from unittest.mock import patch
-from src.app import update_output
-
-# Mock the litellm.completion function
-@patch('src.app.completion')
-def test_update_output_with_input(mock_completion):
-    # Configure the mock to return a predefined response
-    mock_completion.return_value = type('obj', (object,), {'choices': [{'message': type('obj', (object,), {'content': 'Mocked LLM response'})}]})()
-
-    n_clicks = 1
-    user_input = "Hello, bot!"
-    selected_model = "gemini/gemini-2.0-flash"
-    chat_history = []
-
-    updated_chat_history = update_output(n_clicks, user_input, selected_model, chat_history)
-
-    # Assert that the chat history is updated correctly
-    assert len(updated_chat_history) == 2
-    assert updated_chat_history[0].children == "You: Hello, bot!"
-    assert updated_chat_history[1].children == "Bot: Mocked LLM response"
-    mock_completion.assert_called_once_with(
-        model=selected_model,
-        messages=[{"content": "''' \nYou are an expert medical AI diagnostician assisting a human physician in generating a broad differential diagnosis. \nPlease provide a succinct differential diagnosis based on the the patient summary provided. \nProvide three categories of diagnoses: \"Most likely\", \"Can't Miss\", and \"Broader Differential.\" \nInclude at least 3 diagnoses in each category. \nInclude a short table comparing and contrasting the items in the differential, including a column for next treatment step of each condition.\nInclude a section with additional diagnostic steps that would be most helpful for distinguishing between the items on the differential. \nFinally, summarize the single most helpful next diagnostic step, whether it be a lab test or additional information to obtain from the patient.\n\n'''", "role": "system"}, {"content": user_input, "role": "user"}]
-    )
-
-@patch('src.app.completion')
-def test_update_output_no_input(mock_completion):
-    n_clicks = 1
-    user_input = ""
-    selected_model = "gemini/gemini-2.0-flash"
-    chat_history = []
-
-    updated_chat_history = update_output(n_clicks, user_input, selected_model, chat_history)
-
-    # Assert that the chat history is not updated and litellm.completion is not called
-    assert len(updated_chat_history) == 0
-    mock_completion.assert_not_called()
 
-@patch('src.app.completion')
-def test_update_output_no_clicks(mock_completion):
-    n_clicks = 0
-    user_input = "Hello, bot!"
-    selected_model = "gemini/gemini-2.0-flash"
-    chat_history = []
+import pytest
+from fastapi.testclient import TestClient
 
-    updated_chat_history = update_output(n_clicks, user_input, selected_model, chat_history)
+import app
+from prompts import prompt1
 
-    # Assert that the chat history is not updated and litellm.completion is not called
-    assert len(updated_chat_history) == 0
-    mock_completion.assert_not_called()
+# Chunks of a litellm completion stream with the given text deltas
+def stream_of(*deltas):
+    for text in deltas:
+        delta = types.SimpleNamespace(content=text)
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason=None)])
+    delta = types.SimpleNamespace(content=None)
+    yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason="stop")])
 
-@patch('src.app.completion')
-def test_update_output_with_existing_history(mock_completion):
-    mock_completion.return_value = type('obj', (object,), {'choices': [{'message': type('obj', (object,), {'content': 'Another mocked response'})}]})()
+@pytest.fixture
+def client():
+    with TestClient(app.app) as client:
+        yield client
 
-    n_clicks = 1
-    user_input = "How are you?"
-    selected_model = "gemini/gemini-2.0-flash"
-    chat_history = [html.Div("You: Hi"), html.Div("Bot: Hello")]
+def chat(client, user_message, **fields):
+    payload = {"user_message": user_message, "model_name": "gemini/gemini-2.0-flash", "prompt_name": "prompt1"}
+    return client.post("/chat", json={**payload, **fields}).json()
 
-    updated_chat_history = update_output(n_clicks, user_input, selected_model, chat_history)
+# Mock the provider completion used by the app
+@patch('app.completion')
+def test_chat_with_input(mock_completion, client):
+    mock_completion.return_value = stream_of("Mocked ", "LLM response")
 
-    # Assert that the new messages are appended to the existing history
-    assert len(updated_chat_history) == 4
-    assert updated_chat_history[2].children == "You: How are you?"
-    assert updated_chat_history[3].children == "Bot: Another mocked response"
-    mock_completion.assert_called_once()
+    response = chat(client, "Hello, bot!")
 
-@patch('src.app.completion')
-def test_update_output_error_handling(mock_completion):
+    assert response == {"content": "Mocked LLM response", "status": "complete"}
+    mock_completion.assert_called_once()
+    kwargs = mock_completion.call_args.kwargs
+    assert kwargs["model"] == "gemini/gemini-2.0-flash"
+    assert kwargs["stream"] is True
+    assert kwargs["messages"] == [
+        {"role": "system", "content": prompt1},
+        {"role": "user", "content": "Hello, bot!"},
+    ]
+
+@patch('app.completion')
+def test_chat_structured(mock_completion, client):
+    mock_completion.return_value = stream_of("## Most Likely\n", "- **Pneumonia**: fever\n")
+
+    response = chat(client, "Cough and fever", structured=True)
+
+    assert response["status"] == "complete"
+    assert response["result"]["diagnoses"]["most_likely"] == [{"name": "Pneumonia", "detail": "fever"}]
+
+@patch('app.completion')
+def test_chat_keeps_session_history(mock_completion, client):
+    mock_completion.side_effect = lambda **kwargs: stream_of("Another mocked response")
+
+    chat(client, "Hi", session_id="test-session")
+    chat(client, "How are you?", session_id="test-session")
+
+    messages = app.message_store.messages("test-session")
+    assert [(m["role"], m["content"]) for m in messages] == [
+        ("user", "Hi"), ("assistant", "Another mocked response"),
+        ("user", "How are you?"), ("assistant", "Another mocked response"),
+    ]
+    app.message_store.drop("test-session")
+
+@patch('app.completion')
+def test_chat_error_handling(mock_completion, client):
     mock_completion.side_effect = Exception("API Error")
 
-    n_clicks = 1
-    user_input = "Test error"
-    selected_model = "gemini/gemini-2.0-flash"
-    chat_history = []
-
-    updated_chat_history = update_output(n_clicks, user_input, selected_model, chat_history)
+    response = chat(client, "Test error")
 
-    # Assert that an error message is added to the chat history
-    assert len(updated_chat_history) == 2
-    assert updated_chat_history[0].children == "You: Test error"
-    assert "Error: API Error" in updated_chat_history[1].children
+    assert response["content"] == "Error: API Error"
     mock_completion.assert_called_once()
+
+@patch('app.completion')
+def test_chat_unknown_attachment(mock_completion, client):
+    response = chat(client, "See attached", attachments=["missing"])
+
+    assert response["content"].startswith("Error: Attachment missing was not found")
+    mock_completion.assert_not_called()
@@ -0,0 +1,78 @@
+import threading
+import types
+
+import pytest
+
+from condense import Condenser, CondenseError, chunk_key, split_chunks
+
+def paragraphs(count, size=300):
+    return "\n\n".join(f"Paragraph {n}: " + " ".join(["lab value normal"] * (size // 17)) for n in range(count))
+
+def test_split_chunks_keeps_all_text_within_bounds():
+    text = paragraphs(200)
+    chunks = split_chunks(text, chunk_tokens=500)
+    assert len(chunks) > 1
+    assert "\n\n".join(chunks) == text
+    # Content-defined cuts land between half and twice the target
+    assert all(len(chunk) <= 2 * 500 * 4 for chunk in chunks)
+    assert all(len(chunk) >= 500 * 4 // 2 for chunk in chunks[:-1])
+
+def test_split_chunks_boundaries_survive_an_insertion():
+    text = paragraphs(200)
+    before = split_chunks(text, chunk_tokens=500)
+    after = split_chunks("A new first paragraph.\n\n" + text, chunk_tokens=500)
+    # Only the chunks around the edit change, so the rest hit the cache
+    assert len(set(before) & set(after)) >= len(before) - 2
+
+def test_oversized_paragraph_is_cut():
+    line = "x" * 10000
+    chunks = split_chunks(line, chunk_tokens=100)
+    assert "".join(chunks) == line
+    assert max(len(chunk) for chunk in chunks) <= 800
+
+def test_chunk_key_depends_on_text():
+    assert chunk_key("a") == chunk_key("a")
+    assert chunk_key("a") != chunk_key("b")
+
+class FakeCompletion:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, model, messages, **kwargs):
+        with self.lock:
+            self.calls.append(messages[1]["content"])
+        if self.fail:
+            raise RuntimeError("provider down")
+        message = types.SimpleNamespace(content="summary")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+def test_condensed_chunks_are_cached():
+    completion = FakeCompletion()
+    condenser = Condenser(completion, threshold_tokens=1000, chunk_tokens=500, concurrency=2)
+    text = paragraphs(200)
+    events = []
+    condensed = condenser.condense(text, "gemini/gemini-2.0-flash", on_progress=events.append)
+    chunks = len(split_chunks(text, 500))
+    assert len(completion.calls) == chunks
+    assert condensed.endswith("\n\n".join(["summary"] * chunks))
+    assert events[-1]["stage"] == "done" and events[-1]["cached"] == 0
+
+    events.clear()
+    condenser.condense(text, "gemini/gemini-2.0-flash", on_progress=events.append)
+    assert len(completion.calls) == chunks
+    assert events[-1]["cached"] == chunks
+    assert condenser.status() == {"cached_chunks": chunks, "inflight_chunks": 0}
+
+def test_cache_is_bounded():
+    condenser = Condenser(FakeCompletion(), threshold_tokens=1000, chunk_tokens=500, cache_entries=3)
+    condenser.condense(paragraphs(200), "gemini/gemini-2.0-flash")
+    assert condenser.status()["cached_chunks"] == 3
+
+def test_failures_are_not_cached():
+    completion = FakeCompletion(fail=True)
+    condenser = Condenser(completion, threshold_tokens=1000, chunk_tokens=500)
+    with pytest.raises(CondenseError):
+        condenser.condense(paragraphs(200), "gemini/gemini-2.0-flash")
+    assert condenser.status()["cached_chunks"] == 0
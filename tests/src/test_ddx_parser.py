@@ -0,0 +1,105 @@
+from ddx_parser import DifferentialParser, parse_differential, section_id, split_item
+
+ANSWER = """**Most Likely:**
+1. **Acute coronary syndrome**: chest pain radiating to the left arm
+   - diaphoresis
+2. Stable angina - exertional pain
+
+### Can't Miss
+- **Aortic dissection** - tearing pain
+- Pulmonary embolism: tachycardia
+
+## Broader Differential
+- GERD
+
+| Diagnosis | Next step |
+|---|---|
+| ACS | ECG and troponin |
+| Aortic dissection | CT angiography |
+
+## Additional Diagnostic Steps
+1. Serial troponins
+2. **CT angiography** of the chest
+
+## Single Most Helpful Next Step
+Obtain a 12-lead ECG
+within 10 minutes.
+"""
+
+def test_parse_complete_answer():
+    result = parse_differential(ANSWER)
+    assert [s["section"] for s in result["sections"]] == [
+        "most_likely", "cant_miss", "broader", "diagnostic_steps", "next_step",
+    ]
+    assert result["diagnoses"]["most_likely"] == [
+        {"name": "Acute coronary syndrome", "detail": "chest pain radiating to the left arm diaphoresis"},
+        {"name": "Stable angina", "detail": "exertional pain"},
+    ]
+    assert [d["name"] for d in result["diagnoses"]["cant_miss"]] == ["Aortic dissection", "Pulmonary embolism"]
+    assert result["table"] == {
+        "header": ["Diagnosis", "Next step"],
+        "rows": [["ACS", "ECG and troponin"], ["Aortic dissection", "CT angiography"]],
+    }
+    assert result["tables"] == [result["table"]]
+    assert result["diagnostic_steps"] == ["Serial troponins", "CT angiography of the chest"]
+    assert result["next_step"] == "Obtain a 12-lead ECG within 10 minutes."
+
+def test_streamed_tokens_give_the_same_result_and_events():
+    whole = DifferentialParser()
+    whole_events = whole.feed(ANSWER) + whole.close()
+
+    streamed = DifferentialParser()
+    events = []
+    for i in range(0, len(ANSWER), 3):
+        events += streamed.feed(ANSWER[i:i + 3])
+    events += streamed.close()
+    assert streamed.result() == whole.result()
+    assert events == whole_events
+
+def test_events_arrive_when_their_line_completes():
+    parser = DifferentialParser()
+    assert parser.feed("## Most likely\n- Pneumo") == [
+        {"type": "section", "section": "most_likely", "title": "Most likely"},
+    ]
+    assert parser.feed("nia: fever") == []
+    events = parser.feed("\n")
+    assert events == [{"type": "diagnosis", "section": "most_likely", "index": 0, "name": "Pneumonia", "detail": "fever"}]
+
+def test_next_step_event_on_close():
+    parser = DifferentialParser()
+    parser.feed("Summary:\nCheck lipase")
+    assert parser.close() == [{"type": "next_step", "text": "Check lipase"}]
+
+def test_prompt_heading_for_diagnostic_steps():
+    # prompts.py asks for "additional diagnostic steps that would be most helpful for distinguishing"
+    assert section_id("Additional Diagnostic Steps Most Helpful for Distinguishing") == "diagnostic_steps"
+    assert section_id("Single Most Helpful Next Diagnostic Step") == "next_step"
+    assert section_id("Most Helpful Next Step") == "next_step"
+    result = parse_differential(
+        "## Additional Diagnostic Steps Most Helpful for Distinguishing\n- D-dimer\n"
+        "## Single Most Helpful Next Step\nCT pulmonary angiography\n"
+    )
+    assert result["diagnostic_steps"] == ["D-dimer"]
+    assert result["next_step"] == "CT pulmonary angiography"
+
+def test_second_table_has_its_own_header():
+    parser = DifferentialParser()
+    events = parser.feed(
+        "| Diagnosis | Next step |\n|---|---|\n| ACS | ECG |\n\nWorkup costs:\n"
+        "| Test | Cost |\n|---|---|\n| ECG | low |\n"
+    )
+    rows = [event for event in events if event["type"] == "table_row"]
+    assert rows == [
+        {"type": "table_row", "table": 0, "index": 0, "cells": ["ACS", "ECG"], "row": {"Diagnosis": "ACS", "Next step": "ECG"}},
+        {"type": "table_row", "table": 1, "index": 0, "cells": ["ECG", "low"], "row": {"Test": "ECG", "Cost": "low"}},
+    ]
+    result = parser.result()
+    assert result["table"] == {"header": ["Diagnosis", "Next step"], "rows": [["ACS", "ECG"]]}
+    assert result["tables"][1] == {"header": ["Test", "Cost"], "rows": [["ECG", "low"]]}
+
+def test_section_and_item_helpers():
+    assert section_id("Can't Miss Diagnoses") == "cant_miss"
+    assert section_id("Comparison Table") == "comparison_table"
+    assert section_id("Plan") is None
+    assert split_item("**Sepsis** — hypotension") == ("Sepsis", "hypotension")
+    assert split_item("Migraine") == ("Migraine", "")
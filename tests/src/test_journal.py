@@ -0,0 +1,73 @@
+import os
+import stat
+
+from journal import Journal, claim_stream
+
+def test_append_and_read_back(tmp_path):
+    journal = Journal(str(tmp_path), fsync=False)
+    first = journal.append("request", "conv-a", message="Chest pain")
+    second = journal.append("response", "conv-a", content="Most likely: ...")
+    journal.append("request", "conv-b", message="Headache")
+    assert journal.flush(5)
+
+    assert journal.read(first)["message"] == "Chest pain"
+    assert [record["seq"] for record in journal.history("conv-a")] == [first, second]
+    assert [record["type"] for record in journal.history("conv-a", limit=1)] == ["response"]
+    journal.close()
+
+def test_reopen_recovers_index(tmp_path):
+    journal = Journal(str(tmp_path), fsync=False)
+    seqs = [journal.append("request", "conv-a", message=f"message {n}") for n in range(5)]
+    journal.flush(5)
+    journal.close()
+
+    reopened = Journal(str(tmp_path), fsync=False)
+    assert [record["message"] for record in reopened.history("conv-a")] == [f"message {n}" for n in range(5)]
+    assert reopened.append("request", "conv-a", message="after restart") == seqs[-1] + 1
+    reopened.close()
+
+def test_torn_write_is_truncated_on_recovery(tmp_path):
+    journal = Journal(str(tmp_path), fsync=False)
+    journal.append("request", "conv-a", message="kept")
+    journal.append("request", "conv-a", message="torn")
+    journal.flush(5)
+    journal.close()
+
+    # Cut the last record in half, as a crash in the middle of a write would
+    log_path = next(os.path.join(tmp_path, name) for name in os.listdir(tmp_path) if name.endswith(".log"))
+    size = os.path.getsize(log_path)
+    with open(log_path, "r+b") as f:
+        f.truncate(size - 5)
+
+    reopened = Journal(str(tmp_path), fsync=False)
+    assert [record["message"] for record in reopened.history("conv-a")] == ["kept"]
+    segment = reopened._segments[-1]
+    assert os.path.getsize(log_path) == segment.size
+    # The next record continues after the last valid one
+    seq = reopened.append("request", "conv-a", message="next")
+    reopened.flush(5)
+    assert reopened.read(seq)["message"] == "next"
+    reopened.close()
+
+def test_forget_hides_history(tmp_path):
+    journal = Journal(str(tmp_path), fsync=False)
+    journal.append("request", "conv-a", message="private")
+    journal.forget("conv-a")
+    journal.flush(5)
+    assert journal.history("conv-a") == []
+    journal.close()
+
+def test_files_are_private(tmp_path):
+    root = tmp_path / "journal"
+    root.mkdir(mode=0o755)
+    path, lock_fd = claim_stream(str(root))
+    journal = Journal(path, fsync=False)
+    journal.append("request", "conv-a", message="private")
+    journal.flush(5)
+    journal.close()
+    os.close(lock_fd)
+
+    assert stat.S_IMODE(os.stat(root).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    for name in os.listdir(path):
+        assert stat.S_IMODE(os.stat(os.path.join(path, name)).st_mode) == 0o600
@@ -0,0 +1,69 @@
+import pytest
+
+from markdown_stream import IncrementalMarkdownRenderer, render_block, render_frame, split_blocks
+
+ANSWER = """## Most Likely
+1. **Acute coronary syndrome**: chest pain radiating to the arm
+2. *Pericarditis* - pleuritic pain
+
+| Diagnosis | Next step |
+|:---|---:|
+| ACS | ECG and troponin |
+| Pericarditis | Echocardiogram |
+
+```python
+print("a < b")
+```
+
+---
+Send the [guideline](https://example.org) or [not this](javascript:alert(1)).
+Trailing paragraph without a newline"""
+
+# Apply frames to a list of rendered blocks, as assets/markdown_stream.js does to the DOM
+def apply_frames(frames):
+    blocks, tail = [], ""
+    for frame in frames:
+        if frame is None:
+            continue
+        del blocks[frame["start"]:]
+        blocks.extend(frame["blocks"])
+        tail = frame["tail"]
+    return blocks, tail
+
+def full_render(text):
+    blocks, remainder = split_blocks(text)
+    rendered = [render_block(block) for block in blocks]
+    if remainder.strip():
+        rendered.append(render_block(remainder))
+    return rendered
+
+@pytest.mark.parametrize("step", [1, 3, 7, 64, len(ANSWER)])
+def test_incremental_matches_full_render(step):
+    renderer = IncrementalMarkdownRenderer()
+    frames = [renderer.feed(ANSWER[i:i + step]) for i in range(0, len(ANSWER), step)]
+    frames.append(renderer.close())
+    blocks, tail = apply_frames(frames)
+    assert tail == ""
+    assert blocks == full_render(ANSWER)
+
+def test_frames_match_stateless_render_while_streaming():
+    renderer = IncrementalMarkdownRenderer()
+    frames = []
+    for end in range(1, len(ANSWER) + 1):
+        frames.append(renderer.feed(ANSWER[end - 1]))
+        blocks, tail = apply_frames(frames)
+        frame, _ = render_frame(ANSWER[:end])
+        assert blocks == frame["blocks"]
+        assert tail == frame["tail"]
+
+def test_unchanged_tail_sends_no_frame():
+    renderer = IncrementalMarkdownRenderer()
+    assert renderer.feed("Hello") is not None
+    assert renderer.feed("") is None
+
+def test_output_is_escaped_and_links_are_safe():
+    html = "".join(full_render(ANSWER))
+    assert "a &lt; b" in html
+    assert '<a href="https://example.org"' in html
+    assert "javascript:" not in html
+    assert '<td style="text-align: right">ECG and troponin</td>' in html
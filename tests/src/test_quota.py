@@ -0,0 +1,90 @@
+import pytest
+
+import quota
+from quota import QuotaScheduler, TokenBucket, parse_rate_limit_headers, parse_reset
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(60, now=0.0)
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    bucket.refill(30.0)
+    assert bucket.level == pytest.approx(30.0)
+    bucket.refill(1000.0)
+    assert bucket.level == 60.0
+
+def test_oversized_request_fits_a_full_bucket():
+    bucket = TokenBucket(100, now=0.0)
+    assert bucket.wait_time(500) == 0.0
+    bucket.take(50)
+    assert bucket.wait_time(500) == pytest.approx(30.0)
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(None)
+    bucket.take(10 ** 9)
+    assert bucket.wait_time(10 ** 9) == 0.0
+
+def test_parse_reset_formats():
+    assert parse_reset("20") == 20.0
+    assert parse_reset("6m0s") == 360.0
+    assert parse_reset("250ms") == pytest.approx(0.25)
+    assert parse_reset("1970-01-01T00:01:40Z", now=40) == 60.0
+    assert parse_reset("soon") is None
+
+def test_parse_rate_limit_headers():
+    info = parse_rate_limit_headers({
+        "x-ratelimit-limit-requests": "100",
+        "llm_provider-x-ratelimit-remaining-tokens": "500",
+        "x-ratelimit-reset-tokens": "1.5s",
+        "Retry-After": "3",
+    })
+    assert info["requests"] == {"limit": 100.0}
+    assert info["tokens"] == {"remaining": 500.0, "reset": 1.5}
+    assert info["retry_after"] == 3.0
+
+def test_headers_correct_the_buckets(monkeypatch):
+    monkeypatch.setenv("QUOTA_WORKERS", "1")
+    scheduler = QuotaScheduler(max_wait=1)
+    scheduler.configure("gemini", api_keys=["k1"], rpm=1000, tpm=1000000)
+    lease = scheduler.acquire("gemini/gemini-2.0-flash", 100)
+    scheduler.release(lease, used_tokens=40, headers={
+        "x-ratelimit-limit-requests": "60",
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-remaining-tokens": "0",
+        "x-ratelimit-reset-tokens": "30",
+    })
+    key = scheduler.keys("gemini")[0]
+    assert key.requests.capacity == 60.0
+    assert key.requests.level == pytest.approx(10.0, abs=0.1)
+    assert key.tokens.level == 0.0
+    # No tokens left until the reset
+    assert key.wait_time(1, key.tokens.updated) == pytest.approx(30.0, abs=0.1)
+
+def test_header_limits_are_split_between_workers(monkeypatch):
+    monkeypatch.setenv("QUOTA_WORKERS", "4")
+    monkeypatch.setenv("QUOTA_GEMINI_RPM", "100")
+    scheduler = QuotaScheduler(max_wait=1)
+    key = scheduler.keys("gemini")[0]
+    assert key.requests.capacity == 25.0
+    lease = scheduler.acquire("gemini/gemini-2.0-flash", 10)
+    scheduler.release(lease, headers={"x-ratelimit-limit-requests": "200", "x-ratelimit-remaining-requests": "40"})
+    assert key.requests.capacity == 50.0
+    assert key.requests.level == pytest.approx(10.0, abs=0.1)
+
+def test_rate_limited_key_is_skipped(monkeypatch):
+    monkeypatch.setenv("QUOTA_WORKERS", "1")
+    scheduler = QuotaScheduler(max_wait=1)
+    scheduler.configure("gemini", api_keys=["k1", "k2"])
+    lease = scheduler.acquire("gemini/gemini-2.0-flash", 10)
+    scheduler.release(lease, headers={"retry-after": "60"}, rate_limited=True)
+    for _ in range(3):
+        other = scheduler.acquire("gemini/gemini-2.0-flash", 10)
+        assert other.key is not lease.key
+        scheduler.release(other)
+
+def test_acquire_times_out_when_exhausted(monkeypatch):
+    monkeypatch.setenv("QUOTA_WORKERS", "1")
+    scheduler = QuotaScheduler(max_wait=0.05)
+    scheduler.configure("gemini", api_keys=["k1"], rpm=1)
+    scheduler.release(scheduler.acquire("gemini/gemini-2.0-flash", 1))
+    with pytest.raises(quota.QuotaExceeded):
+        scheduler.acquire("gemini/gemini-2.0-flash", 1)
@@ -0,0 +1,108 @@
+import os
+import stat
+
+import pytest
+
+import uploads
+from uploads import UnsupportedUpload, UploadError, file_kind, new_digest
+
+LABS = b"""Test,Result,Units,Reference Range,Flag,Date
+Troponin I,0.45,ng/mL,<0.04,H,2024-01-02
+Sodium,139,mmol/L,135-145,,2024-01-02
+Potassium,2.9,mmol/L,3.5-5.1,,2024-01-02
+Troponin I,1.20,ng/mL,<0.04,H,2024-01-03
+Glucose,"1,200",mg/dL,70-99,,2024-01-03
+"""
+
+REPORT = b"""CT CHEST WITH CONTRAST
+Technique: standard protocol.
+Lungs are clear.
+Aorta: intimal flap in the ascending aorta, abnormal.
+
+IMPRESSION:
+Type A aortic dissection.
+Recommend emergent surgical consult.
+
+Electronically signed.
+"""
+
+def digest_of(filename, data, piece=7):
+    digest = new_digest(filename)
+    for i in range(0, len(data), piece):
+        digest.feed(data[i:i + piece])
+    digest.finish()
+    digest.size = len(data)
+    return digest
+
+def test_file_kind():
+    assert file_kind("labs.CSV") == "csv"
+    assert file_kind("labs.tsv") == "csv"
+    assert file_kind("report.txt") == "text"
+    assert file_kind("export", "text/csv; charset=utf-8") == "csv"
+    assert file_kind("scan.pdf", "application/pdf") is None
+    with pytest.raises(UnsupportedUpload):
+        new_digest("scan.pdf")
+
+def test_csv_digest_keeps_abnormal_results_only():
+    digest = digest_of("labs.csv", LABS)
+    summary = digest.summary()
+    assert summary["rows"] == 5
+    assert summary["recognized"]
+    assert summary["abnormal_rows"] == 4
+    tests = {item["test"]: item for item in summary["abnormal"]}
+    assert set(tests) == {"Troponin I", "Potassium", "Glucose"}
+    assert tests["Troponin I"]["count"] == 2
+    assert tests["Troponin I"]["value"] == "1.20"
+    assert (tests["Troponin I"]["min"], tests["Troponin I"]["max"]) == (0.45, 1.2)
+    assert tests["Potassium"]["flag"] == "LOW"
+    assert tests["Glucose"]["flag"] == "HIGH"
+    text = digest.text()
+    assert "Sodium" not in text
+    assert "- Troponin I: 1.20 ng/mL HIGH (ref <0.04); 2 abnormal results, 0.45-1.2; last 2024-01-03" in text
+
+def test_csv_without_known_columns():
+    digest = digest_of("other.csv", b"a,b\n1,2\n")
+    assert not digest.summary()["recognized"]
+    assert "no test/value columns recognized" in digest.text()
+
+def test_text_digest_keeps_flagged_lines_and_impression():
+    digest = digest_of("report.txt", REPORT)
+    assert digest.kept == [
+        "Aorta: intimal flap in the ascending aorta, abnormal.",
+        "IMPRESSION:",
+        "Type A aortic dissection.",
+        "Recommend emergent surgical consult.",
+    ]
+    assert digest.summary() == {"lines": 8, "kept_lines": 4, "dropped_lines": 0}
+
+def test_text_digest_decodes_split_characters():
+    digest = digest_of("report.txt", "Impression: ≥ 3 lésions\n".encode("utf-8"), piece=1)
+    assert digest.kept == ["Impression: ≥ 3 lésions"]
+
+def test_save_load_and_attach(tmp_path, monkeypatch):
+    directory = str(tmp_path / "uploads")
+    monkeypatch.setattr(uploads, "UPLOADS_DIR", directory)
+    monkeypatch.setattr(uploads, "start_sweeper", lambda: None)
+    record = uploads.save(digest_of("report.txt", REPORT))
+    assert record["bytes"] == len(REPORT)
+
+    # Digests hold patient data: readable by the server user only
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(uploads.digest_path(record["id"])).st_mode) == 0o600
+    assert uploads.load(record["id"])["text"] == record["text"]
+
+    message = uploads.attach("Chest pain", [record["id"]])
+    assert message == "Chest pain\n\n" + record["text"]
+    with pytest.raises(UploadError):
+        uploads.attach("Chest pain", ["missing"])
+    assert uploads.load("../etc/passwd") is None
+
+def test_expired_digests_are_not_loaded_and_swept(tmp_path, monkeypatch):
+    directory = str(tmp_path / "uploads")
+    monkeypatch.setattr(uploads, "UPLOADS_DIR", directory)
+    monkeypatch.setattr(uploads, "start_sweeper", lambda: None)
+    record = uploads.save(digest_of("report.txt", REPORT))
+    monkeypatch.setattr(uploads, "UPLOAD_TTL", -1)
+    assert uploads.load(record["id"]) is None
+    uploads.sweep()
+    assert os.listdir(directory) == []